@@ -3,34 +3,16 @@ import json
 import os
 import sys
 import time
-from typing import Dict, List
+from typing import Dict
 
 from openai import OpenAI
 
+from kgbench.triples import ParseStats, parse_response
+from kgbench.utils.cache import ResponseCache
+from kgbench.utils.eval import calculate_metrics
 from kgbench.utils.io import read_json
 
 
-def parse_triples(response_text: str) -> List[List[str]]:
-    """Parse the response text to extract triples"""
-    triples = []
-    lines = response_text.strip().split('\n')
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        if '(' in line and ')' in line:
-            try:
-                relation_part, args_part = line.split('(', 1)
-                args_part = args_part.rstrip(')')
-                args = args_part.split(',', 1)
-                if len(args) == 2:
-                    sub = args[0].strip()
-                    obj = args[1].strip()
-                    rel = relation_part.strip()
-                    triples.append([sub, rel, obj])
-            except Exception as e:
-                print(f"Error parsing line: {line}, Error: {str(e)}")
-    return triples
 def get_file_paths(config: dict) -> Dict[str, dict]:
     """Generate file paths from config"""
     try:
@@ -59,6 +41,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--config_path', required=True, help='Path to prompt generation config file')
     parser.add_argument('--api_key', required=False, help='OpenAI API key')
+    parser.add_argument('--cache_path', required=False, help='Path to a SQLite response cache')
+    parser.add_argument('--cache_max_entries', type=int, default=100_000,
+                        help='Maximum number of cached responses before LRU eviction')
     args = parser.parse_args()
 
     config = read_json(args.config_path)
@@ -71,6 +56,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
     client = OpenAI(api_key=api_key)
+    cache = ResponseCache(args.cache_path, args.cache_max_entries) if args.cache_path else None
 
     file_paths = get_file_paths(config)
     if not file_paths:
@@ -97,6 +83,7 @@ if __name__ == "__main__":
             continue
 
         responses = []
+        parse_stats = ParseStats()
         for prompt_data in prompts:
             prompt_id = prompt_data.get('id')
             prompt_text = prompt_data.get('prompt')
@@ -106,18 +93,30 @@ if __name__ == "__main__":
             print(f"Processing prompt {prompt_id}")
 
             try:
-                start_time = time.time()
-                response = client.chat.completions.create(
-                    model="gpt-4o",
-                    messages=[{"role": "user", "content": prompt_text}],
-                    max_tokens=250,
-                    temperature=0
-                )
-                end_time = time.time()
-                print(f"Query OpenAI loading time: {end_time - start_time:.2f} seconds")
-
-                response_text = response.choices[0].message.content
-                triples = parse_triples(response_text)
+                cache_key = ResponseCache.make_key("openai", "gpt-4o", 0, 250, prompt_text)
+                cached = cache.get(cache_key) if cache else None
+                if cached:
+                    response_text = cached['response']
+                else:
+                    start_time = time.time()
+                    response = client.chat.completions.create(
+                        model="gpt-4o",
+                        messages=[{"role": "user", "content": prompt_text}],
+                        max_tokens=250,
+                        temperature=0
+                    )
+                    end_time = time.time()
+                    print(f"Query OpenAI loading time: {end_time - start_time:.2f} seconds")
+
+                    response_text = response.choices[0].message.content
+                    if cache:
+                        # same entry schema as kgbench.utils.llm.get_llm_response, so the cache can be shared
+                        metrics = calculate_metrics(start_time, end_time, response_text, prompt_text,
+                                                    response.usage.completion_tokens if response.usage else None)
+                        cache.put(cache_key, {'response': response_text, 'metrics': metrics})
+                parse_result = parse_response(response_text)
+                parse_stats.add(parse_result, response_text)
+                triples = parse_result.triples
 
                 response_data = {
                     'id': prompt_id,
@@ -141,3 +140,8 @@ if __name__ == "__main__":
         except Exception as e:
             print(f"Error writing responses: {str(e)}")
             continue
+        parse_stats.print_stats(onto)
+
+    if cache:
+        cache.print_stats()
+        cache.close()
@@ -1,15 +1,25 @@
 import argparse
+import hashlib
 import json
+import multiprocessing
 import os
 import sys
 import time
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple, Union
 
 from huggingface_hub import hf_hub_download
-from llama_cpp import Llama
-
+import llama_cpp
+from llama_cpp import Llama, LlamaGrammar
+
+from kgbench.grammar import build_triples_grammar
+from kgbench.ontology import CompiledOntology
+from kgbench.triples import ParseStats, parse_response
+from kgbench.utils.cache import ResponseCache
+from kgbench.utils.eval import calculate_metrics
 from kgbench.utils.io import read_json
 
+MODEL_NAME = "qwen2.5-32b-instruct-q4_k_m.gguf"
+
 
 def download_model() -> Optional[str]:
     """
@@ -19,7 +29,7 @@ def download_model() -> Optional[str]:
         The path to the downloaded model or None if download fails.
     """
     models_dir = "/data/johnsonv/models"
-    model_name = "qwen2.5-32b-instruct-q4_k_m.gguf"
+    model_name = MODEL_NAME
     model_path = os.path.join(models_dir, model_name)
 
     # Create models directory if it doesn't exist
@@ -45,14 +55,21 @@ def download_model() -> Optional[str]:
         return None
 
 
-def initialize_model() -> Optional[Llama]:
+def initialize_model(model_path: Optional[str] = None, n_threads: int = 24,
+                     use_mlock: bool = True) -> Optional[Llama]:
     """
-    Initializes the model using llama_cpp.
+    Initializes the model using llama_cpp. The weights are memory mapped, so the worker
+    processes of a pool share one copy of them in the page cache.
+
+    Args:
+        model_path: Path of the GGUF file, downloaded if not given.
+        n_threads: Number of CPU threads of the model.
+        use_mlock: Whether to lock the weights in memory.
 
     Returns:
         An instance of the Llama model or None if initialization fails.
     """
-    model_path = download_model()
+    model_path = model_path or download_model()
     if not model_path:
         return None
 
@@ -61,9 +78,10 @@ def initialize_model() -> Optional[Llama]:
             model_path=model_path,
             n_gpu_layers=-1,        # Maximum layers for RTX 3090
             n_ctx=2048,             # Keep default context size
-            n_threads=24,           # Match your CPU core count
+            n_threads=n_threads,
             offload_kqv=True,       # Beneficial for large models
-            use_mlock=True,
+            use_mmap=True,
+            use_mlock=use_mlock,
 			verbose=False
         )
         print("Model initialized successfully.")
@@ -72,46 +90,150 @@ def initialize_model() -> Optional[Llama]:
         print(f"Error initializing model: {str(e)}")
         return None
 
-def parse_triples(response_text: str) -> List[List[str]]:
-    """Parse the response text to extract triples."""
-    triples = []
-    lines = response_text.strip().split('\n')
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        if '(' in line and ')' in line:
-            try:
-                relation_part, args_part = line.split('(', 1)
-                args_part = args_part.rstrip(')')
-                args = args_part.split(',', 1)
-                if len(args) == 2:
-                    sub = args[0].strip()
-                    obj = args[1].strip()
-                    rel = relation_part.strip()
-                    triples.append([sub, rel, obj])
-            except Exception as e:
-                print(f"Error parsing line: {line}, Error: {str(e)}")
-    return triples
+class GenerationStats:
+    """Tokens, latency and relation conformance of the responses generated in one mode."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.completion_tokens: List[int] = []
+        self.latencies: List[float] = []
+        self.triples = 0
+        self.conformant_triples = 0
+
+    def add(self, completion_tokens: int, latency: float) -> None:
+        self.completion_tokens.append(completion_tokens)
+        self.latencies.append(latency)
+
+    def add_triples(self, triples: List[List[str]], ontology: Optional[CompiledOntology]) -> None:
+        self.triples += len(triples)
+        if ontology is not None:
+            self.conformant_triples += sum(1 for triple in triples if ontology.is_conformant(triple[1]))
+
+    def update(self, other: "GenerationStats") -> None:
+        self.completion_tokens.extend(other.completion_tokens)
+        self.latencies.extend(other.latencies)
+        self.triples += other.triples
+        self.conformant_triples += other.conformant_triples
+
+    def print_stats(self, onto: str) -> None:
+        if not self.latencies:
+            print(f"{self.name} ({onto}): no generated responses")
+            return
+        num_prompts = len(self.latencies)
+        conformance = self.conformant_triples / self.triples if self.triples else 0.0
+        print(f"{self.name} ({onto}): {num_prompts} prompts, "
+              f"{sum(self.completion_tokens) / num_prompts:.1f} tokens/prompt, "
+              f"{sum(self.latencies) / num_prompts:.2f}s/prompt, "
+              f"{sum(self.completion_tokens) / max(sum(self.latencies), 1e-9):.1f} tokens/s, "
+              f"{self.triples} triples ({conformance:.2%} with ontology relations)")
+
+class PromptEvalStats:
+    """Time to first token and prompt evaluation speed of the generated responses."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.ttfts: List[float] = []
+        self.prompt_eval_tokens = 0
+        self.prompt_eval_seconds = 0.0
+
+    def add(self, ttft: float, prompt_eval_tokens: int, prompt_eval_seconds: float) -> None:
+        self.ttfts.append(ttft)
+        self.prompt_eval_tokens += prompt_eval_tokens
+        self.prompt_eval_seconds += prompt_eval_seconds
+
+    def update(self, other: "PromptEvalStats") -> None:
+        self.ttfts.extend(other.ttfts)
+        self.prompt_eval_tokens += other.prompt_eval_tokens
+        self.prompt_eval_seconds += other.prompt_eval_seconds
+
+    def print_stats(self, onto: str) -> None:
+        if not self.ttfts:
+            print(f"{self.name} ({onto}): no generated responses")
+            return
+        ttfts = sorted(self.ttfts)
+        print(f"{self.name} ({onto}): {len(ttfts)} prompts, "
+              f"time to first token {sum(ttfts) / len(ttfts):.3f}s mean, {ttfts[len(ttfts) // 2]:.3f}s median, "
+              f"{self.prompt_eval_tokens / len(ttfts):.1f} prompt tokens evaluated/prompt, "
+              f"{self.prompt_eval_tokens / max(self.prompt_eval_seconds, 1e-9):.1f} prompt eval tokens/s")
+
+class PrefixCache:
+    """
+    KV cache state of the prompt prefix shared by the prompts of an ontology, i.e. the
+    instructions and the ontology header. The prefix is evaluated once and the state is
+    restored before each prompt, so llama.cpp only evaluates the rest of the prompt: the
+    prefix tokens of the restored state match the prompt tokens and are kept.
+    """
 
-def get_file_paths(config: dict) -> Dict[str, dict]:
+    def __init__(self, llm: Llama, prompts: List[str]):
+        prefix = os.path.commonprefix(prompts)
+        # cut the prefix after a line break, so it is tokenized as in the full prompts
+        self.prefix = prefix[:prefix.rfind('\n') + 1]
+        self.num_tokens = len(llm.tokenize(self.prefix.encode('utf-8'), add_bos=False)) if self.prefix else 0
+        self.state = None
+        if self.prefix:
+            llm.reset()
+            llm.create_chat_completion(
+                messages=[{"role": "user", "content": self.prefix}],
+                temperature=0,
+                max_tokens=1
+            )
+            self.state = llm.save_state()
+
+    def restore(self, llm: Llama) -> None:
+        if self.state is not None:
+            llm.load_state(self.state)
+
+class OntologyStats:
+    """Statistics of the prompts of an ontology, merged over the shards of a worker pool."""
+
+    def __init__(self):
+        self.parse_stats = ParseStats()
+        self.free_text_stats = GenerationStats("Free text")
+        self.grammar_stats = GenerationStats("Grammar")
+        self.reuse_stats = PromptEvalStats("Prefix reuse")
+        self.no_reuse_stats = PromptEvalStats("No prefix reuse")
+
+    @property
+    def completion_tokens(self) -> int:
+        return sum(self.free_text_stats.completion_tokens) + sum(self.grammar_stats.completion_tokens)
+
+    def update(self, other: "OntologyStats") -> None:
+        self.parse_stats.update(other.parse_stats)
+        self.free_text_stats.update(other.free_text_stats)
+        self.grammar_stats.update(other.grammar_stats)
+        self.reuse_stats.update(other.reuse_stats)
+        self.no_reuse_stats.update(other.no_reuse_stats)
+
+    def print_stats(self, onto: str, grammar: str, prefix_reuse: str) -> None:
+        self.parse_stats.print_stats(onto)
+        if grammar != 'on':
+            self.free_text_stats.print_stats(onto)
+        if grammar != 'off':
+            self.grammar_stats.print_stats(onto)
+        if prefix_reuse != 'off':
+            self.reuse_stats.print_stats(onto)
+        if prefix_reuse != 'on':
+            self.no_reuse_stats.print_stats(onto)
+
+def get_file_paths(config: dict, response_name: str = "Qwen2_5-32B-Instruct-Q4KM") -> Dict[str, dict]:
     """Generate file paths from config."""
     try:
         # Extract dataset and type from path patterns
         prompt_pattern = config['path_patterns']['prompt']
-
+        onto_pattern = config['path_patterns'].get('onto', '')
 
         # Extract base dataset path (e.g., "./data/dbpedia_webnlg" or "./data/wikidata_tekgen")
         base_path = prompt_pattern.split('/baselines')[0]
 
         # Construct response directory path
-        response_base = f"{base_path}/baselines/Qwen2_5-32B-Instruct-Q4KM"
+        response_base = f"{base_path}/baselines/{response_name}"
         response_dir = f"{response_base}/llm_responses"
 
         file_paths = {}
         for onto in config['onto_list']:
             file_paths[onto] = {
                 'prompt_file': prompt_pattern.replace('$$onto$$', onto),
+                'onto_file': onto_pattern.replace('$$onto$$', onto),
                 'response_dir': response_dir
             }
         return file_paths
@@ -119,49 +241,276 @@ def get_file_paths(config: dict) -> Dict[str, dict]:
         print(f"Error generating file paths: {str(e)}")
         return {}
 
-def generate_response(llm: Llama, prompt: str) -> Optional[str]:
+def get_cache_key(prompt: str, grammar_id: Optional[str] = None) -> str:
+    """Response cache key of a prompt, grammar constrained responses are cached per grammar."""
+    model_key = MODEL_NAME if grammar_id is None else f"{MODEL_NAME}+gbnf:{grammar_id}"
+    return ResponseCache.make_key("llama_cpp", model_key, 0, None, prompt)
+
+class ShardCache:
+    """
+    Response cache of a shard processed in a worker process. Only the parent process uses the
+    SQLite cache: it looks up the prompts of the shard before sending it, and stores the new
+    entries the worker returns, so the workers never write to the database concurrently.
+    """
+
+    def __init__(self, entries: Dict[str, dict]):
+        self.entries = entries
+        self.new_entries: Dict[str, dict] = {}
+
+    def get(self, key: str) -> Optional[dict]:
+        return self.entries.get(key)
+
+    def put(self, key: str, value: dict) -> None:
+        self.new_entries[key] = value
+
+def generate_response(llm: Llama, prompt: str,
+                      cache: Optional[Union[ResponseCache, ShardCache]] = None,
+                      grammar: Optional[LlamaGrammar] = None,
+                      grammar_id: Optional[str] = None,
+                      stats: Optional[GenerationStats] = None,
+                      prefix_cache: Optional[PrefixCache] = None,
+                      eval_stats: Optional[PromptEvalStats] = None,
+                      max_tokens: Optional[int] = None) -> Optional[str]:
     """
     Generates a response from the model given a prompt using chat completion.
 
     Args:
         llm: The initialized model.
         prompt: The input prompt string.
+        cache: Optional response cache consulted before running the model.
+        grammar: Optional GBNF grammar constraining the response.
+        grammar_id: Identifier of the grammar, part of the cache key.
+        stats: Optional statistics updated with the tokens and latency of a generated response.
+        prefix_cache: Optional state of the ontology prompt prefix restored before generating.
+            Without it the model state is reset, so the full prompt is evaluated.
+        eval_stats: Optional statistics updated with the time to first token and the prompt
+            evaluation of a generated response.
+        max_tokens: Optional maximum number of generated tokens.
 
     Returns:
         The generated response string or None if generation fails.
     """
     try:
+        cache_key = get_cache_key(prompt, grammar_id if grammar is not None else None)
+        cached = cache.get(cache_key) if cache else None
+        if cached:
+            return cached['response']
+
+        if prefix_cache is not None:
+            prefix_cache.restore(llm)
+        else:
+            llm.reset()
+        llama_cpp.llama_perf_context_reset(llm.ctx)
+
+        # the response is streamed to measure the time to first token, one chunk per token
         start_time = time.time()
-        response = llm.create_chat_completion(
+        first_token_time = None
+        chunks = []
+        for chunk in llm.create_chat_completion(
             messages=[{"role": "user", "content": prompt}],
-            temperature=0
-        )
+            temperature=0,
+            grammar=grammar,
+            max_tokens=max_tokens,
+            stream=True
+        ):
+            content = chunk['choices'][0]['delta'].get('content')
+            if content:
+                if first_token_time is None:
+                    first_token_time = time.time()
+                chunks.append(content)
         end_time = time.time()
 
         # Extract content from chat completion response
-        response_text = response['choices'][0]['message']['content']
+        response_text = ''.join(chunks)
 
         print(f"Response generated in {end_time - start_time:.2f} seconds.")
+        if stats is not None:
+            stats.add(len(chunks), end_time - start_time)
+        if eval_stats is not None:
+            perf = llama_cpp.llama_perf_context(llm.ctx)
+            eval_stats.add((first_token_time or end_time) - start_time, perf.n_p_eval, perf.t_p_eval_ms / 1000)
+        if cache:
+            # same entry schema as kgbench.utils.llm.get_llm_response; a cache error must not
+            # discard the generated response
+            try:
+                metrics = calculate_metrics(start_time, end_time, response_text, prompt, len(chunks))
+                cache.put(cache_key, {'response': response_text, 'metrics': metrics})
+            except Exception as e:
+                print(f"Error caching response: {str(e)}")
         return response_text
     except Exception as e:
         print(f"Error generating response: {str(e)}")
         return None
 
+def process_prompts(llm: Llama, prompts: List[dict], ontology: Optional[CompiledOntology],
+                    grammar_text: Optional[str], args: argparse.Namespace,
+                    cache: Optional[Union[ResponseCache, ShardCache]] = None) -> Tuple[List[dict], OntologyStats]:
+    """
+    Generates the responses of prompts of one ontology, either all of them or one shard.
+
+    Args:
+        llm: The initialized model.
+        prompts: The prompt records, with an id and a prompt.
+        ontology: The compiled ontology, used for the relation conformance of the responses.
+        grammar_text: Optional GBNF grammar of the ontology relations.
+        args: The command line arguments, for the grammar and prefix reuse modes.
+        cache: Optional response cache consulted before running the model.
+
+    Returns:
+        The response records in prompt order and the statistics of the prompts.
+    """
+    stats = OntologyStats()
+    grammar, grammar_id = None, None
+    if grammar_text is not None:
+        grammar = LlamaGrammar.from_string(grammar_text, verbose=False)
+        grammar_id = hashlib.sha1(grammar_text.encode('utf-8')).hexdigest()[:16]
+
+    # the prompts of the ontology share the instructions and ontology header, which are evaluated once
+    prefix_cache = None
+    if args.prefix_reuse != 'off':
+        prefix_start = time.time()
+        prefix_cache = PrefixCache(llm, [p['prompt'] for p in prompts if p.get('prompt')])
+        print(f"Prompt prefix of {prefix_cache.num_tokens} tokens evaluated in {time.time() - prefix_start:.2f}s")
+
+    responses = []
+    eval_stats = stats.no_reuse_stats if prefix_cache is None else stats.reuse_stats
+    for prompt_data in prompts:
+        prompt_id = prompt_data.get('id')
+        prompt_text = prompt_data.get('prompt')
+        if not prompt_id or not prompt_text:
+            continue
+
+        print(f"Processing prompt {prompt_id}")
+
+        if args.prefix_reuse == 'compare':
+            # the first token is enough to measure the evaluation of the full prompt
+            generate_response(llm, prompt_text, grammar=grammar, grammar_id=grammar_id,
+                              eval_stats=stats.no_reuse_stats, max_tokens=1)
+
+        if args.grammar == 'compare':
+            # the free text response is only generated for the report
+            free_text = generate_response(llm, prompt_text, stats=stats.free_text_stats,
+                                          prefix_cache=prefix_cache)
+            if free_text:
+                stats.free_text_stats.add_triples(parse_response(free_text).triples, ontology)
+
+        if grammar is not None:
+            response_text = generate_response(llm, prompt_text, cache, grammar, grammar_id, stats.grammar_stats,
+                                              prefix_cache, eval_stats)
+        else:
+            response_text = generate_response(llm, prompt_text, cache, stats=stats.free_text_stats,
+                                              prefix_cache=prefix_cache, eval_stats=eval_stats)
+        if response_text:
+            parse_result = parse_response(response_text)
+            stats.parse_stats.add(parse_result, response_text)
+            triples = parse_result.triples
+            (stats.grammar_stats if grammar is not None else stats.free_text_stats).add_triples(triples, ontology)
+
+            response_data = {
+                'id': prompt_id,
+                'response': response_text,
+                'triples': triples
+            }
+
+            responses.append(response_data)
+            print(f"Prompt {prompt_id} processed successfully.")
+        else:
+            print(f"Failed to generate response for prompt {prompt_id}.")
+    return responses, stats
+
+# model of a worker process of the pool, set by init_worker
+_worker_llm: Optional[Llama] = None
+
+def init_worker(model_path: str, n_threads: int) -> None:
+    """Loads the model of a worker process."""
+    global _worker_llm
+    # the weights are shared through the memory map; locking them in every worker would
+    # count the whole model against the memlock limit of each process
+    _worker_llm = initialize_model(model_path, n_threads, use_mlock=False)
+
+def run_shard(llm: Optional[Llama], cache: Optional[ResponseCache],
+              task: tuple) -> Tuple[str, int, List[dict], OntologyStats, Dict[str, dict]]:
+    """
+    Generates the responses of a shard of prompts.
+
+    Args:
+        llm: The initialized model.
+        cache: Optional response cache consulted before running the model, only in the
+            parent process.
+        task: The ontology, the index of the shard, its prompts, the compiled ontology,
+            the grammar text, the command line arguments and, for a worker process, the
+            cached responses of the shard looked up by the parent (None without a cache).
+
+    Returns:
+        The ontology, the index of the shard, its response records, its statistics and the
+        new cache entries of a worker process.
+    """
+    onto, shard_index, prompts, ontology, grammar_text, args, cached_entries = task
+    print(f"\nProcessing ontology: {onto}, shard {shard_index}")
+    if cache is None and cached_entries is not None:
+        cache = ShardCache(cached_entries)
+    if llm is None:
+        print(f"Model not initialized. Skipping shard {shard_index} of ontology {onto}.")
+        return onto, shard_index, [], OntologyStats(), {}
+    try:
+        responses, stats = process_prompts(llm, prompts, ontology, grammar_text, args, cache)
+    except Exception as e:
+        print(f"Error processing shard {shard_index} of ontology {onto}: {str(e)}")
+        responses, stats = [], OntologyStats()
+    new_entries = cache.new_entries if isinstance(cache, ShardCache) else {}
+    return onto, shard_index, responses, stats, new_entries
+
+def process_shard(task: tuple) -> Tuple[str, int, List[dict], OntologyStats, Dict[str, dict]]:
+    """Generates the responses of a shard of prompts in a worker process."""
+    return run_shard(_worker_llm, None, task)
+
 def main():
     parser = argparse.ArgumentParser(description="Process prompts using model and store responses.")
     parser.add_argument('--config_path', required=True, help='Path to prompt generation config file')
+    parser.add_argument('--cache_path', required=False, help='Path to a SQLite response cache')
+    parser.add_argument('--cache_max_entries', type=int, default=100_000,
+                        help='Maximum number of cached responses before LRU eviction')
+    parser.add_argument('--grammar', choices=['off', 'on', 'compare'], default='off',
+                        help='Constrain the responses with a GBNF grammar of the ontology relations; '
+                             'compare also generates each response without the grammar and reports both')
+    parser.add_argument('--max_triples', type=int, default=None,
+                        help='Maximum number of triples allowed by the grammar')
+    parser.add_argument('--prefix_reuse', choices=['on', 'off', 'compare'], default='on',
+                        help='Evaluate the prompt prefix of each ontology once and restore its KV cache state '
+                             'before each prompt; compare also measures the time to first token without it')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of llama.cpp worker processes sharing the memory mapped model')
+    parser.add_argument('--n_threads', type=int, default=24,
+                        help='Total number of CPU threads, split evenly across the workers')
+    parser.add_argument('--shard_size', type=int, default=None,
+                        help='Number of prompts per task of the worker pool, by default the prompts of '
+                             'each ontology are split into one shard per worker')
     args = parser.parse_args()
 
     config = read_json(args.config_path)
     if not config:
         sys.exit(1)
 
-    llm = initialize_model()
-    if not llm:
+    workers = max(1, args.workers)
+    threads_per_worker = max(1, args.n_threads // workers)
+
+    model_path = download_model()
+    if not model_path:
         print("Failed to initialize model.")
         sys.exit(1)
 
-    file_paths = get_file_paths(config)
+    # the SQLite response cache is only opened by this process, also with a worker pool
+    cache = ResponseCache(args.cache_path, args.cache_max_entries) if args.cache_path else None
+    llm = None
+    if workers == 1:
+        llm = initialize_model(model_path, threads_per_worker)
+        if not llm:
+            print("Failed to initialize model.")
+            sys.exit(1)
+
+    # grammar constrained responses are written next to the free text baseline
+    response_name = "Qwen2_5-32B-Instruct-Q4KM" if args.grammar == 'off' else "Qwen2_5-32B-Instruct-Q4KM-GBNF"
+    file_paths = get_file_paths(config, response_name)
     if not file_paths:
         sys.exit(1)
 
@@ -169,8 +518,9 @@ def main():
     output_dir = next(iter(file_paths.values()))['response_dir']
     os.makedirs(output_dir, exist_ok=True)
 
+    tasks = []
+    num_shards: Dict[str, int] = {}
     for onto in config['onto_list']:
-        print(f"\nProcessing ontology: {onto}")
         paths = file_paths[onto]
         prompt_file = paths['prompt_file']
 
@@ -185,40 +535,94 @@ def main():
             print(f"Error reading prompt file {prompt_file}: {str(e)}")
             continue
 
-        responses = []
-        for prompt_data in prompts:
-            prompt_id = prompt_data.get('id')
-            prompt_text = prompt_data.get('prompt')
-            if not prompt_id or not prompt_text:
+        # the ontology is used for the relation conformance of the responses and the grammar
+        ontology = CompiledOntology.from_file(paths['onto_file']) if os.path.exists(paths['onto_file']) else None
+        grammar_text = None
+        if args.grammar != 'off':
+            if ontology is None:
+                print(f"Ontology file {paths['onto_file']} not found. Skipping ontology {onto}.")
+                continue
+            try:
+                # compile the ontology relations into a grammar once per ontology
+                grammar_text = build_triples_grammar(ontology, max_triples=args.max_triples)
+            except Exception as e:
+                print(f"Error building the grammar of ontology {onto}: {str(e)}")
                 continue
 
-            print(f"Processing prompt {prompt_id}")
-
-            response_text = generate_response(llm, prompt_text)
-            if response_text:
-                triples = parse_triples(response_text)
-
-                response_data = {
-                    'id': prompt_id,
-                    'response': response_text,
-                    'triples': triples
-                }
-
-                responses.append(response_data)
-                print(f"Prompt {prompt_id} processed successfully.")
-            else:
-                print(f"Failed to generate response for prompt {prompt_id}.")
+        # contiguous shards keep the prompts that share a prefix on the same worker
+        shard_size = args.shard_size or max(1, -(-len(prompts) // workers))
+        shards = [prompts[i:i + shard_size] for i in range(0, len(prompts), shard_size)] or [[]]
+        num_shards[onto] = len(shards)
+        grammar_id = hashlib.sha1(grammar_text.encode('utf-8')).hexdigest()[:16] if grammar_text is not None else None
+        for shard_index, shard in enumerate(shards):
+            # the workers get the cached responses of their shard instead of the cache itself
+            cached_entries = None
+            if cache is not None and workers > 1:
+                cached_entries = {}
+                for prompt_data in shard:
+                    if prompt_data.get('prompt'):
+                        key = get_cache_key(prompt_data['prompt'], grammar_id)
+                        cached = cache.get(key)
+                        if cached:
+                            cached_entries[key] = cached
+            tasks.append((onto, shard_index, shard, ontology, grammar_text, args, cached_entries))
+
+    pool = None
+    start_time = time.time()
+    if workers > 1:
+        print(f"Starting {workers} llama.cpp workers with {threads_per_worker} threads each")
+        pool = multiprocessing.get_context('spawn').Pool(
+            workers, initializer=init_worker,
+            initargs=(model_path, threads_per_worker)
+        )
+        results = pool.imap_unordered(process_shard, tasks)
+    else:
+        results = (run_shard(llm, cache, task) for task in tasks)
+
+    # the shards of an ontology are merged in prompt order once all of them are done
+    shard_responses: Dict[str, Dict[int, List[dict]]] = {}
+    onto_stats: Dict[str, OntologyStats] = {}
+    completion_tokens = 0
+    try:
+        for onto, shard_index, responses, stats, new_entries in results:
+            for key, value in new_entries.items():
+                try:
+                    cache.put(key, value)
+                except Exception as e:
+                    print(f"Error caching response: {str(e)}")
+            shard_responses.setdefault(onto, {})[shard_index] = responses
+            onto_stats.setdefault(onto, OntologyStats()).update(stats)
+            completion_tokens += stats.completion_tokens
+            if len(shard_responses[onto]) < num_shards[onto]:
+                continue
 
-        output_file = os.path.join(output_dir, f'ont_{onto}_responses.jsonl')
-        try:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                for response_data in responses:
-                    json_line = json.dumps(response_data, ensure_ascii=False)
-                    f.write(json_line + '\n')
-            print(f"Successfully wrote responses to {output_file}")
-        except Exception as e:
-            print(f"Error writing responses: {str(e)}")
-            continue
+            print(f"\nProcessed ontology: {onto}")
+            output_file = os.path.join(output_dir, f'ont_{onto}_responses.jsonl')
+            try:
+                with open(output_file, 'w', encoding='utf-8') as f:
+                    for index in range(num_shards[onto]):
+                        for response_data in shard_responses[onto][index]:
+                            json_line = json.dumps(response_data, ensure_ascii=False)
+                            f.write(json_line + '\n')
+                print(f"Successfully wrote responses to {output_file}")
+            except Exception as e:
+                print(f"Error writing responses: {str(e)}")
+                continue
+            finally:
+                del shard_responses[onto]
+            onto_stats[onto].print_stats(onto, args.grammar, args.prefix_reuse)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.time() - start_time
+    print(f"\n{workers} workers x {threads_per_worker} threads: {completion_tokens} tokens generated "
+          f"in {elapsed:.1f}s, {completion_tokens / max(elapsed, 1e-9):.1f} tokens/s aggregate")
+
+    if cache:
+        cache.print_stats()
+        cache.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,120 @@
+import argparse
+import os
+import sys
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from kgbench.prompts import load_similarity_index
+from kgbench.similarity import BM25Index, SimilarityMatrix, get_top_k_agreement, save_similarity_results
+from kgbench.utils.io import iter_jsonl, read_json
+
+
+def load_sentences(file_path: str) -> Tuple[List[str], List[str]]:
+    """Load sentences and IDs from JSONL file"""
+    sentences, ids = [], []
+    try:
+        for data in iter_jsonl(file_path):
+            sentences.append(data['sent'])
+            ids.append(data['id'])
+        return sentences, ids
+    except Exception as e:
+        print(f"Error loading sentences from {file_path}: {str(e)}")
+        return [], []
+
+def process_ontology(onto: str, config: dict, output_pattern: str) -> Optional[dict]:
+    """
+    Find the most similar train sentences of each test sentence of an ontology with BM25.
+    The results are compared with the existing sent_sim file (T5-XXL similarities) before
+    the output is written.
+    :return: the timings and agreement of the ontology, None if it was skipped
+    """
+    try:
+        test_file = config['path_patterns']['test'].replace('$$onto$$', onto)
+        train_file = config['path_patterns']['train'].replace('$$onto$$', onto)
+        reference_file = config['path_patterns']['sent_sim'].replace('$$onto$$', onto)
+        output_file = output_pattern.replace('$$onto$$', onto)
+
+        print(f'\n{"-"*40}\nProcessing ontology: {onto}\n{"-"*40}')
+
+        test_sentences, test_ids = load_sentences(test_file)
+        train_sentences, train_ids = load_sentences(train_file)
+        if not test_sentences or not train_sentences:
+            print(f"Skipping {onto} due to missing data")
+            return None
+
+        start = time.time()
+        index = BM25Index(train_sentences, k1=config.get('bm25_k1', 1.2), b=config.get('bm25_b', 0.75))
+        build_seconds = time.time() - start
+
+        start = time.time()
+        top_rows, top_scores = index.search_many(test_sentences, top_k=config.get('top_k', 5))
+        search_seconds = time.time() - start
+        similarity_results = SimilarityMatrix(test_ids, train_ids, top_rows, top_scores.astype(np.float16))
+
+        stats = {
+            "onto": onto,
+            "num_train": len(train_ids),
+            "num_test": len(test_ids),
+            "build_seconds": build_seconds,
+            "queries_per_second": len(test_ids) / max(search_seconds, 1e-9),
+            "overlap": None,
+            "identical": None,
+        }
+        print(f"Index of {len(train_ids)} train sentences built in {build_seconds:.3f}s, "
+              f"{stats['queries_per_second']:.1f} queries/sec")
+
+        # compare with the T5-XXL similarity file of the config
+        reference_results = load_similarity_index(reference_file) if os.path.exists(reference_file) else None
+        if reference_results is not None:
+            stats["overlap"], stats["identical"] = get_top_k_agreement(similarity_results, reference_results)
+            print(f"Top-k agreement with {reference_file}: {stats['overlap']:.2%} overlap, "
+                  f"{stats['identical']:.2%} identical lists")
+
+        save_similarity_results(similarity_results, output_file, config.get('sent_sim_format', 'json'))
+        print(f'\n{"-"*40}\nResults saved to {output_file}\n{"-"*40}')
+        return stats
+
+    except Exception as e:
+        print(f"Error processing ontology {onto}: {str(e)}")
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config_path', required=True, help='Path to config file')
+    parser.add_argument('--output_pattern',
+                        help='Output path pattern with $$onto$$, defaults to the sent_sim_bm25 pattern of the config')
+    args = parser.parse_args()
+
+    config = read_json(args.config_path)
+    if not config:
+        sys.exit(1)
+    # the sent_sim files of the config are the T5-XXL reference and are only replaced when asked explicitly
+    output_pattern = args.output_pattern or config['path_patterns'].get('sent_sim_bm25')
+    if not output_pattern:
+        print("No output pattern: pass --output_pattern or add a sent_sim_bm25 path pattern to the config")
+        sys.exit(1)
+
+    all_stats = [
+        stats for stats in (process_ontology(onto, config, output_pattern) for onto in config['onto_list'])
+        if stats is not None
+    ]
+    if not all_stats:
+        sys.exit(1)
+
+    # summary over all ontologies
+    total_queries = sum(stats['num_test'] for stats in all_stats)
+    total_search_seconds = sum(stats['num_test'] / stats['queries_per_second'] for stats in all_stats)
+    print(f"\nBuilt {len(all_stats)} indexes in {sum(stats['build_seconds'] for stats in all_stats):.3f}s, "
+          f"{total_queries / max(total_search_seconds, 1e-9):.1f} queries/sec")
+    compared = [stats for stats in all_stats if stats['overlap'] is not None]
+    if compared:
+        num_compared = sum(stats['num_test'] for stats in compared)
+        overlap = sum(stats['overlap'] * stats['num_test'] for stats in compared) / num_compared
+        identical = sum(stats['identical'] * stats['num_test'] for stats in compared) / num_compared
+        print(f"Top-k agreement with the existing similarity files: {overlap:.2%} overlap, "
+              f"{identical:.2%} identical lists")
+
+if __name__ == "__main__":
+    main()
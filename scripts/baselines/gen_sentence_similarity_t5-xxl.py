@@ -1,62 +1,207 @@
 import argparse
-import glob
-import hashlib
 import json
-import os
-import shutil
 import sys
-from typing import List, Tuple
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple, Union
 
+import numpy as np
 import torch
 from sentence_transformers import SentenceTransformer, util
 from tqdm import tqdm
 
+from kgbench.similarity import SimilarityMatrix, get_top_k_agreement, save_similarity_results
+from kgbench.utils.db import LanceDB
+from kgbench.utils.embeddings import DEFAULT_CACHE_DIR, EmbeddingStore, dequantize_embeddings
 from kgbench.utils.io import read_json
 
 
-def load_sentences(file_path: str) -> Tuple[List[str], List[str], str]:
-    """Load sentences, IDs, and compute file content hash from JSONL file"""
+def load_sentences(file_path: str) -> Tuple[List[str], List[str]]:
+    """Load sentences and IDs from JSONL file"""
     sentences, ids = [], []
-    content = []
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
             for line in f:
-                content.append(line)
                 data = json.loads(line.strip())
                 sentences.append(data['sent'])
                 ids.append(data['id'])
-        file_content = ''.join(content)
-        file_hash = hashlib.sha1(file_content.encode('utf-8')).hexdigest()
-        return sentences, ids, file_hash
+        return sentences, ids
     except Exception as e:
         print(f"Error loading sentences from {file_path}: {str(e)}")
-        return [], [], ''
+        return [], []
+
+def get_token_budget_batches(lengths: List[int], max_batch_tokens: int) -> List[List[int]]:
+    """
+    Group sentences into batches of similar length. Sentences are sorted by token length
+    (longest first) and a batch grows while its padded size, the number of sentences times
+    the longest length, stays within max_batch_tokens.
+    :return: the batches as lists of sentence positions
+    """
+    batches, batch, batch_len = [], [], 0
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        length = max(1, lengths[i])
+        if batch and (len(batch) + 1) * max(batch_len, length) > max_batch_tokens:
+            batches.append(batch)
+            batch, batch_len = [], 0
+        batch.append(i)
+        batch_len = max(batch_len, length)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def encode_sentences(model: SentenceTransformer,
+                     sentences: List[str],
+                     max_batch_tokens: int = 16384,
+                     num_threads: int = 1) -> np.ndarray:
+    """
+    Encode sentences in length-sorted batches formed under a token budget instead of a fixed
+    number of rows, so little time is spent on padding. The batches are encoded by
+    num_threads threads, each using an equal share of the torch CPU threads, and the
+    embeddings are returned in the original order.
+    """
+    start_time = time.time()
+    max_length = model.max_seq_length or None
+    lengths = [
+        len(input_ids) for input_ids in
+        model.tokenizer(sentences, truncation=max_length is not None, max_length=max_length)['input_ids']
+    ]
+    batches = get_token_budget_batches(lengths, max_batch_tokens)
+
+    def encode_batch(batch: List[int]) -> np.ndarray:
+        return model.encode([sentences[i] for i in batch], batch_size=len(batch),
+                            convert_to_numpy=True, show_progress_bar=False)
+
+    torch_threads = torch.get_num_threads()
+    if num_threads > 1:
+        torch.set_num_threads(max(1, torch_threads // num_threads))
+    try:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            batch_embeddings = list(tqdm(executor.map(encode_batch, batches), total=len(batches)))
+    finally:
+        torch.set_num_threads(torch_threads)
+
+    # restore the original order of the sentences
+    embeddings = np.empty((len(sentences), batch_embeddings[0].shape[1]), dtype=np.float32)
+    for batch, batch_embedding in zip(batches, batch_embeddings):
+        embeddings[batch] = batch_embedding
+    elapsed = time.time() - start_time
+    print(f"Encoded {len(sentences)} sentences in {len(batches)} batches with {num_threads} "
+          f"threads: {len(sentences) / max(elapsed, 1e-9):.1f} sentences/sec")
+    return embeddings
+
+
+def get_block_rows(num_train: int, element_size: int, max_block_mb: float) -> int:
+    """Number of test rows whose similarity scores against the train matrix fit in max_block_mb"""
+    row_bytes = max(1, num_train * element_size)
+    return max(1, int(max_block_mb * 1024 * 1024) // row_bytes)
+
+
+def dequantize_train_block(train_embeddings: torch.Tensor,
+                           train_scales: Optional[torch.Tensor],
+                           start: int,
+                           end: int,
+                           device: torch.device) -> torch.Tensor:
+    """Dequantize and normalize a block of rows of a float16 or int8 train matrix"""
+    block = train_embeddings[start:end].to(device).float()
+    if train_scales is not None:
+        block = block * train_scales[start:end].to(device).unsqueeze(1)
+    return util.normalize_embeddings(block)
+
 
 def compute_similarities(test_embeddings: torch.Tensor,
                        train_embeddings: torch.Tensor,
                        test_ids: List[str],
                        train_ids: List[str],
-                       top_k: int) -> dict:
-    """Compute similarities between test and train embeddings"""
+                       top_k: int,
+                       max_block_mb: float = 256,
+                       train_scales: Optional[torch.Tensor] = None) -> Union[SimilarityMatrix, dict]:
+    """
+    Compute similarities between test and train embeddings. Blocks of test rows are scored
+    against the whole train matrix with a single matrix multiplication and top-k runs on
+    the whole block; the size of a score block is capped by max_block_mb.
+    A quantized train matrix (float16, or int8 codes with per-vector train_scales) is scored
+    as is: it is dequantized one block of train rows at a time, so a float32 copy of the
+    whole train matrix is never built.
+    :return: the top-k train sentences and scores of each test sentence, an empty dict on error
+    """
     try:
         # Compute similarities and find top-k similar sentences
-        similarity_results = {}
         print('Computing similarities and finding top similar sentences...')
-        for idx, test_embedding in enumerate(tqdm(test_embeddings)):
-            cosine_scores = util.cos_sim(test_embedding, train_embeddings)[0]
-            top_results = torch.topk(cosine_scores, k=top_k)
-            similar_train_ids = [train_ids[i] for i in top_results[1]]
-            similarity_results[test_ids[idx]] = similar_train_ids
-        return similarity_results
+        test_embeddings = util.normalize_embeddings(torch.as_tensor(test_embeddings).float())
+        device = test_embeddings.device
+        train_embeddings = torch.as_tensor(train_embeddings)
+        quantized = train_embeddings.dtype != torch.float32 or train_scales is not None
+        if quantized:
+            if train_scales is not None:
+                train_scales = torch.as_tensor(train_scales)
+            train_block_rows = get_block_rows(train_embeddings.shape[1], 4, max_block_mb)
+        else:
+            train_embeddings = util.normalize_embeddings(train_embeddings).to(device)
+        top_k = min(top_k, len(train_ids))
+        top_indices = np.zeros((len(test_ids), top_k), dtype=np.int32)
+        top_scores = np.zeros((len(test_ids), top_k), dtype=np.float16)
+
+        block_rows = get_block_rows(len(train_ids), test_embeddings.element_size(), max_block_mb)
+        for start in tqdm(range(0, len(test_ids), block_rows)):
+            block = test_embeddings[start:start + block_rows]
+            # cosine similarity of the normalized embeddings
+            if quantized:
+                cosine_scores = torch.empty((block.shape[0], len(train_ids)), device=device)
+                for train_start in range(0, len(train_ids), train_block_rows):
+                    train_end = train_start + train_block_rows
+                    cosine_scores[:, train_start:train_end] = block @ dequantize_train_block(
+                        train_embeddings, train_scales, train_start, train_end, device
+                    ).T
+            else:
+                cosine_scores = block @ train_embeddings.T
+            top = torch.topk(cosine_scores, k=top_k, dim=1)
+            top_indices[start:start + block_rows] = top.indices.cpu().numpy()
+            top_scores[start:start + block_rows] = top.values.cpu().numpy()
+        return SimilarityMatrix(test_ids, train_ids, top_indices, top_scores)
     except Exception as e:
         print(f"Error computing similarities: {str(e)}")
         return {}
 
+def ingest_train_embeddings(example_db: LanceDB,
+                            table_name: str,
+                            train_ids: List[str],
+                            train_sentences: List[str],
+                            train_embeddings: np.ndarray,
+                            min_index_rows: int = 4096,
+                            batch_rows: int = 10_000) -> None:
+    """
+    Replace the LanceDB table of the train sentences of an ontology, ingesting the embeddings
+    as Arrow record batches. Tables with at least min_index_rows rows get a vector index,
+    smaller tables are searched exhaustively.
+    """
+    batches = (
+        LanceDB.to_record_batch(train_ids[start:start + batch_rows],
+                                train_sentences[start:start + batch_rows],
+                                train_embeddings[start:start + batch_rows])
+        for start in range(0, len(train_ids), batch_rows)
+    )
+    num_rows = example_db.add_record_batches(
+        table_name, batches, schema=LanceDB.get_schema(train_embeddings.shape[1]), overwrite=True)
+    print(f"Ingested {num_rows} train embeddings into LanceDB table {table_name}")
+    if num_rows >= min_index_rows:
+        try:
+            example_db.create_vector_index(table_name, overwrite=True)
+        except Exception as e:
+            print(f"Error creating vector index on {table_name}, it will be searched exhaustively: {str(e)}")
+
 def process_ontology(onto: str,
                     config: dict,
                     model: SentenceTransformer,
-                    model_name: str) -> None:
-    """Process single ontology with cross-config cache support"""
+                    store: EmbeddingStore,
+                    reference_store: Optional[EmbeddingStore] = None,
+                    example_db: Optional[LanceDB] = None) -> None:
+    """
+    Process single ontology, embeddings are shared across corpora and configs through the store.
+    If a float32 reference store is given for a quantized store, the top-k agreement of the
+    quantized similarities with float32 similarities is reported. If a LanceDB database is
+    given, the train embeddings are ingested into the example table of the ontology.
+    """
     try:
         # Get file paths using patterns
         test_file = config['path_patterns']['test'].replace('$$onto$$', onto)
@@ -66,99 +211,70 @@ def process_ontology(onto: str,
         print(f'\n{"-"*40}\nProcessing ontology: {onto}\n{"-"*40}')
 
         # Load test and train data
-        test_sentences, test_ids, _ = load_sentences(test_file)
-        train_sentences, train_ids, train_hash = load_sentences(train_file)
+        test_sentences, test_ids = load_sentences(test_file)
+        train_sentences, train_ids = load_sentences(train_file)
 
         if not test_sentences or not train_sentences:
             print(f"Skipping {onto} due to missing data")
             return
 
-        # Set up cache paths
-        output_dir = os.path.dirname(output_file)
-        current_cache_dir = os.path.join(output_dir, 'cache')
-        os.makedirs(current_cache_dir, exist_ok=True)
-
-        # Check regular config cache directory if available
-        potential_sources = [current_cache_dir]
-
-        # Generate cache filename components
-        safe_model_name = model_name.replace('/', '_')
-        cache_filename = f"{onto}__{safe_model_name}__{train_hash}.pt"
-        current_cache_path = os.path.join(current_cache_dir, cache_filename)
-
-        # Look for existing caches in potential locations
-        existing_caches = []
-        for source_dir in potential_sources:
-            candidate = os.path.join(source_dir, cache_filename)
-            if os.path.exists(candidate):
-                existing_caches.append(candidate)
-                print(f"Found valid cache in: {candidate}")
-
-        # Copy cache from regular config if available
-        if existing_caches:
-            best_source = existing_caches[0]
-            if best_source != current_cache_path:
-                print(f"\nCopying shared cache from: {best_source}")
-                try:
-                    shutil.copyfile(best_source, current_cache_path)
-                    print(f"Successfully copied cache to: {current_cache_path}")
-                except Exception as e:
-                    print(f"Cache copy failed: {str(e)}")
-                    existing_caches = []  # Force recompute if copy failed
-
-        # Cleanup old caches in current directory
-        cache_pattern = os.path.join(current_cache_dir, f"{onto}__{safe_model_name}__*.pt")
-        existing_cache_files = glob.glob(cache_pattern)
-        for file_path in existing_cache_files:
-            if file_path != current_cache_path:
-                try:
-                    os.remove(file_path)
-                    print(f"Removed outdated cache: {os.path.basename(file_path)}")
-                except Exception as e:
-                    print(f"Failed to remove old cache: {str(e)}")
-
-        # Load or compute embeddings
-        train_embeddings = None
-        if os.path.exists(current_cache_path):
-            print(f"\nLoading cached embeddings from: {current_cache_path}")
-            try:
-                cache_data = torch.load(current_cache_path)
-                train_embeddings = cache_data['train_embeddings']
-                device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-                train_embeddings = train_embeddings.to(device)
-                print(f"Successfully loaded cached embeddings (shape: {train_embeddings.shape})")
-            except Exception as e:
-                print(f"Error loading cache file: {str(e)}")
-                train_embeddings = None
-
-        if train_embeddings is None:
-            print('\nComputing fresh embeddings for train sentences...')
-            train_embeddings = model.encode(train_sentences, convert_to_tensor=True, show_progress_bar=True)
-            try:
-                torch.save({'train_embeddings': train_embeddings}, current_cache_path)
-                print(f"\nSaved new cache to: {current_cache_path}")
-            except Exception as e:
-                print(f"Error saving cache file: {str(e)}")
-
-        # Compute test embeddings and similarities
-        print('\nComputing embeddings for test sentences...')
-        test_embeddings = model.encode(test_sentences, convert_to_tensor=True, show_progress_bar=True)
+        # Only sentences that are not in the shared embedding store are encoded
+        def encode(sentences: List[str]) -> np.ndarray:
+            return encode_sentences(model, sentences,
+                                    max_batch_tokens=config.get('encode_batch_tokens', 16384),
+                                    num_threads=config.get('encode_threads', 1))
+
+        print('\nLoading embeddings for train sentences...')
+        load_start = time.time()
+        train_embeddings, train_scales = store.get_or_encode_quantized(train_sentences, encode)
+        print(f"Train embeddings ({store.dtype}) loaded in {time.time() - load_start:.2f}s, "
+              f"store size {store.size_bytes() / 2**20:.1f} MB")
+        print('\nLoading embeddings for test sentences...')
+        test_embeddings = store.get_or_encode(test_sentences, encode)
+
+        if example_db is not None:
+            example_index = config['example_index']
+            ingest_train_embeddings(
+                example_db,
+                example_index.get('table', '$$onto$$_train').replace('$$onto$$', onto),
+                train_ids,
+                train_sentences,
+                dequantize_embeddings(train_embeddings, train_scales),
+                min_index_rows=example_index.get('min_index_rows', 4096)
+            )
+
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        top_k = config.get('top_k', 5)
+        max_block_mb = config.get('similarity_block_mb', 256)
 
         # Compute similarities
         similarity_results = compute_similarities(
-            test_embeddings=test_embeddings,
-            train_embeddings=train_embeddings,
+            test_embeddings=torch.from_numpy(test_embeddings).to(device),
+            train_embeddings=torch.from_numpy(train_embeddings),
             test_ids=test_ids,
             train_ids=train_ids,
-            top_k=config.get('top_k', 5)
+            top_k=top_k,
+            max_block_mb=max_block_mb,
+            train_scales=torch.from_numpy(train_scales) if train_scales is not None else None
         )
 
+        if reference_store is not None and similarity_results:
+            print('\nComputing float32 similarities for the agreement report...')
+            reference_results = compute_similarities(
+                test_embeddings=torch.from_numpy(reference_store.get_or_encode(test_sentences, encode)).to(device),
+                train_embeddings=torch.from_numpy(reference_store.get_or_encode(train_sentences, encode)).to(device),
+                test_ids=test_ids,
+                train_ids=train_ids,
+                top_k=top_k,
+                max_block_mb=max_block_mb
+            )
+            overlap, identical = get_top_k_agreement(similarity_results, reference_results)
+            print(f"Top-{top_k} agreement of {store.dtype} with float32 for {onto}: "
+                  f"{overlap:.2%} overlap, {identical:.2%} identical lists")
+
         if similarity_results:
-            # Ensure output directory exists
-            os.makedirs(os.path.dirname(output_file), exist_ok=True)
             # Save results
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(similarity_results, f, indent=4)
+            save_similarity_results(similarity_results, output_file, config.get('sent_sim_format', 'json'))
             print(f'\n{"-"*40}\nResults saved to {output_file}\n{"-"*40}')
 
     except Exception as e:
@@ -167,6 +283,8 @@ def process_ontology(onto: str,
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config_path', required=True, help='Path to config file')
+    parser.add_argument('--report_agreement', action='store_true',
+                        help='Report the top-k agreement of a quantized embedding store with float32')
     args = parser.parse_args()
 
     # Load config
@@ -178,10 +296,29 @@ def main():
         # Initialize model
         model_name = config.get('model_name', 'sentence-t5-xxl')
         model = SentenceTransformer(model_name)
+        cache_dir = config.get('embedding_cache_dir', DEFAULT_CACHE_DIR)
+        max_rows = config.get('embedding_cache_max_rows', 1_000_000)
+        store = EmbeddingStore(
+            model_name,
+            cache_dir=cache_dir,
+            max_rows=max_rows,
+            dtype=config.get('embedding_dtype', 'float32')
+        )
+        reference_store = None
+        if args.report_agreement and store.dtype != 'float32':
+            reference_store = EmbeddingStore(model_name, cache_dir=cache_dir, max_rows=max_rows)
+        example_db = None
+        if 'example_index' in config:
+            example_db = LanceDB(config['example_index']['db_path'])
 
         # Process each ontology
-        for onto in config['onto_list']:
-            process_ontology(onto, config, model, model_name)
+        try:
+            for onto in config['onto_list']:
+                process_ontology(onto, config, model, store, reference_store, example_db)
+        finally:
+            store.close()
+            if reference_store is not None:
+                reference_store.close()
 
     except Exception as e:
         print(f"Error in main execution: {str(e)}")
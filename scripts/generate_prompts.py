@@ -1,13 +1,145 @@
 import argparse
+import os
+from typing import Dict, Iterator, List, Optional, Tuple
 
-from kgbench.ontology import get_file_paths
+from kgbench.corpus import TrainCorpus, load_train_corpus
+from kgbench.ontology import CompiledOntology, get_file_paths
 from kgbench.prompts import (
     get_similar_sentences,
     get_train_sentence,
+    load_similarity_index,
+    prepare_packed_prompt,
     prepare_prompt,
     write_prompts,
 )
-from kgbench.utils.io import read_json
+from kgbench.utils.db import LanceDB
+from kgbench.utils.embeddings import DEFAULT_CACHE_DIR, EmbeddingStore
+from kgbench.utils.io import iter_jsonl, read_json
+
+
+def get_index_similarity(
+    test_file: str,
+    example_db: LanceDB,
+    table_name: str,
+    embedding_store: EmbeddingStore,
+    top_k: int = 5,
+    nprobes: Optional[int] = None,
+    refine_factor: Optional[int] = None,
+) -> Optional[Dict[str, List[str]]]:
+    """
+    Find the most similar train sentences of each test sentence in the LanceDB example table of
+    an ontology. The test embeddings are read from the embedding store filled by the similarity
+    baseline, so no model is loaded; test sentences without an embedding get no examples.
+    :return: the similar train ids indexed by test sentence id, None if the search failed
+    """
+    try:
+        test_sentences = list(iter_jsonl(test_file))
+        test_embeddings, missing = embedding_store.lookup([sent["sent"] for sent in test_sentences])
+        if missing:
+            print(f"{len(missing)} test sentences have no embedding in {embedding_store.store_dir}")
+        missing = set(missing)
+        found = [i for i in range(len(test_sentences)) if i not in missing]
+        if not found:
+            return None
+
+        similar_ids, _ = example_db.search_many(
+            table_name, test_embeddings[found], top_k=top_k, nprobes=nprobes, refine_factor=refine_factor
+        )
+        return {
+            test_sentences[i]["id"]: [train_id for train_id in train_ids if train_id is not None]
+            for i, train_ids in zip(found, similar_ids)
+        }
+    except Exception as e:
+        print(f"Error searching examples in {table_name}: {str(e)}")
+        return None
+
+
+def iter_ontology_examples(
+    test_file: str,
+    test_train_similarity: Dict[str, List[str]],
+    train_sentences: TrainCorpus,
+) -> Iterator[Tuple[str, str, dict]]:
+    """Stream the test sentences of an ontology and yield each test id and sentence with its example"""
+    # iterate through all test sentences while generating prompts
+    for test_sentence in iter_jsonl(test_file):
+        test_sentence_id = test_sentence['id']
+        # test sentence for which the prompt to be generated
+        test_text = test_sentence['sent']
+
+        # get the similar train sentences for the test sentence
+        similar_sents = get_similar_sentences(test_sentence_id, test_train_similarity)
+        if not similar_sents:
+            continue
+        # we retrieve by default the first similar sentence from the list of similar sentences
+        # we get the train sentence from the train sentences list and from there we process each field sub_label, obj_label, rel_label
+        train_sent = get_train_sentence(similar_sents[0], train_sentences)
+        yield test_sentence_id, test_text, train_sent
+
+
+def iter_ontology_prompts(
+    test_file: str,
+    ontology: CompiledOntology,
+    test_train_similarity: Dict[str, List[str]],
+    train_sentences: TrainCorpus,
+) -> Iterator[dict]:
+    """Stream the test sentences of an ontology and yield the prompt of each test sentence"""
+    for test_sentence_id, test_text, train_sent in iter_ontology_examples(
+        test_file, test_train_similarity, train_sentences
+    ):
+        # prompt generation logic
+        prompt = prepare_prompt(ontology, test_text, train_sent)
+        yield {"id": test_sentence_id, "prompt": prompt}
+
+
+def iter_packed_prompts(
+    test_file: str,
+    ontology: CompiledOntology,
+    test_train_similarity: Dict[str, List[str]],
+    train_sentences: TrainCorpus,
+    pack_size: int,
+    token_counts: Dict[str, int],
+) -> Iterator[dict]:
+    """
+    Stream the test sentences of an ontology and yield prompts of pack_size test sentences
+    under one ontology header. A packed prompt lists the ids of its test sentences in "ids",
+    its id joins them with "+".
+    :param token_counts: updated with the "single" and "packed" prompt tokens (whitespace
+        separated, like the response metrics) to report the reduction
+    """
+    def pack_prompt(pack: List[Tuple[str, str, dict]]) -> dict:
+        prompt = prepare_packed_prompt(ontology, [(test_text, train_sent) for _, test_text, train_sent in pack])
+        token_counts["packed"] += len(prompt.split()) if prompt else 0
+        ids = [test_sentence_id for test_sentence_id, _, _ in pack]
+        return {"id": "+".join(ids), "ids": ids, "prompt": prompt}
+
+    pack = []
+    for test_sentence_id, test_text, train_sent in iter_ontology_examples(
+        test_file, test_train_similarity, train_sentences
+    ):
+        if not train_sent:
+            continue
+        # the prompt that would be sent without packing
+        prompt = prepare_prompt(ontology, test_text, train_sent)
+        token_counts["single"] += len(prompt.split()) if prompt else 0
+        pack.append((test_sentence_id, test_text, train_sent))
+        if len(pack) == pack_size:
+            yield pack_prompt(pack)
+            pack = []
+    if pack:
+        yield pack_prompt(pack)
+
+
+def get_packed_prompt_file(prompt_file: str, pack_size: int) -> str:
+    """The packed prompts are written next to the prompt file, e.g. ont_1_movie_prompts_pack8.jsonl"""
+    root, ext = os.path.splitext(prompt_file)
+    return f"{root}_pack{pack_size}{ext}"
+
+
+def print_token_reduction(token_counts: Dict[str, int], name: str) -> None:
+    reduction = 1 - token_counts["packed"] / token_counts["single"] if token_counts["single"] else 0.0
+    print(f"Prompt tokens of {name}: {token_counts['single']} single, {token_counts['packed']} packed "
+          f"({reduction:.1%} reduction)")
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -16,6 +148,12 @@ if __name__ == "__main__":
         required=True,
         help="Path to prompt generation config file",
     )
+    parser.add_argument(
+        "--pack_size",
+        type=int,
+        default=None,
+        help="Number of test sentences per packed prompt, overrides pack_size of the config",
+    )
     args = parser.parse_args()
 
     # load the prompt generation configuration with details of files needed for prompt generation
@@ -23,54 +161,83 @@ if __name__ == "__main__":
     # file, training sentences file, test-train sentence similarity file, and the output file.
     gen_config = read_json(args.config_path)
     file_paths = get_file_paths(gen_config)
+    # with a pack size above 1, several test sentences share one prompt
+    pack_size = args.pack_size or gen_config.get("pack_size", 1)
+    total_token_counts = {"single": 0, "packed": 0}
+
+    # the examples can be searched in LanceDB tables of train embeddings instead of the similarity files
+    example_index = gen_config.get("example_index")
+    if example_index:
+        example_db = LanceDB(example_index["db_path"])
+        embedding_store = EmbeddingStore(
+            gen_config.get("model_name", "sentence-t5-xxl"),
+            cache_dir=gen_config.get("embedding_cache_dir", DEFAULT_CACHE_DIR),
+            dtype=gen_config.get("embedding_dtype", "float32"),
+        )
 
     # for each of the ontology, we load the corresponding files and generate the prompts for each test sentence
     for onto in gen_config["onto_list"]:
         print(f"\nProcessing ontology: {onto}")
         paths = file_paths[onto]
 
-        # load the ontology which has the concepts and relations (with domain / range constraints)
-        ontology = read_json(paths["ontology_file"])
+        # load the ontology which has the concepts and relations (with domain / range constraints). It is
+        # compiled once, so the ontology header is shared by all prompts of the ontology.
+        ontology = CompiledOntology.from_file(paths["ontology_file"])
 
         # In the prompt, for each test sentence, we are using the most similar train sentence as the example for
         # in-context learning. This files contains pre-calculated similarities for each test sentence using a T5XXL
-        # SBERT model.
-        test_train_similarity = read_json(paths["test_train_similarity_file"])
-        # load the list of train sentences. We use the train sentences with aligned triples to find the examples to
+        # SBERT model. The similarities are indexed by test sentence id. With an example index, they are
+        # searched in the LanceDB table of the ontology instead.
+        if example_index:
+            test_train_similarity = get_index_similarity(
+                paths["test_file"],
+                example_db,
+                example_index.get("table", "$$onto$$_train").replace("$$onto$$", onto),
+                embedding_store,
+                top_k=gen_config.get("top_k", 5),
+                nprobes=example_index.get("nprobes"),
+                refine_factor=example_index.get("refine_factor"),
+            )
+        else:
+            test_train_similarity = load_similarity_index(paths["test_train_similarity_file"])
+        # index the train sentences by id. We use the train sentences with aligned triples to find the examples to
         # include in the prompt.
-        train_sentences = read_json(paths["train_file"])
-        # load the list of test sentences for which we need to generate the prompts.
-        test_sentences = read_json(paths["test_file"])
+        train_sentences = load_train_corpus(paths["train_file"])
+        # the test sentences for which we need to generate the prompts are streamed from the test file.
+        test_file_exists = os.path.exists(paths["test_file"])
 
-        if not all([test_train_similarity, train_sentences, test_sentences, ontology]):
+        if not all([test_train_similarity, train_sentences, test_file_exists, ontology]):
             print(f"Skipping {onto} due to missing files")
+            if train_sentences is not None:
+                train_sentences.close()
             continue
 
         try:
-            prompts_json = []
-
-            # iterate through all test sentences while generating prompts
-            for test_sentence in test_sentences:
-                test_sentence_id = test_sentence['id']
-                # test sentence for which the prompt to be generated
-                test_text = test_sentence['sent']
-
-                # get the similar train sentences for the test sentence
-                similar_sents = get_similar_sentences(test_sentence_id, test_train_similarity)
-                if not similar_sents:
-                    continue
-                # we retrieve by default the first similar sentence from the list of similar sentences
-                # we get the train sentence from the train sentences list and from there we process each field sub_label, obj_label, rel_label
-                train_sent = get_train_sentence(similar_sents[0], train_sentences)
-
-                # prompt generation logic
-                prompt = prepare_prompt(ontology, test_text, train_sent)
-                prompt_data = {"id": test_sentence_id, "prompt": prompt}
-                prompts_json.append(prompt_data)
-
-            write_prompts(prompts_json, paths["prompt_file"])
-            print(f"Generated {len(prompts_json)} prompts for {onto}")
+            if pack_size > 1:
+                token_counts = {"single": 0, "packed": 0}
+                prompts = iter_packed_prompts(
+                    paths["test_file"], ontology, test_train_similarity, train_sentences, pack_size, token_counts
+                )
+                num_prompts = write_prompts(
+                    prompts, gen_config["path_patterns"].get("packed_prompt", "").replace("$$onto$$", onto)
+                    or get_packed_prompt_file(paths["prompt_file"], pack_size)
+                )
+                print(f"Generated {num_prompts} packed prompts for {onto}")
+                print_token_reduction(token_counts, onto)
+                for name in total_token_counts:
+                    total_token_counts[name] += token_counts[name]
+            else:
+                prompts = iter_ontology_prompts(
+                    paths["test_file"], ontology, test_train_similarity, train_sentences
+                )
+                num_prompts = write_prompts(prompts, paths["prompt_file"])
+                print(f"Generated {num_prompts} prompts for {onto}")
 
         except Exception as e:
             print(f"Error processing ontology {onto}: {str(e)}")
             continue
+        finally:
+            train_sentences.close()
+
+    if pack_size > 1:
+        print_token_reduction(total_token_counts, "all ontologies")
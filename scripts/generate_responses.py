@@ -1,10 +1,406 @@
 import argparse
-import json
+import asyncio
 from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
 
-from kgbench.prompts import parse_triples
-from kgbench.utils.io import read_json
-from kgbench.utils.llm import download_ollama_model, get_llm_response
+from kgbench.grammar import build_response_format, build_triples_schema
+from kgbench.ontology import CompiledOntology
+from kgbench.prompts import get_prompt_prefix_key, schedule_prompts
+from kgbench.triples import (
+    parse_responses_file,
+    parse_structured_response,
+    parse_triples,
+    split_packed_response,
+)
+from kgbench.utils.cache import ResponseCache
+from kgbench.utils.io import (
+    JsonlWriter,
+    iter_jsonl,
+    read_json,
+    read_jsonl_records,
+    save_jsonl,
+)
+from kgbench.utils.llm import (
+    download_ollama_model,
+    get_llm_response,
+    get_llm_response_async,
+    supports_response_schema,
+)
+from kgbench.utils.ratelimit import RateController, get_rate_controller
+
+RESPONSE_FORMATS = ("text", "json_schema", "compare")
+SCHEDULES = ("file", "prefix")
+
+
+def get_concurrency(model_config: dict) -> int:
+    """
+    Resolve the number of in-flight requests allowed for the configured provider.
+    :param model_config: the model configuration; "concurrency" is either an int or a
+        dictionary keyed by provider name, e.g. {"ollama": 2, "openai": 16}
+    :return: the concurrency limit, 1 (serial) when not configured
+    """
+    concurrency = model_config.get("concurrency", 1)
+    if isinstance(concurrency, dict):
+        concurrency = concurrency.get(model_config["provider"], 1)
+    return max(1, int(concurrency))
+
+
+def get_rate_limit(model_config: dict) -> dict:
+    """
+    Resolve the rate limits of the configured provider.
+    :param model_config: the model configuration; "rate_limit" holds the arguments of
+        kgbench.utils.ratelimit.RateController, e.g. {"rpm": 500, "tpm": 30000}, either
+        directly or in a dictionary keyed by provider name
+    :return: the rate limit arguments, empty when not configured
+    """
+    rate_limit = model_config.get("rate_limit") or {}
+    if rate_limit and all(isinstance(value, dict) for value in rate_limit.values()):
+        rate_limit = rate_limit.get(model_config["provider"], {})
+    return dict(rate_limit)
+
+
+class FormatStats:
+    """
+    Output tokens, wall time and parse results of the responses of one response format, with
+    the prompt evaluation reported by the server to measure its prefix cache hits
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.responses = 0
+        self.failed_requests = 0
+        self.completion_tokens = 0
+        # responses whose provider reported no usage, their output tokens are unknown
+        self.unknown_tokens = 0
+        self.seconds = 0.0
+        self.triples = 0
+        self.responses_without_triples = 0
+        # server metrics, summed over the responses for which the server reports them
+        self.cache_reports = 0
+        self.cache_prompt_tokens = 0
+        self.cached_tokens = 0
+        self.prompt_eval_reports = 0
+        self.prompt_eval_tokens = 0
+        # Ollama reports the evaluated prompt tokens without their duration
+        self.prompt_eval_ms_reports = 0
+        self.prompt_eval_ms = 0.0
+
+    def add(self, response: dict, triples: Optional[List[List[str]]]) -> None:
+        if not response or not response.get("success"):
+            self.failed_requests += 1
+            return
+        self.responses += 1
+        metrics = response.get("metrics") or {}
+        if metrics.get("completion_tokens") is None:
+            self.unknown_tokens += 1
+        else:
+            self.completion_tokens += metrics["completion_tokens"]
+        self.seconds += metrics.get("total_time_seconds") or 0.0
+        self.triples += len(triples or [])
+        self.responses_without_triples += not triples
+
+        server = metrics.get("server") or {}
+        if server.get("cached_tokens") is not None and server.get("prompt_tokens") is not None:
+            self.cache_reports += 1
+            self.cache_prompt_tokens += server["prompt_tokens"]
+            self.cached_tokens += server["cached_tokens"]
+        if server.get("prompt_eval_count") is not None:
+            self.prompt_eval_reports += 1
+            self.prompt_eval_tokens += server["prompt_eval_count"]
+        if server.get("prompt_eval_ms") is not None:
+            self.prompt_eval_ms_reports += 1
+            self.prompt_eval_ms += server["prompt_eval_ms"]
+
+    def update(self, other: "FormatStats") -> None:
+        for name, value in vars(other).items():
+            if name != "name":
+                setattr(self, name, getattr(self, name) + value)
+
+    def print_stats(self, name: str) -> None:
+        if not self.responses:
+            print(f"{self.name} responses of {name}: none, {self.failed_requests} failed requests")
+            return
+        known = self.responses - self.unknown_tokens
+        tokens = f"{self.completion_tokens / known:.1f}" if known else "unknown"
+        print(
+            f"{self.name} responses of {name}: {self.responses} responses, "
+            f"{tokens} output tokens/response, {self.seconds / self.responses:.2f}s/response, "
+            f"{self.seconds:.1f}s in total, {self.triples} triples, "
+            f"{self.responses_without_triples} responses without triples, "
+            f"{self.failed_requests} failed requests"
+        )
+        if self.cache_reports:
+            print(
+                f"  server prefix cache: {self.cached_tokens} of {self.cache_prompt_tokens} prompt tokens cached "
+                f"({self.cached_tokens / max(self.cache_prompt_tokens, 1):.2%}) over {self.cache_reports} responses"
+            )
+        if self.prompt_eval_reports:
+            eval_ms = (
+                f"{self.prompt_eval_ms / self.prompt_eval_ms_reports:.1f} ms/response, "
+                if self.prompt_eval_ms_reports
+                else ""
+            )
+            print(
+                f"  server prompt evaluation: {eval_ms}"
+                f"{self.prompt_eval_tokens / self.prompt_eval_reports:.1f} tokens evaluated/response "
+                f"over {self.prompt_eval_reports} responses"
+            )
+
+
+def get_response_format(model_config: dict, onto_file: str) -> Optional[dict]:
+    """
+    Build the JSON schema response_format of an ontology, None if the provider does not
+    support JSON schemas or the ontology could not be loaded, the free text format is used then.
+    """
+    if not supports_response_schema(model_config["provider"], model_config["tag"]):
+        print(f"Provider {model_config['provider']} does not support JSON schemas for {model_config['tag']}, "
+              f"using the free text format.")
+        return None
+    ontology = CompiledOntology.from_file(onto_file)
+    if ontology is None:
+        return None
+    try:
+        return build_response_format(build_triples_schema(ontology))
+    except ValueError as e:
+        print(f"Error building the response schema: {str(e)}")
+        return None
+
+
+def build_response_record(prompt_id: str, response: dict, structured: bool = False) -> Optional[dict]:
+    """
+    Build the output record for a prompt, None if the response failed
+    :param structured: whether the response was generated with the JSON schema format
+    """
+    if response and response.get("success"):
+        if structured:
+            triples = parse_structured_response(response["response"]).triples
+        else:
+            triples = parse_triples(response["response"])
+        print(f"Prompt {prompt_id} processed successfully.")
+        return {
+            "id": prompt_id,
+            "response": response,
+            "triples": triples,
+        }
+    print(f"Failed to generate response for prompt {prompt_id}.")
+    return None
+
+
+def build_response_records(prompt_data: dict, response: dict, structured: bool = False) -> List[dict]:
+    """
+    Build the output records of a prompt, empty if the response failed. The response to a
+    packed prompt is split into one record per test sentence, each with its part of the
+    response text and the id of the packed prompt.
+    """
+    if "ids" not in prompt_data:
+        record = build_response_record(prompt_data["id"], response, structured)
+        return [record] if record else []
+    if not response or not response.get("success"):
+        print(f"Failed to generate response for prompt {prompt_data['id']}.")
+        return []
+
+    records = []
+    parts = split_packed_response(response["response"], len(prompt_data["ids"]))
+    for test_id, part in zip(prompt_data["ids"], parts):
+        records.append({
+            "id": test_id,
+            "response": {**response, "response": part, "packed_id": prompt_data["id"]},
+            "triples": parse_triples(part),
+        })
+    print(f"Prompt {prompt_data['id']} processed successfully, "
+          f"{sum(1 for part in parts if not part)} of {len(parts)} sentences without a response.")
+    return records
+
+
+def update_stats(
+    stats: Optional[Dict[str, FormatStats]],
+    response_format: str,
+    response: dict,
+    records: Optional[List[dict]] = None,
+) -> None:
+    """Add a response to the stats of its format, the free text triples are parsed here"""
+    if stats is None or response_format not in stats:
+        return
+    if records:
+        triples = [triple for record in records for triple in record["triples"]]
+    elif response and response.get("success"):
+        triples = parse_triples(response["response"])
+    else:
+        triples = None
+    stats[response_format].add(response, triples)
+
+
+def generate_serial(
+    prompts: Iterable[dict],
+    model_config: dict,
+    on_record: Callable[[dict], None],
+    cache: Optional[ResponseCache] = None,
+    response_format: Optional[dict] = None,
+    stats: Optional[Dict[str, FormatStats]] = None,
+    rate_controller: Optional[RateController] = None,
+) -> List[dict]:
+    """
+    Send the prompts one at a time and collect the responses in prompt order.
+    on_record is called with each successful record as soon as it arrives.
+    With a response_format, the responses are generated as JSON; the stats of each format
+    are updated when given, and a "text" entry also generates the free text response of
+    each prompt for comparison. With a rate_controller, the requests are kept under its
+    budgets and retried after rate limit and server errors.
+    """
+    responses = []
+    for prompt_data in prompts:
+        prompt_id = prompt_data.get("id")
+        prompt_text = prompt_data.get("prompt")
+        if not prompt_id or not prompt_text:
+            continue
+
+        print(f"Processing prompt {prompt_id}")
+
+        # packed responses are split by their "Sentence <number>:" lines, so they stay in free text
+        prompt_format = None if "ids" in prompt_data else response_format
+        if stats and prompt_format is not None and "text" in stats:
+            free_text = get_llm_response(
+                prompt_text,
+                model_config["tag"],
+                model_config["temperature"],
+                model_config["provider"],
+                model_config["base_url"],
+                model_config["api_key"],
+                max_tokens=model_config.get("max_tokens"),
+                cache=cache,
+                rate_controller=rate_controller,
+            )
+            update_stats(stats, "text", free_text)
+
+        response = get_llm_response(
+            prompt_text,
+            model_config["tag"],
+            model_config["temperature"],
+            model_config["provider"],
+            model_config["base_url"],
+            model_config["api_key"],
+            max_tokens=model_config.get("max_tokens"),
+            cache=cache,
+            response_format=prompt_format,
+            rate_controller=rate_controller,
+        )
+        records = build_response_records(prompt_data, response, prompt_format is not None)
+        update_stats(stats, "text" if prompt_format is None else "json_schema", response, records)
+        for record in records:
+            on_record(record)
+            responses.append(record)
+    return responses
+
+
+async def generate_async(
+    prompts: Iterable[dict],
+    model_config: dict,
+    concurrency: int,
+    on_record: Callable[[dict], None],
+    cache: Optional[ResponseCache] = None,
+    response_format: Optional[dict] = None,
+    stats: Optional[Dict[str, FormatStats]] = None,
+    warm_prefixes: bool = False,
+    rate_controller: Optional[RateController] = None,
+) -> List[dict]:
+    """
+    Send the prompts concurrently with at most `concurrency` requests in flight.
+    The prompts are pulled lazily by `concurrency` workers, so a streamed prompt file
+    is never fully loaded. on_record is called with each successful record in
+    completion order, while the returned responses are in prompt order, so the output
+    file is identical to the one written by generate_serial.
+    With warm_prefixes, the prompts sharing an ontology header and example wait for the
+    first of them to complete, so the server evaluates the shared prefix once and the
+    others hit its prefix cache.
+    With a rate_controller, the number of requests in flight adapts to the rate limit
+    responses of the provider, up to `concurrency`.
+    """
+    records = {}
+    # the workers share one iterator, next() is never interleaved within the event loop
+    prompt_iter = enumerate(prompts)
+    # prefix -> set once the first request with this prefix is done
+    warmed_prefixes: Dict[tuple, asyncio.Event] = {}
+
+    async def generate_one(index: int, prompt_data: dict) -> None:
+        prompt_id = prompt_data.get("id")
+        prompt_text = prompt_data.get("prompt")
+
+        print(f"Processing prompt {prompt_id}")
+        # packed responses are split by their "Sentence <number>:" lines, so they stay in free text
+        prompt_format = None if "ids" in prompt_data else response_format
+        if stats and prompt_format is not None and "text" in stats:
+            free_text = await get_llm_response_async(
+                prompt_text,
+                model_config["tag"],
+                model_config["temperature"],
+                model_config["provider"],
+                model_config["base_url"],
+                model_config["api_key"],
+                max_tokens=model_config.get("max_tokens"),
+                cache=cache,
+                rate_controller=rate_controller,
+            )
+            update_stats(stats, "text", free_text)
+
+        response = await get_llm_response_async(
+            prompt_text,
+            model_config["tag"],
+            model_config["temperature"],
+            model_config["provider"],
+            model_config["base_url"],
+            model_config["api_key"],
+            max_tokens=model_config.get("max_tokens"),
+            cache=cache,
+            response_format=prompt_format,
+            rate_controller=rate_controller,
+        )
+        prompt_records = build_response_records(prompt_data, response, prompt_format is not None)
+        update_stats(stats, "text" if prompt_format is None else "json_schema", response, prompt_records)
+        for record in prompt_records:
+            on_record(record)
+        if prompt_records:
+            records[index] = prompt_records
+
+    async def worker() -> None:
+        for index, prompt_data in prompt_iter:
+            prompt_id = prompt_data.get("id")
+            prompt_text = prompt_data.get("prompt")
+            if not prompt_id or not prompt_text:
+                continue
+
+            # wait for the first request with the same header, then with the same example
+            warm_events = []
+            if warm_prefixes:
+                header, example = get_prompt_prefix_key(prompt_text)
+                for prefix in [(header,), (header, example)]:
+                    if prefix in warmed_prefixes:
+                        await warmed_prefixes[prefix].wait()
+                    else:
+                        warmed_prefixes[prefix] = asyncio.Event()
+                        warm_events.append(warmed_prefixes[prefix])
+            try:
+                await generate_one(index, prompt_data)
+            finally:
+                for event in warm_events:
+                    event.set()
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return [record for index in sorted(records) for record in records[index]]
+
+
+def load_checkpoint(output_file: Path) -> Dict[str, dict]:
+    """
+    Load the responses already written to an output file by a previous (possibly
+    interrupted) run. Only successful responses are written, so failed or missing
+    ids are retried.
+    :param output_file: the responses file of an ontology
+    :return: a dictionary from prompt id to response record
+    """
+    completed = {}
+    for record in read_jsonl_records(str(output_file)):
+        if record.get("id") and record.get("response"):
+            completed[record["id"]] = record
+    return completed
 
 
 def main():
@@ -16,19 +412,78 @@ def main():
         required=True,
         help="Path to prompt generation config file",
     )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="Maximum number of in-flight requests, overrides model_config.concurrency",
+    )
+    parser.add_argument(
+        "--no_resume",
+        action="store_true",
+        help="Ignore existing responses and regenerate all prompts",
+    )
+    parser.add_argument(
+        "--cache_path",
+        default=None,
+        help="Path to a SQLite response cache consulted before calling the model",
+    )
+    parser.add_argument(
+        "--cache_max_entries",
+        type=int,
+        default=100_000,
+        help="Maximum number of cached responses before LRU eviction",
+    )
+    parser.add_argument(
+        "--response_format",
+        choices=RESPONSE_FORMATS,
+        default=None,
+        help="text, json_schema (JSON constrained by the ontology relations) or compare "
+        "(json_schema responses, with free text responses generated for the stats), "
+        "overrides model_config.response_format",
+    )
+    parser.add_argument(
+        "--schedule",
+        choices=SCHEDULES,
+        default=None,
+        help="file (prompt file order, the default) or prefix (grouped by ontology header and "
+        "example for the server prefix cache), overrides model_config.schedule",
+    )
     args = parser.parse_args()
     config = read_json(args.config_path)
 
     # Model configuration
-    model_tag = config["model_config"]["tag"]
-    temperature = config["model_config"]["temperature"]
-    provider = config["model_config"]["provider"]
-    base_url = config["model_config"]["base_url"]
-    api_key = config["model_config"]["api_key"]
+    model_config = config["model_config"]
+    concurrency = args.concurrency or get_concurrency(model_config)
+    response_format_name = args.response_format or model_config.get("response_format", "text")
+    if response_format_name not in RESPONSE_FORMATS:
+        print(f"Unsupported response format {response_format_name}, expected one of {RESPONSE_FORMATS}")
+        return
+    run_stats = {name: FormatStats(name) for name in ("text", "json_schema")}
+    # prefix scheduling reorders the requests and holds back the first request of each
+    # group, so it is opt-in
+    schedule = args.schedule or model_config.get("schedule", "file")
+    if schedule not in SCHEDULES:
+        print(f"Unsupported schedule {schedule}, expected one of {SCHEDULES}")
+        return
+    # requests per minute, tokens per minute and retries of the provider and model, shared
+    # by all ontologies
+    try:
+        rate_controller = get_rate_controller(
+            model_config["provider"], model_config["tag"], get_rate_limit(model_config), concurrency
+        )
+    except TypeError as e:
+        print(f"Unsupported rate_limit {model_config.get('rate_limit')}: {str(e)}")
+        return
+    cache = (
+        ResponseCache(args.cache_path, args.cache_max_entries)
+        if args.cache_path
+        else None
+    )
 
     # Download model
-    if provider == "ollama":
-        download_ollama_model(model_tag)
+    if model_config["provider"] == "ollama":
+        download_ollama_model(model_config["tag"])
 
     # Process prompts for each ontology
     for onto in config["onto_list"]:
@@ -40,55 +495,109 @@ def main():
         else:
             print(f"\nProcessing ontology: {onto}")
 
-        try:
-            with open(prompt_file, "r", encoding="utf-8") as f:
-                prompts = [json.loads(line.strip()) for line in f if line.strip()]
-        except Exception as e:
-            print(f"Error reading prompt file {prompt_file}: {str(e)}")
-            continue
+        output_file = Path(config["path_patterns"]["sys"].replace("$$onto$$", onto))
 
-        responses = []
-        for prompt_data in prompts:
-            prompt_id = prompt_data.get("id")
-            prompt_text = prompt_data.get("prompt")
-            if not prompt_id or not prompt_text:
-                continue
+        # the JSON schema of the responses allows the relations of the ontology only
+        response_format = None
+        if response_format_name != "text":
+            response_format = get_response_format(
+                model_config, config["path_patterns"]["onto"].replace("$$onto$$", onto)
+            )
+        stats = {"json_schema": FormatStats("json_schema")} if response_format else {}
+        if response_format is None or response_format_name == "compare":
+            stats["text"] = FormatStats("text")
+
+        # Resume from the responses written by a previous run, the file is compacted first
+        # to drop a line that may have been partially written when the run was interrupted
+        completed = {} if args.no_resume else load_checkpoint(output_file)
+        save_jsonl(completed.values(), str(output_file), ensure_ascii=False)
+        if completed:
+            print(f"Resuming {onto}: {len(completed)} prompts already done")
 
-            print(f"Processing prompt {prompt_id}")
+        # the prompts are streamed from the prompt file, only their ids are kept for the final ordering.
+        # The responses of packed prompts are written per test sentence, a packed prompt is sent
+        # again unless all of its test sentences are done.
+        prompt_ids = []
 
-            response = get_llm_response(
-                prompt_text, model_tag, temperature, provider, base_url, api_key
+        def iter_pending_prompts() -> Iterator[dict]:
+            for prompt_data in iter_jsonl(str(prompt_file)):
+                ids = prompt_data.get("ids") or [prompt_data.get("id")]
+                prompt_ids.extend(ids)
+                if any(p_id not in completed for p_id in ids):
+                    yield prompt_data
+
+        # the prefix schedule groups the streamed prompts in bounded windows, the output is
+        # still written in prompt file order
+        pending_prompts = iter_pending_prompts()
+        if schedule == "prefix":
+            pending_prompts = schedule_prompts(
+                pending_prompts, model_config.get("schedule_window", 1024)
             )
-            if response:
-                triples = parse_triples(response["response"])
-                responses.append(
-                    {
-                        "id": prompt_id,
-                        "response": response,
-                        "triples": triples,
-                    }
-                )
-                print(f"Prompt {prompt_id} processed successfully.")
-            else:
-                print(f"Failed to generate response for prompt {prompt_id}.")
-
-        # Write responses to file
-        output_file = Path(config["path_patterns"]["sys"].replace("$$onto$$", onto))
 
-        # Create output directory if it doesn't exist
-        output_file.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            # append each response durably as soon as it arrives
+            with JsonlWriter(
+                str(output_file), mode="a", ensure_ascii=False, durable=True
+            ) as checkpoint_writer:
+
+                def checkpoint(record: dict) -> None:
+                    completed[record["id"]] = record
+                    checkpoint_writer.write(record)
+
+                if concurrency > 1:
+                    asyncio.run(
+                        generate_async(
+                            pending_prompts,
+                            model_config,
+                            concurrency,
+                            checkpoint,
+                            cache,
+                            response_format,
+                            stats,
+                            warm_prefixes=schedule == "prefix",
+                            rate_controller=rate_controller,
+                        )
+                    )
+                else:
+                    generate_serial(
+                        pending_prompts,
+                        model_config,
+                        checkpoint,
+                        cache,
+                        response_format,
+                        stats,
+                        rate_controller,
+                    )
+        except Exception as e:
+            print(f"Error processing prompt file {prompt_file}: {str(e)}")
+            continue
 
-        # Write responses to file
+        # Rewrite the responses once in prompt order
+        responses = (completed[p_id] for p_id in prompt_ids if p_id in completed)
         try:
-            with open(output_file, "w", encoding="utf-8") as f:
-                for response_data in responses:
-                    json_line = json.dumps(response_data, ensure_ascii=False)
-                    f.write(json_line + "\n")
+            save_jsonl(responses, str(output_file), ensure_ascii=False)
             print(f"Successfully wrote responses to {output_file}")
         except Exception as e:
             print(f"Error writing responses: {str(e)}")
             continue
 
+        # responses without triples silently lower the recall, report them per ontology
+        _, parse_stats = parse_responses_file(str(output_file))
+        parse_stats.print_stats(onto)
+        for name, format_stats in stats.items():
+            format_stats.print_stats(onto)
+            run_stats[name].update(format_stats)
+
+    # output tokens and wall time of the run per response format
+    for format_stats in run_stats.values():
+        if format_stats.responses or format_stats.failed_requests:
+            format_stats.print_stats("the run")
+    rate_controller.print_stats(f"{model_config['provider']}/{model_config['tag']}")
+
+    if cache is not None:
+        cache.print_stats()
+        cache.close()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,484 @@
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from kgbench.triples import get_response_text
+from kgbench.utils.io import iter_jsonl, read_json
+
+LATENCY_DISTRIBUTIONS = ("const", "uniform", "normal", "lognormal", "exp")
+ON_MISS = ("error", "empty")
+
+# words with their leading whitespace, a rough stand-in for the tokens of the model
+_token_re = re.compile(r"\s*\S+|\s+")
+
+
+def get_prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+
+def split_tokens(text: str) -> List[str]:
+    return _token_re.findall(text)
+
+
+class LatencyDistribution:
+    """
+    Latency in seconds drawn from a distribution given as "<name>:<parameters>":
+    const:<seconds>, uniform:<min>,<max>, normal:<mean>,<std>, lognormal:<mu>,<sigma>
+    (of the log of the seconds) or exp:<mean>. Negative samples are clipped to 0.
+    """
+
+    def __init__(self, spec: str):
+        name, _, params = spec.partition(":")
+        if name not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unsupported latency distribution {name}, expected one of {LATENCY_DISTRIBUTIONS}")
+        self.name = name
+        self.params = [float(param) for param in params.split(",") if param.strip()]
+        expected = 1 if name in ("const", "exp") else 2
+        if len(self.params) != expected:
+            raise ValueError(f"Latency distribution {name} expects {expected} parameters, got {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        if self.name == "const":
+            latency = self.params[0]
+        elif self.name == "uniform":
+            latency = rng.uniform(*self.params)
+        elif self.name == "normal":
+            latency = rng.gauss(*self.params)
+        elif self.name == "lognormal":
+            latency = rng.lognormvariate(*self.params)
+        else:
+            latency = rng.expovariate(1 / self.params[0]) if self.params[0] > 0 else 0.0
+        return max(0.0, latency)
+
+
+class ReplayIndex:
+    """Recorded responses of the prompts of a set of ontologies, by prompt id and prompt hash"""
+
+    def __init__(self):
+        self.prompt_ids: Dict[str, str] = {}
+        self.responses: Dict[str, str] = {}
+
+    def load(self, prompt_file: str, responses_file: str) -> Tuple[int, int]:
+        """
+        Index the prompts of a prompt file and the responses of a responses file.
+        :return: the number of prompts and of responses read
+        """
+        num_prompts, num_responses = 0, 0
+        for record in iter_jsonl(prompt_file):
+            if record.get("id") and record.get("prompt"):
+                self.prompt_ids[get_prompt_hash(record["prompt"])] = record["id"]
+                num_prompts += 1
+        for record in iter_jsonl(responses_file):
+            if record.get("id"):
+                self.responses[record["id"]] = get_response_text(record)
+                num_responses += 1
+        return num_prompts, num_responses
+
+    def lookup(self, prompt: str, prompt_id: Optional[str] = None) -> Optional[str]:
+        """
+        Find the recorded response of a prompt, by its id if given, by its hash otherwise.
+        The responses of a packed prompt, whose id joins the ids of its sentences with "+",
+        are recombined into "Sentence <number>:" sections.
+        :return: the response text, None if the prompt has no recorded response
+        """
+        prompt_id = prompt_id or self.prompt_ids.get(get_prompt_hash(prompt))
+        if prompt_id is None:
+            return None
+        if prompt_id in self.responses:
+            return self.responses[prompt_id]
+        ids = prompt_id.split("+")
+        if len(ids) > 1 and all(id_ in self.responses for id_ in ids):
+            return "\n\n".join(f"Sentence {i}:\n{self.responses[id_]}" for i, id_ in enumerate(ids, 1))
+        return None
+
+
+class ReplayServer(ThreadingHTTPServer):
+    """
+    HTTP server answering Ollama and OpenAI chat completion requests with recorded responses.
+    The latency, errors and rate limit responses of each request are drawn from a random
+    generator seeded by the prompt and the number of previous requests of the same prompt,
+    so a benchmark run is reproducible whatever the order in which the requests arrive.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], index: ReplayIndex, args: argparse.Namespace):
+        super().__init__(address, ReplayHandler)
+        self.index = index
+        self.args = args
+        self.latency = LatencyDistribution(args.latency)
+        self._lock = threading.Lock()
+        self._attempts: Dict[str, int] = {}
+        self._requests: Deque[float] = deque()
+        self._tokens: Deque[Tuple[float, int]] = deque()
+        self.in_flight = 0
+        self.stats = {
+            "requests": 0,
+            "replayed": 0,
+            "misses": 0,
+            "errors": 0,
+            "rate_limited": 0,
+            "completion_tokens": 0,
+        }
+
+    def count(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            self.stats[name] += value
+
+    def get_rng(self, prompt: str) -> random.Random:
+        key = get_prompt_hash(prompt)
+        with self._lock:
+            attempt = self._attempts.get(key, 0)
+            self._attempts[key] = attempt + 1
+        return random.Random(f"{self.args.seed}:{key}:{attempt}")
+
+    def acquire(self, num_tokens: int) -> Optional[float]:
+        """
+        Admit a request under the requests/minute, tokens/minute and concurrency limits.
+        :return: None if the request is admitted, otherwise the seconds to wait before a retry
+        """
+        with self._lock:
+            now = time.time()
+            while self._requests and self._requests[0] <= now - 60:
+                self._requests.popleft()
+            while self._tokens and self._tokens[0][0] <= now - 60:
+                self._tokens.popleft()
+            if self.args.max_concurrency and self.in_flight >= self.args.max_concurrency:
+                return self.args.retry_after
+            if self.args.rpm and len(self._requests) >= self.args.rpm:
+                return self._requests[0] + 60 - now
+            if self.args.tpm and self._tokens and sum(n for _, n in self._tokens) + num_tokens > self.args.tpm:
+                return self._tokens[0][0] + 60 - now
+            self._requests.append(now)
+            self._tokens.append((now, num_tokens))
+            self.in_flight += 1
+            return None
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def print_stats(self) -> None:
+        print(
+            f"{self.stats['requests']} requests: {self.stats['replayed']} replayed, "
+            f"{self.stats['misses']} without recorded response, {self.stats['errors']} injected errors, "
+            f"{self.stats['rate_limited']} rate limited, {self.stats['completion_tokens']} tokens streamed"
+        )
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: ReplayServer
+
+    def log_message(self, format: str, *args) -> None:
+        if self.server.args.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status: int, body: dict, headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status: int, message: str, headers: Optional[Dict[str, str]] = None) -> None:
+        if self.path.startswith("/api/"):
+            body = {"error": message}
+        else:
+            body = {"error": {"message": message, "type": "replay_error", "code": status}}
+        self.send_json(status, body, headers)
+
+    def write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self) -> None:
+        if self.path == "/stats":
+            self.send_json(200, dict(self.server.stats))
+        elif self.path == "/api/tags":
+            self.send_json(200, {"models": []})
+        elif self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"object": "list", "data": []})
+        else:
+            self.send_error_json(404, f"Unknown path {self.path}")
+
+    def do_POST(self) -> None:
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            self.send_error_json(400, "Request body is not valid JSON")
+            return
+
+        if self.path == "/api/show":
+            self.send_json(200, {"model_info": {}, "details": {}, "template": ""})
+            return
+        if self.path == "/api/generate":
+            prompt = body.get("prompt") or ""
+        elif self.path in ("/api/chat", "/v1/chat/completions", "/chat/completions"):
+            prompt = get_last_user_message(body.get("messages") or [])
+        else:
+            self.send_error_json(404, f"Unknown path {self.path}")
+            return
+        self.replay(body, prompt)
+
+    def replay(self, body: dict, prompt: str) -> None:
+        server = self.server
+        args = server.args
+        server.count("requests")
+        rng = server.get_rng(prompt)
+
+        response_text = server.index.lookup(prompt, self.headers.get("X-Prompt-Id"))
+        if response_text is None:
+            server.count("misses")
+            if args.on_miss == "error":
+                self.send_error_json(404, "No recorded response for the prompt")
+                return
+            response_text = ""
+
+        prompt_tokens = len(split_tokens(prompt))
+        tokens = split_tokens(response_text)
+        if rng.random() < args.rate_limit_rate:
+            retry_after = args.retry_after
+        else:
+            retry_after = server.acquire(prompt_tokens + len(tokens))
+        if retry_after is not None:
+            server.count("rate_limited")
+            self.send_error_json(429, "Rate limit exceeded", {"Retry-After": str(max(1, math.ceil(retry_after)))})
+            return
+
+        try:
+            latency = server.latency.sample(rng)
+            if rng.random() < args.error_rate:
+                time.sleep(latency)
+                server.count("errors")
+                self.send_error_json(500, "Injected server error")
+                return
+
+            server.count("replayed")
+            server.count("completion_tokens", len(tokens))
+            if body.get("stream"):
+                self.stream_response(body, tokens, prompt_tokens, latency)
+            else:
+                generation_seconds = len(tokens) / args.tokens_per_second if args.tokens_per_second else 0.0
+                time.sleep(latency + generation_seconds)
+                self.send_json(200, self.build_response(body, response_text, prompt_tokens, len(tokens),
+                                                        latency, generation_seconds))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            server.release()
+
+    def build_response(self, body: dict, content: str, prompt_tokens: int, completion_tokens: int,
+                       latency: float, generation_seconds: float, done: bool = True) -> dict:
+        """The (final) response object of a request, in the Ollama or OpenAI format of its path"""
+        model = body.get("model", "replay")
+        if self.path.startswith("/api/"):
+            response = {
+                "model": model,
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "done": done,
+            }
+            if self.path == "/api/generate":
+                response["response"] = content
+            else:
+                response["message"] = {"role": "assistant", "content": content}
+            if done:
+                response.update({
+                    "done_reason": "stop",
+                    "total_duration": int((latency + generation_seconds) * 1e9),
+                    "load_duration": 0,
+                    "prompt_eval_count": prompt_tokens,
+                    "prompt_eval_duration": int(latency * 1e9),
+                    "eval_count": completion_tokens,
+                    "eval_duration": int(generation_seconds * 1e9),
+                })
+            return response
+        return {
+            "id": f"replay-{get_prompt_hash(content)[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def stream_response(self, body: dict, tokens: List[str], prompt_tokens: int, latency: float) -> None:
+        """Stream the tokens after the latency, at the configured tokens/second"""
+        ollama = self.path.startswith("/api/")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson" if ollama else "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        time.sleep(latency)
+        start = time.time()
+        for token in iter_paced(tokens, self.server.args.tokens_per_second):
+            self.write_chunk(self.format_chunk(body, token, done=False))
+        generation_seconds = time.time() - start
+
+        if ollama:
+            final = self.build_response(body, "", prompt_tokens, len(tokens), latency, generation_seconds)
+            self.write_chunk(json.dumps(final).encode("utf-8") + b"\n")
+        else:
+            self.write_chunk(self.format_chunk(body, "", done=True))
+            self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+    def format_chunk(self, body: dict, token: str, done: bool) -> bytes:
+        if self.path.startswith("/api/"):
+            chunk = self.build_response(body, token, 0, 0, 0.0, 0.0, done=done)
+            return json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n"
+        chunk = {
+            "id": "replay",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", "replay"),
+            "choices": [{
+                "index": 0,
+                "delta": {"content": token} if not done else {},
+                "finish_reason": "stop" if done else None,
+            }],
+        }
+        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def get_last_user_message(messages: List[dict]) -> str:
+    """Text of the last user message of a chat request, content parts are joined"""
+    for message in reversed(messages):
+        if message.get("role") == "user":
+            content = message.get("content") or ""
+            if isinstance(content, list):
+                content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+            return content
+    return ""
+
+
+def iter_paced(tokens: List[str], tokens_per_second: float) -> Iterator[str]:
+    """Yield the tokens at a fixed rate, all at once if the rate is 0"""
+    start = time.time()
+    for i, token in enumerate(tokens):
+        if tokens_per_second:
+            time.sleep(max(0.0, start + (i + 1) / tokens_per_second - time.time()))
+        yield token
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve recorded LLM responses through Ollama and OpenAI compatible endpoints."
+    )
+    parser.add_argument(
+        "--config_path",
+        required=True,
+        help="Path to a config with onto_list and the prompt and sys path patterns",
+    )
+    parser.add_argument(
+        "--responses_pattern",
+        default=None,
+        help="Path pattern with $$onto$$ of the recorded responses, defaults to the sys pattern of the config",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument(
+        "--latency",
+        default="const:0",
+        help="Distribution of the time to first token in seconds: const:<s>, uniform:<min>,<max>, "
+        "normal:<mean>,<std>, lognormal:<mu>,<sigma> or exp:<mean>",
+    )
+    parser.add_argument(
+        "--tokens_per_second",
+        type=float,
+        default=0.0,
+        help="Rate at which the response tokens are generated, 0 for no generation time",
+    )
+    parser.add_argument(
+        "--error_rate",
+        type=float,
+        default=0.0,
+        help="Share of the requests answered with an injected HTTP 500 error",
+    )
+    parser.add_argument(
+        "--rate_limit_rate",
+        type=float,
+        default=0.0,
+        help="Share of the requests answered with an HTTP 429 response, on top of the limits",
+    )
+    parser.add_argument(
+        "--rpm", type=int, default=0, help="Requests per minute before HTTP 429 responses, 0 for no limit"
+    )
+    parser.add_argument(
+        "--tpm", type=int, default=0, help="Prompt and response tokens per minute before HTTP 429 responses"
+    )
+    parser.add_argument(
+        "--max_concurrency",
+        type=int,
+        default=0,
+        help="Maximum number of requests in progress before HTTP 429 responses, 0 for no limit",
+    )
+    parser.add_argument(
+        "--retry_after",
+        type=float,
+        default=1.0,
+        help="Retry-After seconds of the injected and concurrency limit 429 responses",
+    )
+    parser.add_argument(
+        "--on_miss",
+        choices=ON_MISS,
+        default="error",
+        help="Answer prompts without a recorded response with an HTTP 404 error or an empty response",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the latencies, errors and rate limits")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    config = read_json(args.config_path)
+    if not config:
+        return
+    try:
+        LatencyDistribution(args.latency)
+    except ValueError as e:
+        print(str(e))
+        return
+
+    responses_pattern = args.responses_pattern or config["path_patterns"]["sys"]
+    index = ReplayIndex()
+    for onto in config["onto_list"]:
+        prompt_file = config["path_patterns"]["prompt"].replace("$$onto$$", onto)
+        responses_file = responses_pattern.replace("$$onto$$", onto)
+        try:
+            num_prompts, num_responses = index.load(prompt_file, responses_file)
+            print(f"Loaded {num_prompts} prompts and {num_responses} responses of {onto}")
+        except Exception as e:
+            print(f"Error loading the responses of {onto}: {str(e)}")
+
+    server = ReplayServer((args.host, args.port), index, args)
+    print(f"Replaying {len(index.responses)} responses on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.print_stats()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+from typing import BinaryIO, Dict, List, Optional
+
+from kgbench.utils.io import first_non_whitespace_byte, json_loads
+
+
+def normalize_train_record(sent: dict) -> dict:
+    """
+    Normalize a train record to a sentence with a list of triples. The following train
+    formats are supported:
+        - {"sent": ..., "triples": [{"sub": ..., "rel": ..., "obj": ...}]}
+        - {"sent": ..., "sub_label": ..., "rel_label": ..., "obj_label": ...}
+        - {"text": ..., "subject": ..., "relation": ..., "object": ...}
+    :param sent: a train record
+    :return: a dictionary with the "sent" text and the "triples"
+    """
+    # Get the sentence text
+    sentence = sent.get("text", sent.get("sent", ""))
+
+    # Get triples from the training data
+    triples = []
+    if "triples" in sent:
+        triples = sent["triples"]
+    elif all(k in sent for k in ["rel_label", "sub_label", "obj_label"]):
+        triples = [
+            {
+                "rel": sent["rel_label"],
+                "sub": sent["sub_label"],
+                "obj": sent["obj_label"],
+            }
+        ]
+    elif all(k in sent for k in ["relation", "subject", "object"]):
+        triples = [
+            {
+                "rel": sent["relation"],
+                "sub": sent["subject"],
+                "obj": sent["object"],
+            }
+        ]
+
+    return {"sent": sentence, "triples": triples}
+
+
+class TrainCorpus:
+    """
+    Index over the train sentences of an ontology, keyed by sentence id. For JSONL files
+    only the byte offset of each line is kept in memory and a record is parsed and
+    normalized when it is looked up, so lookups take constant time and the train set is
+    never held as dictionaries. A file holding a single JSON array is loaded in memory.
+    """
+
+    def __init__(self, train_file: str):
+        self.train_file = train_file
+        self._offsets: Dict[str, int] = {}
+        self._records: Dict[str, dict] = {}
+        self._file: Optional[BinaryIO] = open(train_file, "rb")
+
+        if first_non_whitespace_byte(self._file) == b"[":
+            # a JSON array, the records are normalized once and kept in memory
+            for sent in json_loads(self._file.read()):
+                self._records.setdefault(sent.get("id"), normalize_train_record(sent))
+            self.close()
+        else:
+            self._build_offset_index()
+
+    def _build_offset_index(self) -> None:
+        offset = 0
+        for line in self._file:
+            if line.strip():
+                train_id = json_loads(line).get("id")
+                # keep the first occurrence of an id, as a linear scan would
+                self._offsets.setdefault(train_id, offset)
+            offset += len(line)
+
+    def __len__(self) -> int:
+        return len(self._offsets) + len(self._records)
+
+    def __contains__(self, train_id: str) -> bool:
+        return train_id in self._offsets or train_id in self._records
+
+    def __enter__(self) -> "TrainCorpus":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def ids(self) -> List[str]:
+        """The train sentence ids in file order"""
+        return list(self._offsets) + list(self._records)
+
+    def get(self, train_id: str) -> Optional[dict]:
+        """
+        Look up a train sentence by id.
+        :param train_id: the id of the train sentence
+        :return: the normalized train record (see normalize_train_record) or None if not found
+        """
+        if train_id in self._records:
+            return self._records[train_id]
+        offset = self._offsets.get(train_id)
+        if offset is None:
+            return None
+        self._file.seek(offset)
+        return normalize_train_record(json_loads(self._file.readline()))
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def load_train_corpus(train_file: str) -> Optional[TrainCorpus]:
+    """Index a train file, None if the file could not be loaded"""
+    try:
+        return TrainCorpus(train_file)
+    except Exception as e:
+        print(f"Error loading file {train_file}: {str(e)}")
+        return None
@@ -0,0 +1,104 @@
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from kgbench.ontology import CompiledOntology, compile_ontology
+
+# Entities are free text on a single line. The subject ends at the first comma, the object may
+# contain commas and balanced parentheses, so "rel(sub, obj)" is closed by the last ")".
+_ENTITY_RULES = r"""subject ::= [^ ,()\n] [^,()\n]*
+object ::= object-part (object-part | " ")*
+object-part ::= [^ ()\n] | "(" [^()\n]* ")"
+"""
+
+
+def _gbnf_literal(text: str) -> str:
+    escaped = text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'"{escaped}"'
+
+
+def _get_relation_signatures(ontology: CompiledOntology) -> Dict[str, List[str]]:
+    """relation label -> "domain -> range" of each of its signatures, in ontology order"""
+    signatures: Dict[str, List[str]] = {}
+    for label, domain, range_ in ontology.relation_signatures:
+        signatures.setdefault(label, []).append(f"{domain} -> {range_}")
+    if not signatures:
+        raise ValueError(f"Ontology {ontology.id} has no relations with a domain and range")
+    return signatures
+
+
+def build_triples_grammar(
+    ontology: Union[dict, CompiledOntology], max_triples: Optional[int] = None
+) -> str:
+    """
+    Compile the relations of an ontology into a GBNF grammar for llama.cpp. The grammar only
+    accepts "relation(subject, object)" lines whose relation is one of the ontology relations
+    (with spaces replaced by underscores, as in the prompts), so the model cannot spend tokens
+    on commentary, code fences or relations outside of the ontology. The domain and range of
+    each relation are kept as comments; the entities themselves are free text.
+    :param ontology: the ontology dictionary or a compiled ontology
+    :param max_triples: optional maximum number of triple lines
+    :return: the grammar text, with "root" as start rule
+    """
+    signatures = _get_relation_signatures(compile_ontology(ontology))
+
+    if max_triples is None:
+        lines = 'root ::= (triple ("\\n" triple)*)?'
+    else:
+        lines = f'root ::= (triple ("\\n" triple){{0,{max(0, max_triples - 1)}}})?'
+
+    relation_rules: List[Tuple[str, str]] = []
+    for i, (label, label_signatures) in enumerate(signatures.items()):
+        comment = f"# {label}: {'; '.join(label_signatures)}".replace("\n", " ")
+        relation_rules.append((comment, f"relation-{i} ::= {_gbnf_literal(label)}"))
+
+    return "\n".join(
+        [
+            lines,
+            'triple ::= relation "(" subject ", " object ")"',
+            "relation ::= " + " | ".join(f"relation-{i}" for i in range(len(relation_rules))),
+            *[line for rule in relation_rules for line in rule],
+            _ENTITY_RULES,
+        ]
+    )
+
+
+def build_triples_schema(ontology: Union[dict, CompiledOntology]) -> Dict[str, Any]:
+    """
+    Compile the relations of an ontology into a JSON schema of the response: an object with a
+    "triples" array of {"subject", "relation", "object"} objects, where the relation is one of
+    the ontology relations (with spaces replaced by underscores) and the entities are strings.
+    The domain and range of each relation are given in the description of the relation.
+    :param ontology: the ontology dictionary or a compiled ontology
+    :return: the JSON schema, in the strict subset accepted by OpenAI structured outputs
+    """
+    signatures = _get_relation_signatures(compile_ontology(ontology))
+    triple = {
+        "type": "object",
+        "properties": {
+            "subject": {"type": "string"},
+            "relation": {
+                "type": "string",
+                "enum": list(signatures),
+                "description": "; ".join(
+                    f"{label}: {', '.join(label_signatures)}"
+                    for label, label_signatures in signatures.items()
+                ),
+            },
+            "object": {"type": "string"},
+        },
+        "required": ["subject", "relation", "object"],
+        "additionalProperties": False,
+    }
+    return {
+        "type": "object",
+        "properties": {"triples": {"type": "array", "items": triple}},
+        "required": ["triples"],
+        "additionalProperties": False,
+    }
+
+
+def build_response_format(schema: Dict[str, Any], name: str = "triples") -> Dict[str, Any]:
+    """Wrap a JSON schema into the response_format of a litellm completion request"""
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name, "schema": schema, "strict": True},
+    }
@@ -1,6 +1,8 @@
 import re
 from pathlib import Path
-from typing import Dict
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from kgbench.utils.io import read_json
 
 
 def get_concept_label(ontology: dict, concept_qid: str) -> str:
@@ -31,6 +33,47 @@ def get_ontology_concepts(ontology: dict) -> str:
         return ""
 
 
+def get_concept_labels(ontology: dict) -> Dict[str, str]:
+    """
+    Build a map from concept QID to label. If a QID occurs more than once, the first
+    label is kept, the same one get_concept_label returns.
+    :param ontology: The ontology dictionary containing concepts.
+    :return: A dictionary from concept QID to label.
+    """
+    concept_labels = {}
+    for concept in ontology.get("concepts", []):
+        concept_labels.setdefault(concept.get("qid"), concept.get("label", ""))
+    return concept_labels
+
+
+def get_relation_signatures(ontology: dict) -> List[Tuple[str, str, str]]:
+    """
+    Resolve the domain and range labels of the ontology relations.
+    :param ontology: The ontology dictionary containing relations and concepts.
+    :return: A list of (relation label, domain label, range label) in ontology order where
+        spaces in the relation label are replaced with underscores. Relations with a missing
+        label, domain or range are skipped.
+    """
+    concept_labels = get_concept_labels(ontology)
+
+    signatures = []
+    for relation in ontology["relations"]:
+        label = relation.get("label", "").replace(
+            " ", "_"
+        )  # Replace spaces with underscores
+
+        # Retrieve labels using QIDs
+        domain = concept_labels.get(relation.get("domain", ""), "")
+        range_ = concept_labels.get(relation.get("range", ""), "")
+
+        # Skip if any part is missing
+        if not label or not domain or not range_:
+            continue
+
+        signatures.append((label, domain, range_))
+    return signatures
+
+
 def get_ontology_relations(ontology: dict) -> str:
     """
     Extract and format ontology relations.
@@ -41,29 +84,68 @@ def get_ontology_relations(ontology: dict) -> str:
         if not isinstance(ontology, dict) or "relations" not in ontology:
             return ""
 
-        relations = []
-        for relation in ontology["relations"]:
-            label = relation.get("label", "").replace(
-                " ", "_"
-            )  # Replace spaces with underscores
+        relations = [
+            f"{label}({domain},{range_})"
+            for label, domain, range_ in get_relation_signatures(ontology)
+        ]
+        return ", ".join(relations)
+    except Exception as e:
+        print(f"Error getting ontology relations: {str(e)}")
+        return ""
+
+
+class CompiledOntology:
+    """
+    An ontology preprocessed once for prompt generation and evaluation. It keeps hashed
+    lookups for concept labels, relation labels and domain/range constraints, and the
+    pre-rendered "Ontology Concepts" and "Ontology Relations" prompt header strings.
+    """
 
-            domain_qid = relation.get("domain", "")
-            range_qid = relation.get("range", "")
+    def __init__(self, ontology: dict):
+        self.ontology = ontology
+        self.id: Optional[str] = ontology.get("id")
+        self.concept_labels: Dict[str, str] = get_concept_labels(ontology)
+        # relation labels with spaces replaced by underscores, as produced in the system triples
+        self.relation_labels: FrozenSet[str] = frozenset(
+            rel["label"].replace(" ", "_") for rel in ontology.get("relations", [])
+        )
+        self.relation_signatures: List[Tuple[str, str, str]] = (
+            get_relation_signatures(ontology) if "relations" in ontology else []
+        )
+        # relation label -> (domain label, range label)
+        self.domain_range: Dict[str, Tuple[str, str]] = {}
+        for label, domain, range_ in self.relation_signatures:
+            self.domain_range.setdefault(label, (domain, range_))
+        # pre-rendered strings shared by every prompt of the ontology
+        self.concepts_header: str = get_ontology_concepts(ontology)
+        self.relations_header: str = get_ontology_relations(ontology)
+        # the concept labels appended to test sentences as hallucination context
+        self.concept_context: str = " ".join(
+            [c["label"] for c in ontology.get("concepts", [])]
+        )
+
+    @classmethod
+    def from_file(cls, ontology_file: str) -> Optional["CompiledOntology"]:
+        """Load and compile an ontology JSON file, None if the file could not be loaded"""
+        ontology = read_json(ontology_file)
+        if not ontology:
+            return None
+        return cls(ontology)
 
-            # Retrieve labels using QIDs
-            domain = get_concept_label(ontology, domain_qid)
-            range_ = get_concept_label(ontology, range_qid)
+    def get_concept_label(self, concept_qid: str) -> str:
+        """Retrieve the label for a given concept QID, an empty string if not found"""
+        return self.concept_labels.get(concept_qid, "")
 
-            # Skip if any part is missing
-            if not label or not domain or not range_:
-                continue
+    def is_conformant(self, relation: str) -> bool:
+        """Check if a relation label (with underscores) is defined in the ontology"""
+        return relation in self.relation_labels
 
-            relations.append(f"{label}({domain},{range_})")
 
-        return ", ".join(relations)
-    except Exception as e:
-        print(f"Error getting ontology relations: {str(e)}")
-        return ""
+def compile_ontology(ontology) -> "CompiledOntology":
+    """Compile an ontology dictionary, compiled ontologies are returned as is"""
+    if isinstance(ontology, CompiledOntology):
+        return ontology
+    return CompiledOntology(ontology)
 
 
 def get_file_paths(config: dict) -> Dict[str, dict]:
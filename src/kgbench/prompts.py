@@ -1,92 +1,16 @@
-import json
-import os
-from typing import Dict, List, Optional
-
-
-def parse_triples(response_text: str) -> List[List[str]]:
-    """Parse the response text to extract triples."""
-    triples = []
-    lines = response_text.strip().split('\n')
-    for line in lines:
-        line = line.strip()
-        if not line:
-            continue
-        if '(' in line and ')' in line:
-            try:
-                relation_part, args_part = line.split('(', 1)
-                args_part = args_part.rstrip(')')
-                args = args_part.split(',', 1)
-                if len(args) == 2:
-                    sub = args[0].strip()
-                    obj = args[1].strip()
-                    rel = relation_part.strip()
-                    triples.append([sub, rel, obj])
-            except Exception as e:
-                print(f"Error parsing line: {line}, Error: {str(e)}")
-    return triples
-
-
-def get_concept_label(ontology: dict, concept_qid: str) -> str:
-    """
-    Retrieve the label for a given concept QID from the ontology.
-    :param ontology: The ontology dictionary containing concepts.
-    :param concept_qid: The QID of the concept.
-    :return: The label of the concept or an empty string if not found.
-    """
-    for concept in ontology.get("concepts", []):
-        if concept.get("qid") == concept_qid:
-            return concept.get("label", "")
-    return ""
-
-
-def get_ontology_concepts(ontology: dict) -> str:
-    """Extract concepts from ontology"""
-    try:
-        if isinstance(ontology, dict) and "concepts" in ontology:
-            concepts = []
-            for concept in ontology["concepts"]:
-                if isinstance(concept, dict) and "label" in concept:
-                    concepts.append(concept["label"])
-            return ", ".join(concepts)
-        return ""
-    except Exception as e:
-        print(f"Error getting ontology concepts: {str(e)}")
-        return ""
-
-
-def get_ontology_relations(ontology: dict) -> str:
-    """
-    Extract and format ontology relations.
-    :param ontology: The ontology dictionary containing relations and concepts.
-    :return: A comma-separated string of formatted relations.
-    """
-    try:
-        if not isinstance(ontology, dict) or "relations" not in ontology:
-            return ""
-
-        relations = []
-        for relation in ontology["relations"]:
-            label = relation.get("label", "").replace(
-                " ", "_"
-            )  # Replace spaces with underscores
-
-            domain_qid = relation.get("domain", "")
-            range_qid = relation.get("range", "")
-
-            # Retrieve labels using QIDs
-            domain = get_concept_label(ontology, domain_qid)
-            range_ = get_concept_label(ontology, range_qid)
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-            # Skip if any part is missing
-            if not label or not domain or not range_:
-                continue
-
-            relations.append(f"{label}({domain},{range_})")
-
-        return ", ".join(relations)
-    except Exception as e:
-        print(f"Error getting ontology relations: {str(e)}")
-        return ""
+from kgbench.corpus import TrainCorpus, normalize_train_record
+from kgbench.ontology import (  # noqa: F401
+    CompiledOntology,
+    compile_ontology,
+    get_concept_label,
+    get_ontology_concepts,
+    get_ontology_relations,
+)
+from kgbench.similarity import SimilarityMatrix, is_similarity_matrix_file
+from kgbench.triples import parse_triples  # noqa: F401
+from kgbench.utils.io import JsonlWriter, read_json
 
 
 def get_example_prompt(train_sent: dict) -> str:
@@ -120,10 +44,48 @@ def get_test_prompt(test_sentence: str) -> str:
     return f"\n\nTest Sentence: {test_sentence}\nOutput:"
 
 
-def get_similar_sentences(test_id: str, similarity_dict: dict) -> List[str]:
+def build_similarity_index(
+    similarity_data: Union[dict, list, SimilarityMatrix]
+) -> Union[Dict[str, List[str]], SimilarityMatrix]:
+    """
+    Index test-train similarities by test id. The similarity file is either a dictionary
+    from test id to similar train ids or a list of {"test_id", "similar_sentences"} items.
+    A binary similarity matrix is already indexed and returned as is.
+    """
+    if isinstance(similarity_data, (dict, SimilarityMatrix)):
+        return similarity_data
+    similarity_index = {}
+    if isinstance(similarity_data, list):
+        for item in similarity_data:
+            similarity_index.setdefault(item.get("test_id"), item.get("similar_sentences", []))
+    return similarity_index
+
+
+def load_similarity_index(
+    similarity_file: str,
+) -> Optional[Union[Dict[str, List[str]], SimilarityMatrix]]:
+    """
+    Load and index a similarity file, either JSON or a binary similarity matrix which is
+    memory mapped. None if the file could not be loaded.
+    """
+    if is_similarity_matrix_file(similarity_file):
+        try:
+            return SimilarityMatrix.load(similarity_file)
+        except Exception as e:
+            print(f"Error loading file {similarity_file}: {str(e)}")
+            return None
+    similarity_data = read_json(similarity_file)
+    if similarity_data is None:
+        return None
+    return build_similarity_index(similarity_data)
+
+
+def get_similar_sentences(
+    test_id: str, similarity_dict: Union[dict, list, SimilarityMatrix]
+) -> List[str]:
     """Get similar sentences with improved error handling"""
     try:
-        if isinstance(similarity_dict, dict):
+        if isinstance(similarity_dict, (dict, SimilarityMatrix)):
             return similarity_dict.get(test_id, [])
         elif isinstance(similarity_dict, list):
             for item in similarity_dict:
@@ -135,44 +97,43 @@ def get_similar_sentences(test_id: str, similarity_dict: dict) -> List[str]:
 
 
 def get_train_sentence(
-    simil_sent_id: str, train_sentences: List[dict]
+    simil_sent_id: str, train_sentences: Union[TrainCorpus, List[dict]]
 ) -> Optional[dict]:
     """Get training sentence with proper triple extraction"""
     try:
+        if isinstance(train_sentences, TrainCorpus):
+            return train_sentences.get(simil_sent_id)
         if isinstance(train_sentences, list):
             for sent in train_sentences:
                 if sent.get("id") == simil_sent_id:
-                    # Get the sentence text
-                    sentence = sent.get("text", sent.get("sent", ""))
-
-                    # Get triples from the training data
-                    triples = []
-                    if "triples" in sent:
-                        triples = sent["triples"]
-                    elif all(k in sent for k in ["relation", "subject", "object"]):
-                        triples = [
-                            {
-                                "rel": sent["relation"],
-                                "sub": sent["subject"],
-                                "obj": sent["object"],
-                            }
-                        ]
-
-                    return {"sent": sentence, "triples": triples}
+                    return normalize_train_record(sent)
         return None
     except Exception as e:
         print(f"Error getting train sentence: {str(e)}")
         return None
 
 
+def get_ontology_header(ontology: CompiledOntology) -> str:
+    """The ontology concepts and relations of a prompt"""
+    return (
+        f"Ontology Concepts: {ontology.concepts_header}\n"
+        f"Ontology Relations: {ontology.relations_header}"
+    )
+
+
 def prepare_prompt(
-    ontology: dict, test_sentence: str, train_sent: dict
+    ontology: Union[dict, CompiledOntology], test_sentence: str, train_sent: dict
 ) -> Optional[str]:
-    """Prepare prompt with proper formatting"""
+    """
+    Prepare prompt with proper formatting. Pass a CompiledOntology when generating
+    many prompts for the same ontology, so the ontology header is rendered only once.
+    """
     try:
         if not all([ontology, test_sentence, train_sent]):
             return None
 
+        ontology = compile_ontology(ontology)
+
         prompt = (
             "Given the following ontology and sentences, please extract the triples from the sentence according "
             "to the relations in the ontology. In the output, only include the triples in the given output format."
@@ -180,11 +141,7 @@ def prepare_prompt(
         )
 
         # Add concepts and relations
-        concepts = get_ontology_concepts(ontology)
-        relations = get_ontology_relations(ontology)
-
-        prompt += f"Ontology Concepts: {concepts}\n"
-        prompt += f"Ontology Relations: {relations}"
+        prompt += get_ontology_header(ontology)
 
         # Add example with triples
         prompt += get_example_prompt(train_sent)
@@ -197,25 +154,114 @@ def prepare_prompt(
         return None
 
 
-def write_prompts(prompts_json: List[dict], prompt_file: str) -> None:
-    """Write prompts to JSONL file with proper formatting"""
+def prepare_packed_prompt(
+    ontology: Union[dict, CompiledOntology], sentences: List[Tuple[str, dict]]
+) -> Optional[str]:
+    """
+    Prepare one prompt for several test sentences of an ontology, so the instructions and the
+    ontology header are sent once for all of them. Each test sentence comes with its own
+    example and is numbered from 1; the model is asked to write a "Sentence <number>:" line
+    before the triples of each test sentence, see kgbench.triples.split_packed_response.
+    :param ontology: the ontology dictionary or a compiled ontology
+    :param sentences: (test sentence, example train sentence) pairs
+    """
     try:
-        # Ensure the output directory exists
-        output_dir = os.path.dirname(prompt_file)
-        os.makedirs(output_dir, exist_ok=True)
+        if not ontology or not sentences or not all(all(pair) for pair in sentences):
+            return None
 
-        with open(prompt_file, "w", encoding="utf-8") as f:
+        ontology = compile_ontology(ontology)
+
+        prompt = (
+            "Given the following ontology and sentences, please extract the triples from each test sentence "
+            "according to the relations in the ontology. Each test sentence is preceded by an example. In the "
+            "output, write \"Sentence <number>:\" on its own line before the triples of each test sentence and "
+            "only include the triples in the given output format."
+            "\n\nCONTEXT:\n\n"
+        )
+        prompt += get_ontology_header(ontology)
+
+        for number, (test_sentence, train_sent) in enumerate(sentences, start=1):
+            prompt += f"\n\n### Sentence {number}"
+            prompt += get_example_prompt(train_sent)
+            prompt += f"\n\nTest Sentence {number}: {test_sentence}"
+
+        prompt += "\n\nOutput:"
+        return prompt
+    except Exception:
+        return None
+
+
+def get_prompt_prefix_key(prompt: str) -> Tuple[str, str]:
+    """
+    Split a prompt into the parts shared with other prompts: the instructions with the ontology
+    header, then the few-shot example. The test sentence, which is never shared, is dropped.
+    Packed prompts are split at their first sentence section.
+    :return: the (header, example) pair, empty strings for parts not found in the prompt
+    """
+    test_start = prompt.find("\n\nTest Sentence")
+    if test_start < 0:
+        test_start = len(prompt)
+    example_start = prompt.find("\n\n### Sentence 1\n")
+    if example_start < 0:
+        example_start = prompt.find("\n\nExample Sentence:")
+    if example_start < 0 or example_start > test_start:
+        return prompt[:test_start], ""
+    return prompt[:example_start], prompt[example_start:test_start]
+
+
+def _group_by_prefix(prompts: List[dict]) -> List[dict]:
+    groups: Dict[str, Dict[str, List[dict]]] = {}
+    for prompt_data in prompts:
+        header, example = get_prompt_prefix_key(prompt_data.get("prompt") or "")
+        groups.setdefault(header, {}).setdefault(example, []).append(prompt_data)
+    return [
+        prompt_data
+        for examples in groups.values()
+        for group in examples.values()
+        for prompt_data in group
+    ]
+
+
+def schedule_prompts(prompts: Iterable[dict], window: int = 1024) -> Iterator[dict]:
+    """
+    Order prompts to maximize the prefix shared by consecutive requests, so a server with a
+    prefix (KV) cache evaluates each ontology header and each example once: the prompts are
+    grouped by header, then by example, and groups keep the order of their first prompt.
+    The prompts are streamed and grouped in consecutive windows, so at most `window` prompts
+    are held in memory.
+    """
+    batch: List[dict] = []
+    for prompt_data in prompts:
+        batch.append(prompt_data)
+        if len(batch) >= window:
+            yield from _group_by_prefix(batch)
+            batch = []
+    yield from _group_by_prefix(batch)
+
+
+def write_prompts(prompts_json: Iterable[dict], prompt_file: str) -> int:
+    """
+    Write prompts to JSONL file with proper formatting. The prompts are streamed to the
+    file, so prompts_json can be a generator. Packed prompts also keep their "ids".
+    :return: the number of prompts written
+    """
+    try:
+        with JsonlWriter(prompt_file, ensure_ascii=False) as writer:
             for prompt_data in prompts_json:
                 # Ensure consistent formatting
                 formatted_prompt = {
                     "id": prompt_data["id"],
                     "prompt": prompt_data["prompt"].replace("\n        ", "\n").strip(),
                 }
-                json_line = json.dumps(formatted_prompt, ensure_ascii=False)
-                f.write(json_line + "\n")
+                # packed prompts keep the ids of their test sentences
+                if "ids" in prompt_data:
+                    formatted_prompt["ids"] = prompt_data["ids"]
+                writer.write(formatted_prompt)
         print(f"Successfully wrote prompts to {prompt_file}")
+        return writer.count
     except Exception as e:
         print(f"Error writing prompts: {str(e)}")
+        return 0
 
 
 def get_file_paths(config: dict) -> Dict[str, dict]:
@@ -0,0 +1,246 @@
+import json
+import math
+import os
+import struct
+from collections import Counter, defaultdict
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from kgbench.utils.nlp import stem, tokenize
+
+
+def get_terms(text: str) -> List[str]:
+    """Stemmed, lower case terms of a text, punctuation tokens are dropped"""
+    return [stem(token) for token in tokenize(text) if any(c.isalnum() for c in token)]
+
+
+class BM25Index:
+    """
+    Inverted index over a list of documents with BM25 scoring. The postings of each term are
+    kept as an array of document rows and an array of precomputed term weights, so scoring a
+    query only touches the documents that share a term with it.
+    """
+
+    def __init__(self, documents: Sequence[str], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.num_docs = len(documents)
+
+        doc_terms = [Counter(get_terms(document)) for document in documents]
+        doc_lengths = np.array([sum(terms.values()) for terms in doc_terms], dtype=np.float32)
+        self.avg_doc_length = float(doc_lengths.mean()) if self.num_docs else 0.0
+
+        rows, frequencies = defaultdict(list), defaultdict(list)
+        for row, terms in enumerate(doc_terms):
+            for term, frequency in terms.items():
+                rows[term].append(row)
+                frequencies[term].append(frequency)
+
+        # BM25 weight of each (term, document) pair, the query side only sums them up
+        length_norm = self.k1 * (1 - self.b + self.b * doc_lengths / max(self.avg_doc_length, 1e-9))
+        self.postings: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        for term, term_rows in rows.items():
+            term_rows = np.array(term_rows, dtype=np.int32)
+            tf = np.array(frequencies[term], dtype=np.float32)
+            df = len(term_rows)
+            idf = math.log(1 + (self.num_docs - df + 0.5) / (df + 0.5))
+            weights = idf * tf * (self.k1 + 1) / (tf + length_norm[term_rows])
+            self.postings[term] = (term_rows, weights.astype(np.float32))
+
+    def get_scores(self, query: str) -> np.ndarray:
+        """BM25 score of every document for a query"""
+        scores = np.zeros(self.num_docs, dtype=np.float32)
+        for term, query_frequency in Counter(get_terms(query)).items():
+            if term in self.postings:
+                term_rows, weights = self.postings[term]
+                scores[term_rows] += query_frequency * weights
+        return scores
+
+    def search(self, query: str, top_k: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the best matching documents of a query.
+        :return: the rows and scores of the top_k documents, best first; ties are broken by row
+        """
+        scores = self.get_scores(query)
+        top_k = min(top_k, self.num_docs)
+        if top_k == 0:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        # candidates scoring at least the k-th best score, sorted by score and row
+        threshold = np.partition(scores, self.num_docs - top_k)[self.num_docs - top_k]
+        candidates = np.flatnonzero(scores >= threshold)
+        top_rows = candidates[np.lexsort((candidates, -scores[candidates]))][:top_k]
+        return top_rows.astype(np.int32), scores[top_rows]
+
+    def search_many(self, queries: Sequence[str], top_k: int = 5) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the best matching documents of many queries.
+        :return: the rows and scores of the top_k documents of each query, as arrays of shape
+            (number of queries, top_k)
+        """
+        top_k = min(top_k, self.num_docs)
+        rows = np.zeros((len(queries), top_k), dtype=np.int32)
+        scores = np.zeros((len(queries), top_k), dtype=np.float32)
+        for i, query in enumerate(queries):
+            rows[i], scores[i] = self.search(query, top_k)
+        return rows, scores
+
+
+def get_top_k_agreement(similarity_results: dict, reference_results: dict) -> Tuple[float, float]:
+    """
+    Compare the top-k train ids of each test sentence with a reference run.
+    :return: the mean overlap of the top-k sets and the rate of identical top-k lists
+    """
+    overlap, identical = 0.0, 0
+    for test_id, reference_ids in reference_results.items():
+        similar_ids = similarity_results.get(test_id, [])
+        overlap += len(set(similar_ids) & set(reference_ids)) / max(1, len(reference_ids))
+        identical += similar_ids == reference_ids
+    num_tests = max(1, len(reference_results))
+    return overlap / num_tests, identical / num_tests
+
+
+class SimilarityMatrix(Mapping):
+    """
+    Binary, memory-mappable form of a test-train similarity file. For each test sentence it
+    keeps the rows of its top-k train sentences as an int32 matrix and their scores as a
+    float16 matrix, next to the tables of test and train ids. It maps a test id to its list
+    of similar train ids like the JSON similarity files do; rows with fewer than top-k train
+    sentences are padded with -1.
+
+    File layout: the magic bytes, the length of a JSON header with the id tables as an
+    unsigned 64 bit integer, the header, then the index and score matrices, 64-byte aligned.
+    """
+
+    MAGIC: bytes = b"KGSIM\x01\x00\x00"
+    ALIGNMENT: int = 64
+
+    def __init__(
+        self,
+        test_ids: Sequence[str],
+        train_ids: Sequence[str],
+        indices: np.ndarray,
+        scores: Optional[np.ndarray] = None,
+    ):
+        self.test_ids = list(test_ids)
+        self.train_ids = list(train_ids)
+        self.indices = indices
+        if scores is None:
+            scores = np.full(indices.shape, np.nan, dtype=np.float16)
+        self.scores = scores
+        self._test_rows = {}
+        for row, test_id in enumerate(self.test_ids):
+            self._test_rows.setdefault(test_id, row)
+
+    @property
+    def top_k(self) -> int:
+        return self.indices.shape[1] if self.indices.ndim == 2 else 0
+
+    def __getitem__(self, test_id: str) -> List[str]:
+        row = self._test_rows[test_id]
+        return [self.train_ids[index] for index in self.indices[row].tolist() if index >= 0]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._test_rows)
+
+    def __len__(self) -> int:
+        return len(self._test_rows)
+
+    def get_scores(self, test_id: str) -> List[float]:
+        """Scores of the similar train sentences of a test sentence, in the same order"""
+        row = self._test_rows[test_id]
+        return [
+            float(score) for index, score in zip(self.indices[row].tolist(), self.scores[row].tolist())
+            if index >= 0
+        ]
+
+    @classmethod
+    def from_dict(cls, similarity_dict: Dict[str, List[str]]) -> "SimilarityMatrix":
+        """Convert a JSON similarity dictionary, its scores are unknown and stored as NaN"""
+        train_rows: Dict[str, int] = {}
+        for similar_ids in similarity_dict.values():
+            for train_id in similar_ids:
+                train_rows.setdefault(train_id, len(train_rows))
+        top_k = max((len(similar_ids) for similar_ids in similarity_dict.values()), default=0)
+        indices = np.full((len(similarity_dict), top_k), -1, dtype=np.int32)
+        for row, similar_ids in enumerate(similarity_dict.values()):
+            indices[row, :len(similar_ids)] = [train_rows[train_id] for train_id in similar_ids]
+        return cls(list(similarity_dict), list(train_rows), indices)
+
+    def to_dict(self) -> Dict[str, List[str]]:
+        return {test_id: self[test_id] for test_id in self}
+
+    def save(self, path: str) -> None:
+        """Write the matrix to a binary file, atomically replacing an existing file"""
+        header = json.dumps(
+            {"top_k": self.top_k, "test_ids": self.test_ids, "train_ids": self.train_ids},
+            ensure_ascii=False,
+        ).encode("utf-8")
+        data_offset = _align(len(self.MAGIC) + 8 + len(header), self.ALIGNMENT)
+        index_bytes = np.ascontiguousarray(self.indices, dtype=np.int32).tobytes()
+        scores_offset = _align(data_offset + len(index_bytes), self.ALIGNMENT)
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self.MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            f.write(b"\x00" * (data_offset - f.tell()))
+            f.write(index_bytes)
+            f.write(b"\x00" * (scores_offset - f.tell()))
+            f.write(np.ascontiguousarray(self.scores, dtype=np.float16).tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "SimilarityMatrix":
+        """Map a binary similarity file, the matrices are read lazily from disk"""
+        with open(path, "rb") as f:
+            if f.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError(f"{path} is not a binary similarity file")
+            (header_length,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_length))
+        shape = (len(header["test_ids"]), header["top_k"])
+        data_offset = _align(len(cls.MAGIC) + 8 + header_length, cls.ALIGNMENT)
+        scores_offset = _align(data_offset + shape[0] * shape[1] * 4, cls.ALIGNMENT)
+        if shape[0] * shape[1] == 0:
+            indices = np.zeros(shape, dtype=np.int32)
+            scores = np.zeros(shape, dtype=np.float16)
+        else:
+            indices = np.memmap(path, dtype=np.int32, mode="r", offset=data_offset, shape=shape)
+            scores = np.memmap(path, dtype=np.float16, mode="r", offset=scores_offset, shape=shape)
+        return cls(header["test_ids"], header["train_ids"], indices, scores)
+
+
+def _align(offset: int, alignment: int) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def is_similarity_matrix_file(path: str) -> bool:
+    """Whether a file is a binary similarity file, based on its magic bytes"""
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(SimilarityMatrix.MAGIC)) == SimilarityMatrix.MAGIC
+    except OSError:
+        return False
+
+
+def save_similarity_results(similarity: SimilarityMatrix, path: str, sent_sim_format: str = "json") -> None:
+    """
+    Write similarity results either as a JSON file from test id to similar train ids, or as a
+    binary similarity matrix which also keeps the scores.
+    :param sent_sim_format: json or binary
+    """
+    if sent_sim_format == "binary":
+        similarity.save(path)
+    elif sent_sim_format == "json":
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(similarity.to_dict(), f, indent=4)
+    else:
+        raise ValueError(f"Unsupported similarity format {sent_sim_format}, expected json or binary")
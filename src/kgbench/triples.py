@@ -0,0 +1,234 @@
+import json
+import re
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from kgbench.utils.io import iter_jsonl
+
+# One pass over the response: each match is either a code fence line, a relation(subject, object)
+# line or any other non-empty line. The arguments run to the last ")" of the line, so objects
+# may contain parentheses.
+_line_re = re.compile(
+    r"^[ \t]*(?:"
+    r"(?P<fence>```[\w+-]*)"
+    r"|(?:(?:[-*•]|\d+[.)])[ \t]+)?(?P<rel>[^\s(,][^(\n]*?)[ \t]*\((?P<args>[^\n]*)\)[ \t]*[.,;]?"
+    r"|(?P<other>\S[^\n]*?)"
+    r")[ \t]*\r?$",
+    re.MULTILINE,
+)
+# the subject ends at the first comma outside of parentheses
+_args_re = re.compile(r"^((?:[^,()]|\([^()]*\))*),(.*)$", re.DOTALL)
+_fence_re = re.compile(r"```[\w+-]*")
+# "Sentence 2:" lines of packed responses, also as markdown headings or with "Test" in front;
+# the triples may follow on the same line
+_sentence_re = re.compile(
+    r"^[ \t]*(?:#+[ \t]*)?\**(?:Test[ \t]+)?Sentence[ \t]+(\d+)[ \t]*\**:?\**[ \t]*", re.IGNORECASE | re.MULTILINE
+)
+
+_SUBJECT_KEYS = ("subject", "sub", "head")
+_RELATION_KEYS = ("predicate", "relation", "rel")
+_OBJECT_KEYS = ("object", "obj", "tail")
+
+
+class ParseResult(NamedTuple):
+    triples: List[List[str]]
+    # "lines", "json" or "none" if nothing could be parsed
+    format: str
+    unparsed_lines: int
+
+
+class ParseStats:
+    """Counters of the parsed responses of an ontology"""
+
+    def __init__(self):
+        self.responses = 0
+        self.triples = 0
+        self.json_responses = 0
+        self.empty_responses = 0
+        self.failed_responses = 0
+        self.unparsed_lines = 0
+
+    def add(self, result: ParseResult, response_text: str) -> None:
+        self.responses += 1
+        self.triples += len(result.triples)
+        self.unparsed_lines += result.unparsed_lines
+        if result.format == "json":
+            self.json_responses += 1
+        if not response_text.strip():
+            self.empty_responses += 1
+        elif not result.triples:
+            self.failed_responses += 1
+
+    def update(self, other: "ParseStats") -> None:
+        """Add the counters of another ParseStats, e.g. of a shard of the same ontology"""
+        for name, value in vars(other).items():
+            setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(vars(self))
+
+    def print_stats(self, name: str) -> None:
+        print(
+            f"Parsed {self.triples} triples from {self.responses} responses of {name}: "
+            f"{self.failed_responses} responses without triples, {self.empty_responses} empty, "
+            f"{self.unparsed_lines} unparsed lines, {self.json_responses} in JSON format"
+        )
+
+
+def _split_args(args: str) -> Optional[Tuple[str, str]]:
+    match = _args_re.match(args)
+    if match is None:
+        return None
+    return match.group(1).strip(), match.group(2).strip()
+
+
+def _first_value(item: dict, keys: Tuple[str, ...]) -> Optional[str]:
+    for key in keys:
+        if key in item:
+            return str(item[key])
+    return None
+
+
+def _parse_json(text: str) -> Optional[List[List[str]]]:
+    """Triples of a JSON array of {"subject", "predicate", "object"} objects or of [sub, rel, obj] lists"""
+    start, end = text.find("["), text.rfind("]")
+    if start < 0 or end < start:
+        return None
+    try:
+        items = json.loads(text[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(items, list):
+        return None
+
+    triples = []
+    for item in items:
+        if isinstance(item, dict):
+            triple = [
+                _first_value(item, _SUBJECT_KEYS),
+                _first_value(item, _RELATION_KEYS),
+                _first_value(item, _OBJECT_KEYS),
+            ]
+            if None not in triple:
+                triples.append(triple)
+        elif isinstance(item, list) and len(item) == 3:
+            triples.append([str(value) for value in item])
+    return triples
+
+
+def parse_response(response_text: str) -> ParseResult:
+    """
+    Parse an LLM response. The response is either made of relation(subject, object) lines,
+    possibly in a fenced code block or a bulleted or numbered list, or a JSON array of triples.
+    :param response_text: the text of the response
+    :return: the triples as [subject, relation, object] lists, the detected format and the
+        number of non-empty lines that are not triples
+    """
+    stripped = _fence_re.sub("", response_text).strip()
+    if stripped.startswith("[") or stripped.startswith("{"):
+        triples = _parse_json(stripped)
+        if triples is not None:
+            return ParseResult(triples, "json", 0)
+
+    triples = []
+    unparsed_lines = 0
+    for match in _line_re.finditer(response_text):
+        if match.group("fence") is not None:
+            continue
+        if match.group("rel") is not None:
+            args = _split_args(match.group("args"))
+            if args is not None:
+                triples.append([args[0], match.group("rel"), args[1]])
+                continue
+        unparsed_lines += 1
+    return ParseResult(triples, "lines" if triples else "none", unparsed_lines)
+
+
+def parse_structured_response(response_text: str) -> ParseResult:
+    """
+    Parse a response generated with the JSON schema of kgbench.grammar.build_triples_schema,
+    i.e. an object with a "triples" array, without any pattern matching. Responses that are
+    not valid JSON (e.g. from a provider that ignored the schema) fall back to parse_response.
+    :param response_text: the text of the response
+    :return: the triples as [subject, relation, object] lists, the detected format and the
+        number of array items that are not triples
+    """
+    try:
+        response = json.loads(response_text)
+    except ValueError:
+        return parse_response(response_text)
+    items = response.get("triples") if isinstance(response, dict) else response
+    if not isinstance(items, list):
+        return parse_response(response_text)
+
+    triples = []
+    for item in items:
+        triple = None
+        if isinstance(item, dict):
+            triple = [
+                _first_value(item, _SUBJECT_KEYS),
+                _first_value(item, _RELATION_KEYS),
+                _first_value(item, _OBJECT_KEYS),
+            ]
+        elif isinstance(item, list) and len(item) == 3:
+            triple = [str(value) for value in item]
+        if triple is not None and None not in triple:
+            triples.append(triple)
+    return ParseResult(triples, "json", len(items) - len(triples))
+
+
+def split_packed_response(response_text: str, num_sentences: int) -> List[str]:
+    """
+    Split the response to a packed prompt (see kgbench.prompts.prepare_packed_prompt) into the
+    responses of its test sentences, using the "Sentence <number>:" lines. Text before the first
+    of these lines and sections numbered outside of 1..num_sentences are dropped; a sentence
+    without a section, or with more than one, gets the text of all its sections.
+    :return: the response text of each test sentence, in order
+    """
+    sections = [""] * num_sentences
+    matches = list(_sentence_re.finditer(response_text))
+    for i, match in enumerate(matches):
+        number = int(match.group(1))
+        if not 1 <= number <= num_sentences:
+            continue
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(response_text)
+        sections[number - 1] += response_text[match.end():end]
+    return [section.strip() for section in sections]
+
+
+def parse_triples(response_text: str) -> List[List[str]]:
+    """Parse the response text to extract triples"""
+    return parse_response(response_text).triples
+
+
+def get_response_text(record: dict) -> str:
+    """The response text of a responses file record, the response is either a string or the
+    dictionary returned by get_llm_response"""
+    response = record.get("response")
+    if isinstance(response, dict):
+        response = response.get("response")
+    return response if isinstance(response, str) else ""
+
+
+def parse_responses(records: Iterable[dict], stats: Optional[ParseStats] = None) -> Iterator[dict]:
+    """
+    Parse the responses of a stream of records and yield the records with their "triples"
+    replaced by the parsed triples.
+    :param records: records with an "id" and a "response"
+    :param stats: optional counters updated with each parsed response
+    """
+    for record in records:
+        response_text = get_response_text(record)
+        result = parse_response(response_text)
+        if stats is not None:
+            stats.add(result, response_text)
+        yield {**record, "triples": result.triples}
+
+
+def parse_responses_file(responses_file: str) -> Tuple[List[dict], ParseStats]:
+    """
+    Parse all responses of a responses file in one pass.
+    :return: the records with the parsed triples and the parse counters of the file
+    """
+    stats = ParseStats()
+    records = list(parse_responses(iter_jsonl(responses_file), stats))
+    return records, stats
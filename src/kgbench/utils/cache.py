@@ -0,0 +1,121 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of LLM responses stored in SQLite.
+    Entries are keyed by a hash of the provider, model, temperature, max_tokens
+    and prompt. When the number of entries exceeds max_entries, the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, db_path: str, max_entries: int = 100_000):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access "
+            "ON responses(last_access)"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(
+        provider: str,
+        model: str,
+        temperature: float,
+        max_tokens: Optional[int],
+        prompt: str,
+        response_format: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        """
+        Compute the cache key of a request.
+        :param response_format: the structured output format of the request, if any
+        :return: the hex SHA-256 digest of the request parameters and prompt
+        """
+        request = [provider, model, float(temperature), max_tokens, prompt]
+        # free text requests keep the keys of the entries cached before structured outputs
+        if response_format is not None:
+            request.append(response_format)
+        payload = json.dumps(request, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a cached value and mark it as recently used.
+        :param key: the key computed by make_key
+        :return: the cached value or None on a miss
+        """
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.conn.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self.conn.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def put(self, key: str, value: Dict[str, Any]) -> None:
+        """
+        Store a value, evicting the least recently used entries above the size cap.
+        :param key: the key computed by make_key
+        :param value: a json serializable value
+        """
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, last_access) "
+                "VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), time.time()),
+            )
+            (num_entries,) = self.conn.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()
+            if num_entries > self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                    (num_entries - self.max_entries,),
+                )
+            self.conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit and miss counters of the current run"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def print_stats(self) -> None:
+        stats = self.stats()
+        print(
+            f"Response cache: {stats['hits']} hits, {stats['misses']} misses "
+            f"(hit rate {stats['hit_rate']:.2%})"
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
@@ -1,3 +1,6 @@
+from typing import Iterable, Optional, Tuple, Union
+
+import numpy as np
 import pandas as pd
 from lancedb import connect
 
@@ -35,14 +38,21 @@ class LanceDB:
 
 
     def create_vector_index(
-            self, table_name: str, overwrite=False):
+            self, table_name: str, overwrite=False, metric: str = "cosine",
+            num_partitions: Optional[int] = None):
         """
         Create an index on a specific table.
 
         :param table_name: Name of the table to create an index on.
+        :param metric: Distance metric of the index, must match the metric used for searching.
+        :param num_partitions: Optional. Number of IVF partitions, defaults to the square root
+            of the number of rows.
         """
         table = self.conn.open_table(table_name)
+        if num_partitions is None:
+            num_partitions = max(1, int(np.sqrt(table.count_rows())))
         table.create_index(
+            metric=metric, num_partitions=num_partitions,
             vector_column_name=self.VECTOR_COL, replace=overwrite)
 
 
@@ -70,15 +80,78 @@ class LanceDB:
         # _pd_columns = set([ID_COL, TEXT_COL, VECTOR_COL, "tags", "embed_type"])
         # len(_required_cols - _pd_columns)
 
-        if (set(self._required_cols) - set(data.column.to_list())) > 0:
+        if len(set(self._required_cols) - set(data.columns.to_list())) > 0:
             raise ValueError(
-                f"DataFrame must have required columns: {",".join(self._required_cols)}")
+                f"DataFrame must have required columns: {', '.join(self._required_cols)}")
 
         # Assuming the DataFrame has at least 'id' and 'vector' columns
         table = self.conn.open_table(table_name)
         table.add(data)
 
 
+    @classmethod
+    def get_schema(cls, dim: int) -> pa.Schema:
+        """
+        Schema of a document table with fixed size float32 vectors.
+
+        :param dim: Dimension of the vectors.
+        """
+        return pa.schema([
+            (cls.ID_COL, pa.string()),
+            (cls.TEXT_COL, pa.string()),
+            (cls.VECTOR_COL, pa.list_(pa.float32(), dim)),
+        ])
+
+    @classmethod
+    def to_record_batch(cls, ids, texts, vectors: np.ndarray) -> pa.RecordBatch:
+        """
+        Build a record batch of documents without going through a DataFrame.
+
+        :param ids: Document ids.
+        :param texts: Document texts.
+        :param vectors: Array with one vector per document.
+        """
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        return pa.RecordBatch.from_arrays(
+            [
+                pa.array(ids, type=pa.string()),
+                pa.array(texts, type=pa.string()),
+                pa.FixedSizeListArray.from_arrays(
+                    pa.array(vectors.ravel()), vectors.shape[1]),
+            ],
+            schema=cls.get_schema(vectors.shape[1]),
+        )
+
+    def add_record_batches(
+            self, table_name: str,
+            batches: Union[pa.RecordBatchReader, Iterable[pa.RecordBatch]],
+            schema: Optional[pa.Schema] = None, overwrite=False) -> int:
+        """
+        Bulk ingest Arrow record batches, creating the table if it does not exist.
+
+        :param table_name: Name of the table to which documents will be added.
+        :param batches: A record batch reader or an iterable of record batches.
+        :param schema: Schema of the batches, required if batches is not a reader.
+        :param overwrite: Replace the table instead of appending to it.
+        :return: Number of rows in the table.
+        """
+        if not isinstance(batches, pa.RecordBatchReader):
+            if schema is None:
+                raise ValueError("A schema is required to ingest an iterable of record batches")
+            batches = pa.RecordBatchReader.from_batches(schema, batches)
+
+        missing_cols = set(self._required_cols) - set(batches.schema.names)
+        if missing_cols:
+            raise ValueError(
+                f"Record batches must have required columns: {', '.join(self._required_cols)}")
+
+        if overwrite or table_name not in self.conn.table_names():
+            table = self.conn.create_table(table_name, data=batches, mode="overwrite")
+        else:
+            table = self.conn.open_table(table_name)
+            table.add(batches)
+        return table.count_rows()
+
     def remove_document(self, table_name: str, document_id):
         """
         Remove a specific document from the table.
@@ -101,22 +174,71 @@ class LanceDB:
         table = self.conn.open_table(table_name)
         table.update(document_id, new_data)
 
-    def search(self, table_name: str, query_vector, top_k=10):
+    def search(self, table_name: str, query_vector, top_k=10, metric: str = "cosine"):
         """
         Perform a search on the specified table.
 
         :param table_name: Name of the table to perform the search on.
         :param query_vector: Vector to be used for querying.
         :param top_k: Number of results to return. Default is 10.
-        :return: List of (id, score) tuples representing the most similar documents.
+        :param metric: Distance metric. Default is cosine.
+        :return: List of (id, distance) tuples representing the most similar documents.
         """
-        table = self.conn.open_table(table_name)
-        vectors = [query_vector]
+        ids, distances = self.search_many(
+            table_name, [query_vector], top_k=top_k, metric=metric)
+        return [
+            (doc_id, float(distance))
+            for doc_id, distance in zip(ids[0], distances[0]) if doc_id is not None
+        ]
+
+    def search_many(
+            self, table_name: str, query_vectors, top_k=10, metric: str = "cosine",
+            batch_size: int = 1024, nprobes: Optional[int] = None,
+            refine_factor: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Search the nearest documents of many query vectors, sending the queries in batches.
 
-        # Fetching and scoring
-        scores = table.search(vectors).to_pandas()
-        results = [(row['id'], row['score']) for _, row in scores.iterrows()]
-        return results
+        :param table_name: Name of the table to perform the search on.
+        :param query_vectors: Array or list with one query vector per row.
+        :param top_k: Number of results per query. Default is 10.
+        :param metric: Distance metric. Default is cosine.
+        :param batch_size: Number of query vectors per search request.
+        :param nprobes: Optional. Number of IVF partitions to probe if the table is indexed.
+        :param refine_factor: Optional. Re-rank refine_factor * top_k candidates with exact distances.
+        :return: An object array of ids and a float32 array of distances, both of shape
+            (number of queries, top_k) and sorted by increasing distance. Rows with fewer
+            than top_k results are padded with None ids and infinite distances.
+        """
+        table = self.conn.open_table(table_name)
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        ids = np.full((len(query_vectors), top_k), None, dtype=object)
+        distances = np.full((len(query_vectors), top_k), np.inf, dtype=np.float32)
+
+        for start in range(0, len(query_vectors), batch_size):
+            batch = query_vectors[start:start + batch_size]
+            query = table.search(batch if len(batch) > 1 else batch[0]) \
+                .metric(metric).limit(top_k).select([self.ID_COL])
+            if nprobes is not None:
+                query = query.nprobes(nprobes)
+            if refine_factor is not None:
+                query = query.refine_factor(refine_factor)
+            results = query.to_arrow()
+
+            # a search with a single vector has no query_index column
+            if "query_index" in results.schema.names:
+                query_index = results["query_index"].to_numpy()
+            else:
+                query_index = np.zeros(results.num_rows, dtype=np.int32)
+            result_ids = np.asarray(results[self.ID_COL].to_pylist(), dtype=object)
+            result_distances = results["_distance"].to_numpy()
+
+            # group the results by query, nearest first
+            order = np.lexsort((result_distances, query_index))
+            query_index = query_index[order]
+            rank = np.arange(len(order)) - np.searchsorted(query_index, query_index)
+            ids[start + query_index, rank] = result_ids[order]
+            distances[start + query_index, rank] = result_distances[order]
+        return ids, distances
 
 
 # Example usage:
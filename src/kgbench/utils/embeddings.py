@@ -0,0 +1,348 @@
+import hashlib
+import sqlite3
+import time
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = str(Path.home() / ".cache" / "kgbench" / "embeddings")
+
+STORE_DTYPES = ("float32", "float16", "int8")
+
+
+def quantize_embeddings(
+    embeddings: np.ndarray, dtype: str = "float32"
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Convert embeddings to a store format.
+    :param embeddings: an array with one embedding per row
+    :param dtype: float32, float16 or int8; int8 uses a symmetric scale per vector
+    :return: the codes and the per-vector scales (None unless dtype is int8)
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype == "float32":
+        return embeddings, None
+    if dtype == "float16":
+        return embeddings.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(embeddings).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(embeddings / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    raise ValueError(f"Unsupported embedding dtype {dtype}, expected one of {STORE_DTYPES}")
+
+
+def dequantize_embeddings(codes: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+    """Convert codes of any store format back to float32 embeddings"""
+    embeddings = np.asarray(codes, dtype=np.float32)
+    if scales is not None:
+        embeddings = embeddings * scales[:, None]
+    return embeddings
+
+
+class EmbeddingStore:
+    """
+    Content-addressed store of sentence embeddings for one model. The embeddings are
+    appended to a memory-mapped array file and a SQLite index maps the hash of each
+    sentence to its row, so the store is shared by every corpus and config that uses
+    the same model and only new or changed sentences are ever encoded. When the number
+    of rows exceeds max_rows, the least recently used rows are evicted and the array is
+    compacted. A store is meant to be written by one process at a time.
+
+    Embeddings are kept as float32, float16 or int8 codes with a float32 scale per vector
+    (stored in a second memory-mapped file). Each format lives in its own directory.
+    """
+
+    VECTORS_FILE: str = "vectors.bin"
+    SCALES_FILE: str = "scales.bin"
+    INDEX_FILE: str = "index.sqlite"
+
+    def __init__(
+        self,
+        model_name: str,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        max_rows: int = 1_000_000,
+        dtype: str = "float32",
+    ):
+        if dtype not in STORE_DTYPES:
+            raise ValueError(f"Unsupported embedding dtype {dtype}, expected one of {STORE_DTYPES}")
+        self.model_name = model_name
+        self.max_rows = max_rows
+        self.dtype = dtype
+        store_name = model_name.replace("/", "_")
+        if dtype != "float32":
+            store_name = f"{store_name}__{dtype}"
+        self.store_dir = Path(cache_dir).expanduser() / store_name
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.store_dir / self.VECTORS_FILE
+        self.scales_path = self.store_dir / self.SCALES_FILE
+
+        self.conn = sqlite3.connect(str(self.store_dir / self.INDEX_FILE))
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, row INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self.conn.commit()
+        dim = self._get_meta("dim")
+        self.dim: Optional[int] = int(dim) if dim else None
+        if self.dim is not None:
+            self._truncate()
+
+    @property
+    def has_scales(self) -> bool:
+        return self.dtype == "int8"
+
+    @staticmethod
+    def sentence_key(sentence: str) -> str:
+        """The key of a sentence, the model is implied by the store"""
+        return hashlib.sha1(sentence.encode("utf-8")).hexdigest()
+
+    def _get_meta(self, name: str) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE name = ?", (name,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, name: str, value: str) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value)
+        )
+
+    def _row_bytes(self) -> int:
+        return self.dim * np.dtype(self.dtype).itemsize
+
+    def _truncate(self) -> None:
+        """
+        Cut the array files to the rows recorded by the index. Rows are appended before the
+        index is committed, so an interrupted add can leave rows (or part of a row) that no
+        entry points to, and the next rows would be appended after them.
+        """
+        (last_row,) = self.conn.execute("SELECT MAX(row) FROM entries").fetchone()
+        num_rows = 0 if last_row is None else last_row + 1
+        sizes = [(self.vectors_path, num_rows * self._row_bytes())]
+        if self.has_scales:
+            sizes.append((self.scales_path, num_rows * np.dtype(np.float32).itemsize))
+        for path, size in sizes:
+            if path.exists() and path.stat().st_size > size:
+                with open(path, "r+b") as f:
+                    f.truncate(size)
+
+    def num_rows(self) -> int:
+        if self.dim is None or not self.vectors_path.exists():
+            return 0
+        return self.vectors_path.stat().st_size // self._row_bytes()
+
+    def size_bytes(self) -> int:
+        """Size of the array files on disk"""
+        return sum(
+            path.stat().st_size for path in (self.vectors_path, self.scales_path) if path.exists()
+        )
+
+    def _vectors(self) -> np.memmap:
+        """Map the array file read-only"""
+        return np.memmap(
+            self.vectors_path, dtype=self.dtype, mode="r", shape=(self.num_rows(), self.dim)
+        )
+
+    def _scales(self) -> np.memmap:
+        return np.memmap(self.scales_path, dtype=np.float32, mode="r", shape=(self.num_rows(),))
+
+    def lookup_quantized(
+        self, sentences: Sequence[str]
+    ) -> Tuple[Optional[np.ndarray], Optional[np.ndarray], List[int]]:
+        """
+        Look up the embeddings of sentences in the store format, without converting them.
+        :param sentences: the sentences to look up
+        :return: the codes with one row per sentence (rows of missing sentences are zero,
+            None if nothing is stored yet), the per-vector scales (None unless the store is
+            int8) and the positions of the missing sentences
+        """
+        if self.dim is None:
+            return None, None, list(range(len(sentences)))
+
+        keys = [self.sentence_key(sentence) for sentence in sentences]
+        rows = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # SQLite limits the number of parameters of a query
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows.update(
+                self.conn.execute(
+                    f"SELECT key, row FROM entries WHERE key IN ({placeholders})", chunk
+                ).fetchall()
+            )
+        now = time.time()
+        self.conn.executemany(
+            "UPDATE entries SET last_access = ? WHERE key = ?",
+            [(now, key) for key in rows],
+        )
+        self.conn.commit()
+
+        codes = np.zeros((len(sentences), self.dim), dtype=self.dtype)
+        scales = np.ones(len(sentences), dtype=np.float32) if self.has_scales else None
+        missing = [i for i, key in enumerate(keys) if key not in rows]
+        # read the rows in file order and in bounded blocks, so only one block of the
+        # memory map is copied at a time
+        found = sorted((i for i, key in enumerate(keys) if key in rows), key=lambda i: rows[keys[i]])
+        if found:
+            vectors = self._vectors()
+            stored_scales = self._scales() if self.has_scales else None
+            for start in range(0, len(found), 10_000):
+                block = found[start:start + 10_000]
+                block_rows = [rows[keys[i]] for i in block]
+                codes[block] = vectors[block_rows]
+                if stored_scales is not None:
+                    scales[block] = stored_scales[block_rows]
+            del vectors, stored_scales
+        return codes, scales, missing
+
+    def lookup(self, sentences: Sequence[str]) -> Tuple[Optional[np.ndarray], List[int]]:
+        """
+        Look up the embeddings of sentences.
+        :param sentences: the sentences to look up
+        :return: a float32 array with one row per sentence (rows of missing sentences are
+            zero, None if nothing is stored yet) and the positions of the missing sentences
+        """
+        codes, scales, missing = self.lookup_quantized(sentences)
+        if codes is None:
+            return None, missing
+        return dequantize_embeddings(codes, scales), missing
+
+    def add(self, sentences: Sequence[str], embeddings: np.ndarray) -> None:
+        """
+        Append the embeddings of sentences to the store.
+        :param sentences: the sentences
+        :param embeddings: a float array with one row per sentence
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if self.dim is None:
+            self.dim = int(embeddings.shape[1])
+            self._set_meta("dim", str(self.dim))
+            self._set_meta("dtype", self.dtype)
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(
+                f"Embedding dimension {embeddings.shape[1]} does not match the store ({self.dim})"
+            )
+
+        # skip duplicates within the batch and sentences already stored
+        new_rows = {}
+        for i, sentence in enumerate(sentences):
+            new_rows.setdefault(self.sentence_key(sentence), i)
+        existing = {
+            key for key in new_rows
+            if self.conn.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone()
+        }
+        positions = [i for key, i in new_rows.items() if key not in existing]
+        if not positions:
+            return
+
+        codes, scales = quantize_embeddings(embeddings[positions], self.dtype)
+        first_row = self.num_rows()
+        with open(self.vectors_path, "ab") as f:
+            f.write(np.ascontiguousarray(codes).tobytes())
+        if scales is not None:
+            with open(self.scales_path, "ab") as f:
+                f.write(scales.tobytes())
+        now = time.time()
+        try:
+            self.conn.executemany(
+                "INSERT INTO entries (key, row, last_access) VALUES (?, ?, ?)",
+                [
+                    (self.sentence_key(sentences[i]), first_row + n, now)
+                    for n, i in enumerate(positions)
+                ],
+            )
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            self._truncate()
+            raise
+
+        if self.num_rows() > self.max_rows:
+            self._evict()
+
+    def _evict(self) -> None:
+        """Keep the most recently used rows (90% of max_rows) and compact the array files"""
+        keep = max(1, int(self.max_rows * 0.9))
+        kept = self.conn.execute(
+            "SELECT key, row FROM entries ORDER BY last_access DESC LIMIT ?", (keep,)
+        ).fetchall()
+        arrays = [(self.vectors_path, self._vectors())]
+        if self.has_scales:
+            arrays.append((self.scales_path, self._scales()))
+        for path, array in arrays:
+            tmp_path = path.with_suffix(".tmp")
+            with open(tmp_path, "wb") as f:
+                for start in range(0, len(kept), 10_000):
+                    chunk = kept[start:start + 10_000]
+                    f.write(np.ascontiguousarray(array[[row for _, row in chunk]]).tobytes())
+            del array
+            tmp_path.replace(path)
+        del arrays
+
+        self.conn.execute("DELETE FROM entries")
+        now = time.time()
+        self.conn.executemany(
+            "INSERT INTO entries (key, row, last_access) VALUES (?, ?, ?)",
+            [(key, new_row, now) for new_row, (key, _) in enumerate(kept)],
+        )
+        self.conn.commit()
+        print(f"Evicted embeddings from {self.store_dir}, {len(kept)} rows kept")
+
+    def get_or_encode_quantized(
+        self,
+        sentences: Sequence[str],
+        encode_fn: Callable[[List[str]], np.ndarray],
+    ) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """
+        Return the embeddings of sentences in the store format, encoding and storing only
+        the missing ones.
+        :param sentences: the sentences to embed
+        :param encode_fn: encodes a list of sentences to an array with one row per sentence
+        :return: the codes with one row per sentence and the per-vector scales (None unless
+            the store is int8)
+        """
+        codes, scales, missing = self.lookup_quantized(sentences)
+        print(
+            f"Embedding store {self.store_dir}: {len(sentences) - len(missing)} cached, "
+            f"{len(missing)} to encode"
+        )
+        if not missing:
+            return codes, scales
+
+        # encode each missing sentence once
+        missing_sentences = list(dict.fromkeys(sentences[i] for i in missing))
+        new_embeddings = np.asarray(encode_fn(missing_sentences), dtype=np.float32)
+        self.add(missing_sentences, new_embeddings)
+
+        new_codes, new_scales = quantize_embeddings(new_embeddings, self.dtype)
+        if codes is None:
+            codes = np.zeros((len(sentences), new_codes.shape[1]), dtype=new_codes.dtype)
+            scales = np.ones(len(sentences), dtype=np.float32) if self.has_scales else None
+        position = {sentence: n for n, sentence in enumerate(missing_sentences)}
+        new_positions = [position[sentences[i]] for i in missing]
+        codes[missing] = new_codes[new_positions]
+        if scales is not None:
+            scales[missing] = new_scales[new_positions]
+        return codes, scales
+
+    def get_or_encode(
+        self,
+        sentences: Sequence[str],
+        encode_fn: Callable[[List[str]], np.ndarray],
+    ) -> np.ndarray:
+        """
+        Return the float32 embeddings of sentences, encoding and storing only the missing ones.
+        :param sentences: the sentences to embed
+        :param encode_fn: encodes a list of sentences to an array with one row per sentence
+        :return: an array with one row per sentence
+        """
+        return dequantize_embeddings(*self.get_or_encode_quantized(sentences, encode_fn))
+
+    def close(self) -> None:
+        self.conn.close()
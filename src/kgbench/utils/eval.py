@@ -1,7 +1,8 @@
-import re
-from typing import Any, Dict, List, Set
+from functools import lru_cache
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple, Union
 
-from kgbench.utils.nlp import stem, tokenize
+from kgbench.ontology import CompiledOntology, compile_ontology
+from kgbench.utils.nlp import normalize_label, normalize_text
 
 
 def calculate_precision_recall_f1(gold: Set, pred: Set) -> (float, float, float):
@@ -28,6 +29,40 @@ def calculate_precision_recall_f1(gold: Set, pred: Set) -> (float, float, float)
     return p, r, f1
 
 
+@lru_cache(maxsize=256)
+def _split_concept_context(concept_context: str) -> Tuple[str, str]:
+    """
+    Split the ontology concept context into the first chunk, which is glued to the end of
+    the test sentence and tokenized with it, and the normalized remainder, which is the
+    same for every test sentence of the ontology. Without sentence-ending punctuation in
+    the concept labels the remainder is tokenized the same way on its own as within the
+    whole context; otherwise the whole concept context is kept with the sentence.
+    :param concept_context: the concept labels of the ontology joined with spaces
+    :return: the first chunk and the normalized remainder
+    """
+    head, sep, rest = concept_context.partition(" ")
+    if not sep or any(ch in concept_context for ch in ".?!"):
+        return concept_context, ""
+    return head, normalize_text(rest)
+
+
+def get_hallucination_context(
+    ontology: Union[Dict, CompiledOntology], test_sentence: str
+) -> str:
+    """
+    Build the normalized context for the hallucination metrics: the test sentence followed
+    by the ontology concept labels, stemmed word by word and without white spaces and
+    underscores. The concept part is normalized once per ontology.
+    :param ontology: ontology (dictionary or CompiledOntology) with the concepts
+    :param test_sentence: test sentence for which the triples are generated
+    :return: the normalized context
+    """
+    head, normalized_rest = _split_concept_context(
+        compile_ontology(ontology).concept_context
+    )
+    return normalize_text(test_sentence + head) + normalized_rest
+
+
 def get_subject_object_hallucinations(
     ontology, test_sentence, triples
 ) -> (float, float):
@@ -35,7 +70,7 @@ def get_subject_object_hallucinations(
     Calculate subject and object hallucinations metrics. As the context for
     calculating hallucinations, we consider the test sentence and the ontology
     concepts as relevant tokens.
-    :param ontology: ontology to take into account with the concepts and relations
+    :param ontology: ontology (dictionary or CompiledOntology) to take into account with the concepts and relations
     :param test_sentence: test sentences for which the triples are generated
     :param triples: a set of triples generated by the system
     :return:
@@ -47,25 +82,21 @@ def get_subject_object_hallucinations(
     if len(triples) == 0:
         return 0, 0
 
-    # append the test sentence with concepts from the ontology
-    test_sentence += " ".join([c["label"] for c in ontology["concepts"]])
-    # stem each word in the test sentence concatenated with the ontology concepts
-    stemmed_sentence = "".join([stem(word) for word in tokenize(test_sentence)])
-    # normalize the text to remove white spaces and underscores
-    normalized_stemmed_sentence = re.sub(r"(_|\s+)", "", stemmed_sentence).lower()
-
-    # count the number of subject and object hallucinations
-    num_subj_hallucinations, num_obj_hallucinations = 0, 0
-    for triple in triples:
-        # clean and normalize subject and object noun phrases the same way as the test sentence
-        normalized_stemmed_subject = clean_entity_string(triple[0])
-        normalized_stemmed_object = clean_entity_string(triple[2])
-
-        # check if the subject/object is found in the stemmed sentence/context text. If not found, mark it as a hallucination
-        if normalized_stemmed_sentence.find(normalized_stemmed_subject) == -1:
-            num_subj_hallucinations += 1
-        if normalized_stemmed_sentence.find(normalized_stemmed_object) == -1:
-            num_obj_hallucinations += 1
+    # the test sentence appended with concepts from the ontology, each word stemmed and
+    # normalized to remove white spaces and underscores
+    normalized_stemmed_sentence = get_hallucination_context(ontology, test_sentence)
+
+    # clean and normalize subject and object noun phrases the same way as the test sentence
+    normalized_stemmed_subjects = clean_entity_strings([triple[0] for triple in triples])
+    normalized_stemmed_objects = clean_entity_strings([triple[2] for triple in triples])
+
+    # count the subjects/objects not found in the stemmed sentence/context text, they are hallucinations
+    num_subj_hallucinations = sum(
+        1 for sub in normalized_stemmed_subjects if sub not in normalized_stemmed_sentence
+    )
+    num_obj_hallucinations = sum(
+        1 for obj in normalized_stemmed_objects if obj not in normalized_stemmed_sentence
+    )
 
     # divide the number of hallucinations by the number of triples to calculate the hallucination metrics
     subj_hallucination = num_subj_hallucinations / len(triples)
@@ -73,10 +104,12 @@ def get_subject_object_hallucinations(
     return subj_hallucination, obj_hallucination
 
 
-def get_ontology_conformance(ontology: Dict, triples: List) -> (float, float):
+def get_ontology_conformance(
+    ontology: Union[Dict, CompiledOntology], triples: List
+) -> (float, float):
     """
     Calculate the ontology conformance and relation hallucination metrics.
-    :param ontology: ontology to take into account with the concepts and relations
+    :param ontology: ontology (dictionary or CompiledOntology) to take into account with the concepts and relations
     :param triples: a set of triples generated by the system
     :return:
         ont_conformance: float - ontology conformance metric
@@ -84,8 +117,8 @@ def get_ontology_conformance(ontology: Dict, triples: List) -> (float, float):
     """
     if len(triples) == 0:
         return 1, 0
-    # replace spaces with underscores in the ontology relations
-    ont_rels = [rel["label"].replace(" ", "_") for rel in ontology["relations"]]
+    # set of ontology relations with spaces replaced by underscores
+    ont_rels = compile_ontology(ontology).relation_labels
     # count the number of system triples relations that are in the ontology
     num_rels_conformant = len([tr for tr in triples if tr[1] in ont_rels])
 
@@ -104,34 +137,51 @@ def normalize_triple(sub_label: str, rel_label: str, obj_label: str) -> str:
     :param obj_label: object string
     :return: a normalized triple as a single concatenated string
     """
-    # remove spaces and underscores and make lower case
-    sub_label = stem(re.sub(r"(_|\s+)", "", sub_label).lower())
-    rel_label = stem(re.sub(r"(_|\s+)", "", rel_label).lower())
-    obj_label = stem(re.sub(r"(_|\s+)", "", obj_label).lower())
+    # remove spaces and underscores, make lower case and stem (memoized)
+    sub_label = normalize_label(sub_label)
+    rel_label = normalize_label(rel_label)
+    obj_label = normalize_label(obj_label)
     # concatenate them to a single string
     tr_key = f"{sub_label}{rel_label}{obj_label}"
     # print(tr_key)
     return tr_key
 
 
+def normalize_triples(triples: Iterable) -> List[str]:
+    """
+    Batch version of normalize_triple
+    :param triples: a list of [subject, relation, object] triples
+    :return: the list of normalized triples in the same order
+    """
+    return [normalize_triple(tr[0], tr[1], tr[2]) for tr in triples]
+
+
 def clean_entity_string(entity: str) -> str:
     """
     Utility method to clean subject and object strings of triples
     :param entity: subject or object string
     :return: the cleaned and normalized string
     """
-    # stem every word for better matches
-    stemmed_entity = "".join([stem(word) for word in tokenize(entity)])
-    # normalizing the string by removing white spaces, underscores and then converting to lower case
-    normalized_stemmed_entity = re.sub(r"(_|\s+)", "", stemmed_entity).lower()
+    # stem every word for better matches and normalize the string by removing white spaces,
+    # underscores and then converting to lower case (memoized)
+    normalized_stemmed_entity = normalize_text(entity)
     # special handling for string with years to remove January 01
     return normalized_stemmed_entity.replace("01januari", "")
 
 
-def convert_to_dict(data: List[Dict], id_name: str = "id") -> Dict:
+def clean_entity_strings(entities: Iterable[str]) -> List[str]:
+    """
+    Batch version of clean_entity_string
+    :param entities: a list of subject or object strings
+    :return: the list of cleaned and normalized strings in the same order
+    """
+    return [clean_entity_string(entity) for entity in entities]
+
+
+def convert_to_dict(data: Iterable[Dict], id_name: str = "id") -> Dict:
     """
     Utility method to convert a list to a dictionary
-    :param data: a list of dictionary objects
+    :param data: a list (or iterable) of dictionary objects
     :param id_name: the attribute to be used as the key for the dictionary
     :return: a dictionary with the same content as the list
     """
@@ -139,7 +189,11 @@ def convert_to_dict(data: List[Dict], id_name: str = "id") -> Dict:
 
 
 def calculate_metrics(
-    start_time: float, end_time: float, response: str, prompt: str
+    start_time: float,
+    end_time: float,
+    response: str,
+    prompt: str,
+    completion_tokens: Optional[int] = None,
 ) -> Dict[str, Any]:
     total_time = end_time - start_time
     response_tokens = len(response.split())
@@ -153,6 +207,8 @@ def calculate_metrics(
         "response_tokens": response_tokens,
         "total_tokens": total_tokens,
         "response_length_chars": len(response),
+        # output tokens counted by the provider, None if it does not report usage
+        "completion_tokens": completion_tokens,
         "memory_usage_mb": None,  # Will be filled by GPU memory usage
     }
     return metrics
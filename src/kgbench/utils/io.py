@@ -1,48 +1,206 @@
 import json
+import os
 from pathlib import Path
-from typing import Dict, List, Optional, Union
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Union
 
+try:
+    import orjson
+except ImportError:  # optional fast JSON backend
+    orjson = None
 
-def save_jsonl(data: List, jsonl_path: str) -> None:
+
+def json_loads(data: Union[str, bytes]) -> Any:
+    """
+    Parse a JSON document with orjson when it is installed. Documents orjson rejects
+    (e.g. lone surrogates) are parsed with the standard library, which also raises the
+    usual json.JSONDecodeError for malformed input.
     """
-    Utility method to serialize a list of json objects to a .jsonl file
-    :param data: list of data items
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
+def first_non_whitespace_byte(f: BinaryIO) -> bytes:
+    """Return the first non-whitespace byte of a file opened in binary mode and rewind it"""
+    first_byte = b""
+    for chunk in iter(lambda: f.read(4096), b""):
+        chunk = chunk.lstrip()
+        if chunk:
+            first_byte = chunk[:1]
+            break
+    f.seek(0)
+    return first_byte
+
+
+def _is_jsonl(src_file: str, first_byte: bytes) -> bool:
+    """Decide if a file is JSONL from its extension, or from its first byte otherwise"""
+    suffix = Path(src_file).suffix.lower()
+    if suffix == ".jsonl":
+        return True
+    if suffix == ".json":
+        return False
+    return first_byte != b"["
+
+
+def iter_jsonl(src_file: str) -> Iterator[Any]:
+    """
+    Stream the records of a JSONL file one line at a time. Files with a .json extension
+    (or starting with "[" without a known extension) are parsed as a single document; the
+    items of a list are yielded one by one, any other document is yielded as is.
+    :param src_file: path to the .jsonl or .json file
+    :return: an iterator over the records
+    """
+    with open(src_file, "rb") as f:
+        if not _is_jsonl(src_file, first_non_whitespace_byte(f)):
+            data = json_loads(f.read())
+            if isinstance(data, list):
+                yield from data
+            else:
+                yield data
+            return
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json_loads(line)
+
+
+class JsonlWriter:
+    """
+    Buffered writer of .jsonl files. The lines are serialized with the standard json
+    module, so the output is the same as the one of save_jsonl and append_jsonl.
+    """
+
+    def __init__(
+        self,
+        jsonl_path: str,
+        mode: str = "w",
+        ensure_ascii: bool = True,
+        buffer_size: int = 1 << 16,
+        durable: bool = False,
+    ):
+        """
+        :param jsonl_path: path to the output .jsonl file
+        :param mode: "w" to truncate the file or "a" to append to it
+        :param ensure_ascii: escape non-ASCII characters in the output
+        :param buffer_size: number of characters buffered before writing to the file
+        :param durable: flush and fsync after every record so it survives a crash
+        """
+        Path(jsonl_path).parent.mkdir(parents=True, exist_ok=True)
+        self.jsonl_path = jsonl_path
+        self.ensure_ascii = ensure_ascii
+        self.buffer_size = buffer_size
+        self.durable = durable
+        self.count = 0
+        self._buffer: List[str] = []
+        self._buffered_chars = 0
+        self._file = open(jsonl_path, mode, encoding="utf-8")
+
+    def __enter__(self) -> "JsonlWriter":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def write(self, item: Any) -> None:
+        line = f"{json.dumps(item, ensure_ascii=self.ensure_ascii)}\n"
+        self._buffer.append(line)
+        self._buffered_chars += len(line)
+        self.count += 1
+        if self.durable or self._buffered_chars >= self.buffer_size:
+            self.flush()
+
+    def write_all(self, items: Iterable[Any]) -> None:
+        for item in items:
+            self.write(item)
+
+    def flush(self, sync: bool = False) -> None:
+        """Write the buffered lines, and fsync the file if sync or durable is set"""
+        if self._buffer:
+            self._file.write("".join(self._buffer))
+            self._buffer = []
+            self._buffered_chars = 0
+        self._file.flush()
+        if sync or self.durable:
+            os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+
+def save_jsonl(data: Iterable, jsonl_path: str, ensure_ascii: bool = True) -> None:
+    """
+    Utility method to serialize a list of json objects to a .jsonl file. The file is
+    written to a temporary file first and then moved in place, so a crash never
+    leaves a partially written file behind.
+    :param data: list (or iterable) of data items
     :param jsonl_path: path to the output .jsonl file
+    :param ensure_ascii: escape non-ASCII characters in the output
     :return: None
     """
-    # ensure directory exists
-    Path(jsonl_path).parent.mkdir(parents=True, exist_ok=True)
-    with open(jsonl_path, "w", encoding='utf-8') as out_file:
-        for item in data:
-            out_file.write(f"{json.dumps(item)}\n")
+    tmp_path = f"{jsonl_path}.tmp"
+    with JsonlWriter(tmp_path, ensure_ascii=ensure_ascii) as writer:
+        writer.write_all(data)
+        writer.flush(sync=True)
+    os.replace(tmp_path, jsonl_path)
 
 
-def append_jsonl(data: Dict, jsonl_path: str) -> None:
+def append_jsonl(
+    data: Dict, jsonl_path: str, ensure_ascii: bool = True, durable: bool = False
+) -> None:
     """
     Utility method to append a new line to a .jsonl file
     :param data: data to be serialized into the file
     :param jsonl_path: path of the file to be appended
+    :param ensure_ascii: escape non-ASCII characters in the output
+    :param durable: fsync the file after writing so the line survives a crash
     :return: None
     """
-    Path(jsonl_path).parent.mkdir(parents=True, exist_ok=True)
+    with JsonlWriter(
+        jsonl_path, mode="a", ensure_ascii=ensure_ascii, durable=durable
+    ) as writer:
+        writer.write(data)
 
-    with open(jsonl_path, "a+", encoding='utf-8') as out_file:
-        out_file.write(f"{json.dumps(data)}\n")
+
+def read_jsonl_records(src_file: str) -> List[Dict]:
+    """
+    Load the valid records of a .jsonl file, skipping lines that cannot be parsed
+    such as a line that was only partially written when a process crashed.
+    :param src_file: path to the .jsonl file
+    :return: the list of parsed records, empty if the file does not exist
+    """
+    records = []
+    if not os.path.exists(src_file):
+        return records
+    with open(src_file, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json_loads(line))
+            except ValueError:
+                # JSONDecodeError, or UnicodeDecodeError for a line cut inside a character
+                print(f"Skipping malformed line in {src_file}")
+    return records
 
 
 def read_json(src_file: str) -> Optional[Union[Dict,List]]:
     """Load either JSON or JSONL file"""
     try:
-        with open(src_file, "r", encoding="utf-8") as f:
-            try:
-                data = json.load(f)
-                return data
-            except json.JSONDecodeError:
-                f.seek(0)
-                data = []
-                for line in f:
-                    data.append(json.loads(line.strip()))
-                return data
+        if Path(src_file).suffix.lower() == ".jsonl":
+            return list(iter_jsonl(src_file))
+        with open(src_file, "rb") as f:
+            content = f.read()
+        try:
+            return json_loads(content)
+        except json.JSONDecodeError:
+            # JSONL content without the .jsonl extension
+            return [json_loads(line) for line in content.splitlines() if line.strip()]
     except Exception as e:
         print(f"Error loading file {src_file}: {str(e)}")
         return None
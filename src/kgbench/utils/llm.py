@@ -1,47 +1,265 @@
+import asyncio
 import subprocess
 import time
-from typing import Any, Dict, Tuple, TypeVar
+from typing import Any, Dict, List, Optional, Tuple, TypeVar
 
 import litellm
 
+from kgbench.utils.cache import ResponseCache
 from kgbench.utils.eval import calculate_metrics
+from kgbench.utils.ratelimit import RateController
 
 Triple = TypeVar("Triple", bound=Tuple[str, str, str])
 
+OLLAMA_PROVIDERS = ("ollama", "ollama_chat")
+
+
+def get_server_metrics(response, provider: str) -> Dict[str, Any]:
+    """
+    Collect the prompt evaluation metrics reported by the server from the public fields of the
+    litellm response: the prompt tokens, the prompt tokens served from the server's prefix cache
+    (OpenAI and vLLM usage details, llama.cpp server timings) and the evaluated prompt tokens
+    and their duration (llama.cpp server timings). Ollama only evaluates the prompt tokens that
+    are not in its cache and litellm reports that count as the prompt tokens; the Ollama
+    durations are dropped by litellm. Values the server does not report are None.
+    :param response: the litellm response
+    :param provider: the litellm provider of the request
+    """
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    timings = getattr(response, "timings", None) or {}
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+
+    prompt_eval_count = timings.get("prompt_n")
+    if provider in OLLAMA_PROVIDERS:
+        prompt_eval_count = prompt_tokens
+    return {
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": getattr(details, "cached_tokens", None) or timings.get("cache_n"),
+        "prompt_eval_count": prompt_eval_count,
+        "prompt_eval_ms": timings.get("prompt_ms"),
+    }
+
+
+def _build_messages(prompt: str) -> List[Dict[str, str]]:
+    return [
+        {
+            "role": "user",
+            "content": f"{prompt}",
+        }
+    ]
+
+
+def _get_cached_response(
+        cache: Optional[ResponseCache], cache_key: Optional[str]) -> Optional[Dict[str, Any]]:
+    if cache is None:
+        return None
+    cached = cache.get(cache_key)
+    if cached is None:
+        return None
+    # the metrics of the original call are returned with the cached response; entries written
+    # without metrics (e.g. by older baseline scripts) have None, like a call without metrics
+    return {"success": True, "response": cached["response"], "metrics": cached.get("metrics")}
+
+
+def _get_completion_tokens(response) -> Optional[int]:
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "completion_tokens", None)
+
+
+def _get_total_tokens(response) -> Optional[int]:
+    usage = getattr(response, "usage", None)
+    return getattr(usage, "total_tokens", None)
+
+
+def supports_response_schema(provider: str, model: str) -> bool:
+    """
+    Whether a provider accepts a JSON schema response_format for a model. Ollama supports
+    schemas for every model; for the other providers the litellm model map is consulted.
+    """
+    if provider in OLLAMA_PROVIDERS:
+        return True
+    try:
+        return litellm.supports_response_schema(model=model, custom_llm_provider=provider)
+    except Exception:
+        return False
+
+
 def get_llm_response(
         prompt: str,
         model: str,
         temperature: float = 0.0,
         provider: str = "ollama",
         base_url: str = "http://localhost:11434",
-        api_key="sk-1234") -> Dict[str, Any]:
+        api_key="sk-1234",
+        max_tokens: Optional[int] = None,
+        cache: Optional[ResponseCache] = None,
+        response_format: Optional[Dict[str, Any]] = None,
+        rate_controller: Optional[RateController] = None) -> Dict[str, Any]:
+    """
+    Send a prompt to a model through litellm.
+    :param response_format: optional structured output format, e.g. the JSON schema format
+        built by kgbench.grammar.build_response_format; it is part of the cache key
+    :param rate_controller: optional requests/tokens per minute budgets of the provider and
+        model; with it, rate limited and failed requests are retried with backoff
+    :return: a dictionary with "success", "response" and "metrics", or "error" on failure
+    """
     try:
-        # Start timing
-        start_time = time.time()
-
-        # Generate response
-        response = litellm.completion(
-            model=f"{provider}/{model}",
-            temperature=temperature,
-            api_key=api_key,
-            api_base=base_url,
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"{prompt}",
-                }
-            ],
-        )
-
-        # End timing
-        end_time = time.time()
+        # Consult the response cache before calling the model
+        cache_key = None
+        if cache is not None:
+            cache_key = ResponseCache.make_key(
+                provider, model, temperature, max_tokens, prompt, response_format)
+            cached = _get_cached_response(cache, cache_key)
+            if cached:
+                return cached
+
+        client_kwargs = {}
+
+        # the rate controller retries the failed requests itself
+        if rate_controller is not None:
+            client_kwargs["max_retries"] = 0
+
+        attempt = 0
+        while True:
+            estimated_tokens = 0
+            if rate_controller is not None:
+                estimated_tokens = rate_controller.estimate_tokens(prompt, max_tokens)
+                time.sleep(rate_controller.reserve(estimated_tokens))
+            request_start = time.monotonic()
+
+            # Start timing
+            start_time = time.time()
+
+            # Generate response
+            try:
+                response = litellm.completion(
+                    model=f"{provider}/{model}",
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    api_key=api_key,
+                    api_base=base_url,
+                    messages=_build_messages(prompt),
+                    response_format=response_format,
+                    **client_kwargs,
+                )
+            except Exception as e:
+                delay = (rate_controller.on_error(e, attempt, request_start, estimated_tokens)
+                         if rate_controller else None)
+                if delay is None:
+                    raise
+                print(f"Retrying in {delay:.1f}s after error: {str(e)}")
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            # End timing
+            end_time = time.time()
+            break
+
+        if rate_controller is not None:
+            rate_controller.on_success(
+                request_start, end_time - start_time, estimated_tokens, _get_total_tokens(response))
 
         # Extract response text
         response_text = response.choices[0].message.content
 
         # Calculate metrics
         metrics = calculate_metrics(
-            start_time, end_time, response_text, prompt)
+            start_time, end_time, response_text, prompt, _get_completion_tokens(response))
+        metrics["server"] = get_server_metrics(response, provider)
+        metrics["attempts"] = attempt + 1
+
+        if cache is not None:
+            cache.put(cache_key, {"response": response_text, "metrics": metrics})
+
+        return {"success": True, "response": response_text, "metrics": metrics}
+
+    except Exception as e:
+        return {"success": False, "error": str(e), "metrics": None}
+
+
+async def get_llm_response_async(
+        prompt: str,
+        model: str,
+        temperature: float = 0.0,
+        provider: str = "ollama",
+        base_url: str = "http://localhost:11434",
+        api_key="sk-1234",
+        max_tokens: Optional[int] = None,
+        cache: Optional[ResponseCache] = None,
+        response_format: Optional[Dict[str, Any]] = None,
+        rate_controller: Optional[RateController] = None) -> Dict[str, Any]:
+    """
+    Async counterpart of get_llm_response built on litellm.acompletion.
+    Returns the same result dictionary so callers can switch between both.
+    With a rate_controller, the number of requests in flight also follows its concurrency.
+    """
+    try:
+        cache_key = None
+        if cache is not None:
+            cache_key = ResponseCache.make_key(
+                provider, model, temperature, max_tokens, prompt, response_format)
+            cached = _get_cached_response(cache, cache_key)
+            if cached:
+                return cached
+
+        client_kwargs = {}
+
+        if rate_controller is not None:
+            client_kwargs["max_retries"] = 0
+
+        attempt = 0
+        while True:
+            estimated_tokens, request_start = 0, time.monotonic()
+            if rate_controller is not None:
+                # the slot is released while waiting for a retry
+                await rate_controller.acquire_slot()
+            try:
+                if rate_controller is not None:
+                    estimated_tokens = rate_controller.estimate_tokens(prompt, max_tokens)
+                    await asyncio.sleep(rate_controller.reserve(estimated_tokens))
+                request_start = time.monotonic()
+                start_time = time.time()
+
+                response = await litellm.acompletion(
+                    model=f"{provider}/{model}",
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    api_key=api_key,
+                    api_base=base_url,
+                    messages=_build_messages(prompt),
+                    response_format=response_format,
+                    **client_kwargs,
+                )
+
+                end_time = time.time()
+                break
+            except Exception as e:
+                delay = (rate_controller.on_error(e, attempt, request_start, estimated_tokens)
+                         if rate_controller else None)
+                if delay is None:
+                    raise
+                print(f"Retrying in {delay:.1f}s after error: {str(e)}")
+            finally:
+                if rate_controller is not None:
+                    await rate_controller.release_slot()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+        if rate_controller is not None:
+            rate_controller.on_success(
+                request_start, end_time - start_time, estimated_tokens, _get_total_tokens(response))
+
+        response_text = response.choices[0].message.content
+
+        metrics = calculate_metrics(
+            start_time, end_time, response_text, prompt, _get_completion_tokens(response))
+        metrics["server"] = get_server_metrics(response, provider)
+        metrics["attempts"] = attempt + 1
+
+        if cache is not None:
+            cache.put(cache_key, {"response": response_text, "metrics": metrics})
 
         return {"success": True, "response": response_text, "metrics": metrics}
 
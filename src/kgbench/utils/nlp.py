@@ -1,11 +1,19 @@
+import re
+from functools import lru_cache
 from pathlib import Path
+from typing import Dict, Iterable, List
 
 import nltk
 from nltk.stem import PorterStemmer
 from nltk.tokenize import word_tokenize
 
+# bounds of the normalization caches
+STEM_CACHE_SIZE: int = 2**16
+NORMALIZE_CACHE_SIZE: int = 2**16
+
 _is_initialized: bool = False
 _stemmer: PorterStemmer = PorterStemmer()
+_whitespace_underscore_re = re.compile(r"(_|\s+)")
 
 def _download_nltk_data():
     global _is_initialized
@@ -23,12 +31,12 @@ def _download_nltk_data():
 
     _is_initialized = True
 
+@lru_cache(maxsize=STEM_CACHE_SIZE)
 def stem(text: str):
-    global _stemmer
     # Idempotent call to download NLTK data
     _download_nltk_data()
 
-    # Return the stem of the text
+    # Return the stem of the text, memoized as the same tokens are stemmed over and over
     return _stemmer.stem(text)
 
 
@@ -38,3 +46,70 @@ def tokenize(text: str):
 
     # Return a list of tokens
     return word_tokenize(text)
+
+
+def remove_whitespace_underscores(text: str) -> str:
+    """Remove white spaces and underscores and convert to lower case"""
+    return _whitespace_underscore_re.sub("", text).lower()
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_label(label: str) -> str:
+    """
+    Normalize a triple element as a whole: white spaces and underscores are removed,
+    the label is converted to lower case and then stemmed.
+    :param label: subject, relation or object string
+    :return: the normalized label
+    """
+    return stem(remove_whitespace_underscores(label))
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_text(text: str) -> str:
+    """
+    Normalize a text word by word: every token is stemmed, the stems are concatenated
+    and white spaces and underscores are removed before converting to lower case.
+    :param text: a sentence or an entity string
+    :return: the normalized text
+    """
+    stemmed_text = "".join([stem(word) for word in tokenize(text)])
+    return remove_whitespace_underscores(stemmed_text)
+
+
+def normalize_labels(labels: Iterable[str]) -> List[str]:
+    """Batch version of normalize_label"""
+    return [normalize_label(label) for label in labels]
+
+
+def normalize_texts(texts: Iterable[str]) -> List[str]:
+    """Batch version of normalize_text"""
+    return [normalize_text(text) for text in texts]
+
+
+def get_cache_stats() -> Dict[str, Dict[str, float]]:
+    """
+    Report the usage of the normalization caches.
+    :return: a dictionary with hits, misses, size and hit rate per cache
+    """
+    stats = {}
+    for name, cached_fn in [
+        ("stem", stem),
+        ("normalize_label", normalize_label),
+        ("normalize_text", normalize_text),
+    ]:
+        info = cached_fn.cache_info()
+        lookups = info.hits + info.misses
+        stats[name] = {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+            "hit_rate": round(info.hits / lookups, 4) if lookups else 0.0,
+        }
+    return stats
+
+
+def clear_caches() -> None:
+    """Clear the normalization caches"""
+    stem.cache_clear()
+    normalize_label.cache_clear()
+    normalize_text.cache_clear()
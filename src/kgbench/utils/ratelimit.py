@@ -0,0 +1,239 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+# HTTP statuses worth retrying besides 429: timeouts, conflicts and server errors
+RETRYABLE_STATUSES = (408, 409, 500, 502, 503, 504, 529)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a per-minute rate, holding at most one minute of
+    tokens. Reservations are taken immediately and may drive the bucket into debt; the caller
+    waits for the returned delay, so concurrent callers are served in reservation order.
+    """
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60
+        self.capacity = capacity if capacity is not None else per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, tokens: float) -> float:
+        """
+        Take tokens from the bucket.
+        :return: the seconds to wait until the reservation is covered by the refill
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= tokens
+            return max(0.0, -self.tokens / self.rate) if self.rate > 0 else 0.0
+
+    def adjust(self, tokens: float) -> None:
+        """Give back (or take more) tokens once the actual usage of a request is known"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens - tokens)
+
+
+class RateController:
+    """
+    Keeps the requests to one provider and model under its requests-per-minute and
+    tokens-per-minute budgets, and adapts the number of requests in flight with AIMD:
+    each success adds 1/concurrency (about one more request per round trip), while a 429
+    response, or a latency above latency_target, halves the concurrency. Only responses
+    to requests sent after the last decrease can decrease it again, so a burst of 429s
+    from one round of requests counts once. A Retry-After header pauses all requests.
+    Failed requests are retried with jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        max_concurrency: int = 1,
+        min_concurrency: int = 1,
+        latency_target: Optional[float] = None,
+        max_retries: int = 6,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+        expected_output_tokens: int = 256,
+    ):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.concurrency = float(self.max_concurrency)
+        self.latency_target = latency_target
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.expected_output_tokens = expected_output_tokens
+        self.in_flight = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+        # asyncio.Condition is bound to the event loop it is first used in
+        self._conditions: Dict[int, asyncio.Condition] = {}
+
+    @classmethod
+    def from_config(cls, rate_limit: Dict[str, Any], concurrency: int = 1) -> "RateController":
+        """
+        Build a controller from the rate_limit section of a model config, e.g.
+        {"rpm": 500, "tpm": 30000, "latency_target": 20, "max_retries": 6}
+        :param concurrency: the maximum number of requests in flight
+        """
+        return cls(max_concurrency=concurrency, **rate_limit)
+
+    def estimate_tokens(self, prompt: str, max_tokens: Optional[int] = None) -> int:
+        """Tokens reserved for a request before its usage is known, counted on whitespace"""
+        return len(prompt.split()) + (max_tokens or self.expected_output_tokens)
+
+    def get_backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Seconds to wait before a retry: full jitter over an exponential bound, at least retry_after"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+
+    def reserve(self, tokens: int) -> float:
+        """
+        Take one request and the estimated tokens from the budgets.
+        :return: the seconds to wait before sending the request
+        """
+        delay = max(0.0, self._paused_until - time.monotonic())
+        if self.requests is not None:
+            delay = max(delay, self.requests.reserve(1))
+        if self.tokens is not None:
+            delay = max(delay, self.tokens.reserve(tokens))
+        return delay
+
+    def on_success(self, start_time: float, latency: float, estimated_tokens: int,
+                   used_tokens: Optional[int] = None) -> None:
+        """
+        Record a successful request.
+        :param start_time: time.monotonic() when the request was sent
+        :param used_tokens: the prompt and completion tokens reported by the provider
+        """
+        if self.tokens is not None and used_tokens is not None:
+            self.tokens.adjust(used_tokens - estimated_tokens)
+        if self.latency_target is not None and latency > self.latency_target:
+            self._decrease(start_time)
+            return
+        with self._lock:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+    def on_rate_limited(self, start_time: float, retry_after: Optional[float] = None) -> None:
+        """Record a 429 response, pausing all requests for retry_after seconds"""
+        with self._lock:
+            self.rate_limited += 1
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        self._decrease(start_time)
+
+    def on_error(self, error: Exception, attempt: int, start_time: float,
+                 estimated_tokens: int = 0) -> Optional[float]:
+        """
+        Record a failed request.
+        :param attempt: the number of retries of the request so far
+        :param start_time: time.monotonic() when the request was sent
+        :param estimated_tokens: the tokens reserved for the request, given back since a failed
+            request reports no usage
+        :return: the seconds to wait before retrying the request, None if it should not be retried
+        """
+        if self.tokens is not None and estimated_tokens:
+            self.tokens.adjust(-estimated_tokens)
+        retry_after = get_retry_after(error)
+        if get_status_code(error) == 429:
+            self.on_rate_limited(start_time, retry_after)
+        if attempt >= self.max_retries or not is_retryable(error):
+            return None
+        with self._lock:
+            self.retries += 1
+        return self.get_backoff(attempt, retry_after)
+
+    def _decrease(self, start_time: float) -> None:
+        with self._lock:
+            if start_time < self._last_decrease:
+                return
+            self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+            self._last_decrease = time.monotonic()
+
+    def _get_condition(self) -> asyncio.Condition:
+        loop_id = id(asyncio.get_running_loop())
+        if loop_id not in self._conditions:
+            self._conditions.clear()
+            self._conditions[loop_id] = asyncio.Condition()
+        return self._conditions[loop_id]
+
+    async def acquire_slot(self) -> None:
+        """Wait until fewer requests than the current concurrency are in flight"""
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.concurrency))
+            self.in_flight += 1
+
+    async def release_slot(self) -> None:
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+
+    def print_stats(self, name: str) -> None:
+        print(
+            f"Rate control of {name}: {self.retries} retries, {self.rate_limited} rate limited responses, "
+            f"concurrency {self.concurrency:.1f} of {self.max_concurrency}"
+        )
+
+
+_controllers: Dict[Tuple[str, str], RateController] = {}
+
+
+def get_rate_controller(
+    provider: str, model: str, rate_limit: Optional[Dict[str, Any]] = None, concurrency: int = 1
+) -> RateController:
+    """
+    The rate controller shared by all requests to a provider and model, created from the
+    rate_limit section of a model config on first use.
+    """
+    key = (provider, model)
+    if key not in _controllers:
+        _controllers[key] = RateController.from_config(rate_limit or {}, concurrency)
+    return _controllers[key]
+
+
+def get_status_code(error: Exception) -> Optional[int]:
+    """HTTP status of a litellm/httpx error, None for connection errors and other exceptions"""
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    """Seconds of the Retry-After header of an error response, if any"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or getattr(
+        error, "litellm_response_headers", None
+    )
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether a failed request may succeed when sent again: rate limits, timeouts, server
+    and connection errors"""
+    status_code = get_status_code(error)
+    if status_code is None:
+        return "connect" in type(error).__name__.lower() or "timeout" in type(error).__name__.lower()
+    return status_code == 429 or status_code in RETRYABLE_STATUSES
@@ -0,0 +1,26 @@
+import numpy as np
+
+from kgbench.utils.embeddings import EmbeddingStore
+
+
+def test_store_drops_rows_appended_without_index_commit(tmp_path):
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((3, 8)).astype(np.float32)
+    store = EmbeddingStore("model", cache_dir=str(tmp_path), dtype="int8")
+    store.add(["a", "b"], embeddings[:2])
+    store.close()
+
+    # an add interrupted before the index commit leaves a row and a half in the array files
+    with open(store.vectors_path, "ab") as f:
+        f.write(b"\x01" * 12)
+    with open(store.scales_path, "ab") as f:
+        f.write(b"\x01" * 4)
+
+    store = EmbeddingStore("model", cache_dir=str(tmp_path), dtype="int8")
+    assert store.num_rows() == 2
+    store.add(["c"], embeddings[2:])
+    found, missing = store.lookup(["a", "b", "c"])
+    store.close()
+
+    assert missing == []
+    np.testing.assert_allclose(found, embeddings, atol=np.abs(embeddings).max() / 127)
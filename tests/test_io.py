@@ -0,0 +1,14 @@
+import json
+
+from kgbench.utils.io import read_jsonl_records
+
+
+def test_read_jsonl_records_skips_line_truncated_mid_character(tmp_path):
+    records = [{"id": "a", "response": "Café"}, {"id": "b", "response": "Pelé"}]
+    data = b"".join(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n" for record in records)
+    # the torn last line stops after the first byte of the two-byte "é"
+    torn = json.dumps({"id": "c", "response": "é"}, ensure_ascii=False).encode("utf-8")
+    path = tmp_path / "responses.jsonl"
+    path.write_bytes(data + torn[:torn.index("é".encode("utf-8")) + 1])
+
+    assert read_jsonl_records(str(path)) == records
@@ -0,0 +1,16 @@
+from kgbench.utils.ratelimit import RateController
+
+
+class ServerError(Exception):
+    status_code = 503
+
+
+def test_failed_request_gives_back_reserved_tokens():
+    controller = RateController(tpm=1000, max_retries=2, backoff_max=0)
+    for attempt in range(3):
+        estimated_tokens = controller.estimate_tokens("one two three", 400)
+        assert controller.reserve(estimated_tokens) == 0
+        controller.on_error(ServerError(), attempt, 0.0, estimated_tokens)
+
+    # without the refund the third reservation would already wait for the refill
+    assert controller.tokens.tokens > 999